@@ -0,0 +1,130 @@
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+from pydantic import BaseModel
+
+from config.environment import ANALYTICS_ENGINE
+from data.query import HeatmapEntry
+from repo import util, user_repo
+from repo.client import database
+from repo.heatmap_repo import HeatmapCubeRepo, CubeKind, list_fields, ignored_params
+from repo.version_repo import VersionRepo
+
+logger = logging.getLogger(__name__)
+
+
+def has_numpy() -> bool:
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+@dataclass
+class FilterSpec:
+    """Query parameters of a heatmap and the dimensions they filter on."""
+    contains: dict[str, str]
+    search_fields: list[str]
+    in_filters: dict[str, str]
+    range_filters: dict[str, tuple[str, str]]
+    any_in_filters: dict[str, str] = field(default_factory=dict)
+
+
+filter_specs = {
+    CubeKind.CLEANDAY: FilterSpec(
+        contains={**{name: name for name in util.contains_filters}, 'address': 'location.address'},
+        search_fields=util.contains_filters,
+        in_filters=util.cube_in_filters,
+        range_filters=util.cube_range_filters,
+        any_in_filters={'tags': 'tags'}
+    ),
+    CubeKind.USER: FilterSpec(
+        contains={name: name for name in user_repo.contains_filters},
+        search_fields=user_repo.contains_filters,
+        in_filters=user_repo.cube_in_filters,
+        range_filters=user_repo.cube_range_filters
+    ),
+}
+
+
+@dataclass
+class LoadedSnapshots:
+    version: str
+    loaded_at: float
+    snapshots: dict
+
+
+class AnalyticsEngine:
+    """In-process columnar copy of the heatmap dimensions, answering heatmaps with NumPy.
+
+    The snapshot is reloaded when the data version changes and is used only while its
+    version is current, so answers are the same as those of the database queries.
+    """
+
+    def __init__(self, enabled: bool):
+        if enabled and not has_numpy():
+            logger.warning('ANALYTICS_ENGINE is set, but numpy is not installed; the engine is disabled')
+            enabled = False
+        self.enabled = enabled
+        self.state: Optional[LoadedSnapshots] = None
+
+    def refresh(self) -> bool:
+        """Reload the snapshot if the data changed since the last load."""
+        from analytics.snapshot import Snapshot
+
+        version = VersionRepo(database).get_data_version()
+        if self.state is not None and self.state.version == version:
+            return False
+
+        # Версия прочитана до загрузки: изменения во время неё сделают снимок устаревшим
+        snapshots = {kind: Snapshot((row['dims'] for row in HeatmapCubeRepo(database).get_dimensions(kind)),
+                                    list_fields)
+                     for kind in CubeKind}
+        self.state = LoadedSnapshots(version=version, loaded_at=time.time(), snapshots=snapshots)
+        return True
+
+    def get_heatmap(self, kind: CubeKind, version: str, x_field: str, y_field: str, params: BaseModel,
+                    x_bucket: Optional[str] = None, y_bucket: Optional[str] = None) -> Optional[list[HeatmapEntry]]:
+        """Heatmap computed from the snapshot, or None if it is missing, outdated or cannot apply the filters.
+
+        `version` is the current data version, already read by the caller.
+        """
+        state = self.state
+        if not self.enabled or state is None or state.version != version:
+            return None
+
+        import numpy as np
+
+        snapshot = state.snapshots[kind]
+        if not snapshot.has(x_field) or not snapshot.has(y_field):
+            return None
+
+        spec = filter_specs[kind]
+        mask = np.ones(snapshot.size, dtype=bool)
+        for name, value in params.model_dump(exclude_none=True, exclude=ignored_params).items():
+            if name == 'search_query' or name in spec.contains:
+                fields = spec.search_fields if name == 'search_query' else [spec.contains[name]]
+                if not all(snapshot.has(field_name) for field_name in fields):
+                    return None
+                # Пустая строка содержится в любом значении, такой фильтр ничего не отбрасывает
+                if value != "":
+                    snapshot.where_contains(mask, fields, value)
+            elif name in spec.in_filters and snapshot.has(spec.in_filters[name]):
+                snapshot.where_in(mask, spec.in_filters[name], value)
+            elif name in spec.any_in_filters and snapshot.has(spec.any_in_filters[name]):
+                snapshot.where_any_in(mask, spec.any_in_filters[name], value)
+            elif name in spec.range_filters and snapshot.has(spec.range_filters[name][0]):
+                field_name, operator = spec.range_filters[name]
+                snapshot.where_compare(mask, field_name, operator,
+                                       value.isoformat() if hasattr(value, 'isoformat') else value)
+            else:
+                return None
+
+        return [HeatmapEntry(x_label=x, y_label=y, count=count)
+                for x, y, count in snapshot.histogram(x_field, y_field, mask, x_bucket, y_bucket)]
+
+
+analytics_engine = AnalyticsEngine(ANALYTICS_ENGINE)
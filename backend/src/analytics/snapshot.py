@@ -0,0 +1,177 @@
+import math
+from dataclasses import dataclass
+from datetime import date, timedelta
+from typing import Any, Callable, Iterable, Optional
+
+import numpy as np
+
+from repo.bucketing import parse_bucket, format_number
+
+# До этого числа ячеек счётчики считаются плотным массивом, для больших сеток - через сортировку
+DENSE_HISTOGRAM_CELLS = 1 << 22
+
+# Порядок типов при сравнении значений в AQL: null < bool < число < строка < массив < объект
+type_ranks = {type(None): 0, bool: 1, int: 2, float: 2, str: 3, list: 4, dict: 5}
+
+
+def compare_key(value: Any) -> tuple:
+    return (type_ranks.get(type(value), 5), value if value is not None else 0)
+
+
+def to_string(value: Any) -> str:
+    """Python counterpart of AQL TO_STRING for scalar values."""
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return format_number(value)
+    return str(value)
+
+
+def label_function(bucket: Optional[str]) -> Callable[[Any], str]:
+    """Python counterpart of bucketing.bucket_expression; quantiles are applied to the result later."""
+    kind, value = parse_bucket(bucket) if bucket else (None, None)
+
+    def label(item: Any) -> str:
+        if item is None or kind is None or kind == 'quantile':
+            return to_string(item)
+        if kind == 'day':
+            return str(item)[:10]
+        if kind == 'month':
+            return str(item)[:7]
+        if kind == 'week':
+            day = date.fromisoformat(str(item)[:10])
+            return (day - timedelta(days=day.weekday())).isoformat()
+        if kind == 'width':
+            start = math.floor(item / value) * value
+            return f"[{format_number(start)}, {format_number(start + value)})"
+        return to_string(item)
+
+    return label
+
+
+@dataclass
+class Column:
+    """Dictionary-encoded column in CSR layout.
+
+    Entry i belongs to entity owners[i] and holds categories[codes[i]], -1 is null. A scalar
+    column has exactly one entry per entity, a list column one entry per element.
+    """
+    categories: list
+    codes: np.ndarray
+    owners: np.ndarray
+
+    @classmethod
+    def encode(cls, rows: list, is_list: bool) -> 'Column':
+        values = [value for row in rows for value in (row or [])] if is_list else rows
+        index: dict = {}
+        categories = []
+        codes = np.empty(len(values), dtype=np.int32)
+        for i, value in enumerate(values):
+            if value is None or isinstance(value, (list, dict)):
+                codes[i] = -1
+                continue
+            code = index.get((type(value), value))
+            if code is None:
+                code = index[(type(value), value)] = len(categories)
+                categories.append(value)
+            codes[i] = code
+
+        counts = np.array([len(row or []) for row in rows] if is_list else np.ones(len(rows)), dtype=np.int64)
+        owners = np.repeat(np.arange(len(rows)), counts)
+        return cls(categories=categories, codes=codes, owners=owners)
+
+    def category_mask(self, predicate: Callable[[Any], bool]) -> np.ndarray:
+        """Evaluate the predicate once per distinct value; the last element is the result for null."""
+        return np.array([predicate(value) for value in self.categories] + [predicate(None)], dtype=bool)
+
+    def entry_mask(self, predicate: Callable[[Any], bool]) -> np.ndarray:
+        return self.category_mask(predicate)[self.codes]
+
+    def labels(self, bucket: Optional[str]) -> tuple[list[str], np.ndarray]:
+        """Labels of the entries: distinct label strings and the index of each entry's label."""
+        label = label_function(bucket)
+        names: dict[str, int] = {}
+        mapping = np.array([names.setdefault(label(value), len(names)) for value in self.categories + [None]],
+                           dtype=np.int64)
+        return list(names), mapping[self.codes]
+
+
+class Snapshot:
+    """Columns of every heatmap dimension of one kind of entity."""
+
+    def __init__(self, rows: Iterable[dict], list_fields: set[str]):
+        # Запрос измерений возвращает одинаковый набор полей для каждой сущности
+        values: dict[str, list] = {}
+        size = 0
+        for dims in rows:
+            for field, value in dims.items():
+                values.setdefault(field, []).append(value)
+            size += 1
+
+        self.size = size
+        self.columns = {field: Column.encode(column, field in list_fields) for field, column in values.items()}
+
+    def has(self, field: str) -> bool:
+        return field in self.columns
+
+    def where_contains(self, mask: np.ndarray, fields: list[str], text: str):
+        """CONTAINS(LOWER(field), LOWER(text)) for any of the fields."""
+        text = text.lower()
+        found = np.zeros(self.size, dtype=bool)
+        for field in fields:
+            column = self.columns[field]
+            found[column.owners[column.entry_mask(lambda value: text in to_string(value).lower())]] = True
+        mask &= found
+
+    def where_in(self, mask: np.ndarray, field: str, allowed: list):
+        column = self.columns[field]
+        mask &= column.entry_mask(lambda value: value in allowed)
+
+    def where_any_in(self, mask: np.ndarray, field: str, allowed: list):
+        column = self.columns[field]
+        found = np.zeros(self.size, dtype=bool)
+        found[column.owners[column.entry_mask(lambda value: value in allowed)]] = True
+        mask &= found
+
+    def where_compare(self, mask: np.ndarray, field: str, operator: str, bound: Any):
+        column = self.columns[field]
+        key = compare_key(bound)
+        if operator == '>=':
+            mask &= column.entry_mask(lambda value: compare_key(value) >= key)
+        else:
+            mask &= column.entry_mask(lambda value: compare_key(value) <= key)
+
+    def histogram(self, x_field: str, y_field: str, mask: np.ndarray, x_bucket: Optional[str],
+                  y_bucket: Optional[str]) -> list[tuple[str, str, int]]:
+        """Count the entities passing the mask by pairs of axis labels, one pair per combination of list elements."""
+        x_column, y_column = self.columns[x_field], self.columns[y_field]
+        x_names, x_labels = x_column.labels(x_bucket)
+        y_names, y_labels = y_column.labels(y_bucket)
+
+        # Отфильтрованные записи остаются сгруппированными по сущности, как и исходные
+        x_keep = mask[x_column.owners]
+        x_owners, x_labels = x_column.owners[x_keep], x_labels[x_keep]
+        y_keep = mask[y_column.owners]
+        y_labels = y_labels[y_keep]
+        y_counts = np.bincount(y_column.owners[y_keep], minlength=self.size)
+        y_starts = np.cumsum(y_counts) - y_counts
+
+        # Каждая запись по x соединяется со всеми записями по y той же сущности
+        repeats = y_counts[x_owners]
+        total = int(repeats.sum())
+        x_pairs = np.repeat(x_labels, repeats)
+        group_starts = np.repeat(np.cumsum(repeats) - repeats, repeats)
+        y_pairs = y_labels[np.repeat(y_starts[x_owners], repeats) + np.arange(total) - group_starts]
+
+        cells = x_pairs * len(y_names) + y_pairs
+        if len(x_names) * len(y_names) <= DENSE_HISTOGRAM_CELLS:
+            counts = np.bincount(cells, minlength=len(x_names) * len(y_names))
+            cells = np.flatnonzero(counts)
+            counts = counts[cells]
+        else:
+            cells, counts = np.unique(cells, return_counts=True)
+
+        return [(x_names[cell // len(y_names)], y_names[cell % len(y_names)], int(count))
+                for cell, count in zip(cells.tolist(), counts.tolist())]
@@ -9,9 +9,14 @@ from auth.service import get_current_user
 from data.entity import User
 from data.query import GetExtendedUser
 from repo.client import database
+from repo.heatmap_repo import CubeKind
 from repo.log_repo import LogRepo
 from repo.model import CreateUser, CreateLog, LogRelations
+from repo.stat_repo import StatRepo
 from repo.user_repo import UserRepo
+from repo.version_repo import VersionRepo
+from task.heatmap import schedule_refresh
+from task.versions import schedule_bump
 
 router = APIRouter(prefix="/auth", tags=["auth"])
 
@@ -20,7 +25,7 @@ router = APIRouter(prefix="/auth", tags=["auth"])
 async def register(register_user: RegisterUser) -> AuthToken:
     trans = database.begin_transaction(read=['City', 'User', 'lives_in', 'Log', 'Image'],
                                        write=['User', 'lives_in', 'relates_to_user',
-                                              'Log', 'Image', 'user_avatar'])
+                                              'Log', 'Image', 'user_avatar', 'Stats', 'DataVersion'])
     try:
         user_repo = UserRepo(trans)
         log_repo = LogRepo(trans)
@@ -39,6 +44,7 @@ async def register(register_user: RegisterUser) -> AuthToken:
         )
 
         user = user_repo.create(create_user)
+        StatRepo(trans).increment(user_count=1)
 
         if not user_repo.set_city(user.key, register_user.city_id):
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='City not found')
@@ -53,11 +59,14 @@ async def register(register_user: RegisterUser) -> AuthToken:
                 keys=LogRelations(user_key=user.key)
             )
         )
+        VersionRepo(trans).bump_data()
     except Exception as e:
         trans.abort_transaction()
         raise e
     else:
         trans.commit_transaction()
+        schedule_bump(log_repo.versioned)
+        schedule_refresh(CubeKind.USER, [user.key])
     access_token = auth_service.create_access_token(data={"sub": user.login})
     return AuthToken(access_token=access_token, token_type="bearer")
 
@@ -0,0 +1,65 @@
+import hashlib
+import json
+from datetime import UTC
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Optional, Any
+
+from fastapi import Request, Response, status
+from fastapi.encoders import jsonable_encoder
+
+from repo.model import EntityVersion
+
+# Клиент может хранить ответ, но обязан проверять его актуальность при каждом запросе
+CACHE_CONTROL = "no-cache"
+
+
+def make_etag(tag: str) -> str:
+    return f'"{hashlib.sha256(tag.encode()).hexdigest()[:32]}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == '*':
+        return True
+    # Для If-None-Match используется слабое сравнение
+    candidates = [candidate.strip().removeprefix('W/') for candidate in if_none_match.split(',')]
+    return etag in candidates
+
+
+def not_modified_since(if_modified_since: str, version: EntityVersion) -> bool:
+    if version.modified_at is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    return version.modified_at.replace(microsecond=0) <= since
+
+
+def check_version(request: Request, response: Response, version: EntityVersion) -> Optional[Response]:
+    """Set validators on the response and return a 304 response if the client's copy is up to date.
+
+    Called before the heavy query, so an unchanged resource costs only the version lookup.
+    """
+    headers = {"ETag": make_etag(version.tag), "Cache-Control": CACHE_CONTROL}
+    if version.modified_at is not None:
+        headers["Last-Modified"] = format_datetime(version.modified_at.astimezone(UTC), usegmt=True)
+
+    response.headers.update(headers)
+
+    if 'if-none-match' in request.headers:
+        fresh = etag_matches(request.headers['if-none-match'], headers["ETag"])
+    elif 'if-modified-since' in request.headers:
+        fresh = not_modified_since(request.headers['if-modified-since'], version)
+    else:
+        fresh = False
+
+    if fresh:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    return None
+
+
+def check_body(request: Request, response: Response, body: Any) -> Optional[Response]:
+    """Validators for cheap responses without a version: the ETag is a hash of the body."""
+    serialized = json.dumps(jsonable_encoder(body), sort_keys=True, ensure_ascii=False)
+    return check_version(request, response, EntityVersion(tag=serialized))
@@ -1,7 +1,8 @@
 from typing import Annotated
 
-from fastapi import APIRouter, Query, Depends
+from fastapi import APIRouter, Query, Depends, Request, Response
 
+from api.caching import check_body
 from auth.service import get_current_user
 from data.query import GetCitiesParams, CityListResponse
 from repo.city_repo import CityRepo
@@ -11,7 +12,14 @@ router = APIRouter(prefix="/cities", tags=["cities"])
 
 
 @router.get("/")
-async def get_cities(query: Annotated[GetCitiesParams, Query()]) -> CityListResponse:
+async def get_cities(query: Annotated[GetCitiesParams, Query()],
+                     request: Request, response: Response) -> CityListResponse:
     city_repo = CityRepo(database)
     count, page = city_repo.get_page(query)
-    return CityListResponse(contents=page, total_count=count)
+    result = CityListResponse(contents=page, total_count=count)
+
+    # Список городов дешёвый, поэтому ETag считается по телу ответа
+    if (not_modified := check_body(request, response, result)) is not None:
+        return not_modified
+
+    return result
@@ -1,21 +1,30 @@
 from datetime import datetime, UTC
-from typing import Annotated
+from typing import Annotated, Optional
 
 from pydantic import BaseModel
-from fastapi import APIRouter, Query, Depends, HTTPException, status
+from fastapi import APIRouter, Query, Depends, HTTPException, status, Request, Response
 
+from api.caching import check_version
+from api.idempotency import Idempotency, get_idempotency
 from auth.service import get_current_user
 from data.entity import CleanDayStatus, CleanDay, User, CleanDayTag, Comment
 from data.query import GetCleandaysParams, CleandayListResponse, GetCleanday, UserListResponse, GetMembersParams, \
     PaginationParams, CleandayLogListResponse, CommentListResponse, UpdateCleanday, CreateCleanday, CreateImages, \
     ImageListResponse, UpdateParticipation, CreateParticipation, CleandayResults, GetCleandayLogsParams, \
-    GetCommentsParams, CreateComment, GetMembersResponse, RequirementListResponse
-from repo.cleanday_repo import CleandayRepo
+    GetCommentsParams, CreateComment, GetMembersResponse, RequirementListResponse, SortOrder
+from repo.cleanday_repo import CleandayRepo, encode_log_cursor
 from repo.client import database
+from repo.heatmap_repo import CubeKind
 import repo.model as repo_model
 from repo.location_repo import LocationRepo
 from repo.log_repo import LogRepo
 from repo.participation_repo import ParticipationRepo, SetReqResult, CreateResult
+from repo.rollup_repo import RollupRepo
+from repo.stat_repo import StatRepo
+from repo.version_repo import VersionRepo
+from storage.variants import collect_blobs, schedule_variants
+from task.heatmap import schedule_refresh
+from task.versions import schedule_bump
 
 router = APIRouter(prefix="/cleandays", tags=["cleanday"],
                    dependencies=[Depends(get_current_user)])
@@ -31,13 +40,18 @@ async def get_cleandays(query: Annotated[GetCleandaysParams, Query()]) -> Cleand
 
 @router.post("/")
 async def create_cleanday(cleanday: CreateCleanday,
-                          current_user: User = Depends(get_current_user)) -> CleanDay:
+                          current_user: User = Depends(get_current_user),
+                          idempotency: Annotated[Optional[Idempotency], Depends(get_idempotency)] = None) -> CleanDay:
+    if idempotency and (stored := idempotency.replay()):
+        return stored.response
+
     trans = database.begin_transaction(read=['Location', 'CleanDay', 'in_location', 'Participation', 'User',
                                              'has_participation', 'participation_in'],
                                        write=['Location', 'CleanDay', 'in_location', 'Participation',
                                               'has_participation', 'participation_in', 'Requirement',
                                               'has_requirement', 'Log', 'relates_to_user', 'relates_to_cleanday',
-                                              'relates_to_location'])
+                                              'relates_to_location', 'IdempotencyKey', 'Stats',
+                                              'DailyRollup', 'DataVersion'])
     try:
         cleanday_repo = CleandayRepo(trans)
         log_repo = LogRepo(trans)
@@ -48,11 +62,18 @@ async def create_cleanday(cleanday: CreateCleanday,
 
         res = cleanday_repo.create(current_user.key, create_cleanday)
 
+        # Организатор становится участником субботника
+        stat_repo = StatRepo(trans)
+        stat_repo.increment(cleanday_count=1)
+        stat_repo.record_participation(current_user.key)
+
         loc_set = cleanday_repo.set_location(res.key, cleanday.location_id)
 
         if not loc_set:
             raise HTTPException(status_code=404, detail="Location not found")
 
+        RollupRepo(trans).add(res.key, datetime.now(UTC), created=1, participants=1)
+
         log_repo.create(
             repo_model.CreateLog(
                 date=datetime.now(UTC),
@@ -66,17 +87,31 @@ async def create_cleanday(cleanday: CreateCleanday,
             )
         )
 
+        if idempotency:
+            idempotency.record(trans, res)
+
+        VersionRepo(trans).bump_data()
+
     except Exception as e:
         trans.abort_transaction()
         raise e
     else:
         trans.commit_transaction()
+        schedule_bump(log_repo.versioned)
+        schedule_refresh(CubeKind.CLEANDAY, [res.key])
+        schedule_refresh(CubeKind.USER, [current_user.key])
 
     return res
 
 
 @router.get("/{cleanday_id}")
-async def get_cleanday(cleanday_id: str) -> GetCleanday:
+async def get_cleanday(cleanday_id: str, request: Request, response: Response) -> GetCleanday:
+    version = static_cleanday_repo.get_version(cleanday_id)
+    if version is None:
+        raise HTTPException(status_code=404, detail="Cleanday not found")
+    if (not_modified := check_version(request, response, version)) is not None:
+        return not_modified
+
     cleanday = static_cleanday_repo.get_by_key(cleanday_id)
     if not cleanday:
         raise HTTPException(status_code=404, detail="Cleanday not found")
@@ -90,7 +125,8 @@ async def update_cleanday(cleanday_id: str, cleanday: UpdateCleanday,
     trans = database.begin_transaction(read=['CleanDay', 'in_location', 'Location', 'Participation', 'User',
                                              'has_participation', 'participation_in', 'Requirement', 'has_requirement'],
                                        write=['in_location', 'CleanDay', 'Log', 'relates_to_cleanday',
-                                              'relates_to_location', 'Requirement', 'has_requirement'])
+                                              'relates_to_location', 'Requirement', 'has_requirement', 'fullfills',
+                                              'DataVersion'])
     try:
         cleanday_repo = CleandayRepo(trans)
         log_repo = LogRepo(trans)
@@ -102,6 +138,13 @@ async def update_cleanday(cleanday_id: str, cleanday: UpdateCleanday,
         if cleanday_obj.organizer_key != current_user.key:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Insufficient permissions")
 
+        # Завершение меняет счётчики Stats и DailyRollup, поэтому идёт только через /end (UpdateCleanDayStatus
+        # не содержит статуса "Завершен"); по той же причине у завершённого субботника не меняются статус и площадь
+        if cleanday_obj.status == CleanDayStatus.ENDED and \
+                (cleanday.status is not None or cleanday.area is not None):
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                                detail="Status and area of an ended cleanday cannot be changed")
+
         cleanday_dict = cleanday.model_dump(exclude_none=True)
         cleanday_update = repo_model.UpdateCleanday.model_validate(cleanday_dict)
 
@@ -109,20 +152,9 @@ async def update_cleanday(cleanday_id: str, cleanday: UpdateCleanday,
         
         # Обработка требований
         if cleanday.requirements is not None:
-            # Получаем текущие требования
-            existing_reqs = cleanday_repo.get_raw_requirements(cleanday_id)
-            existing_req_names = {req.name for req in existing_reqs} if existing_reqs else set()
-            new_req_names = set(cleanday.requirements)
-            
-            # Добавляем новые требования
-            for req_name in new_req_names - existing_req_names:
-                cleanday_repo.create_requirement(cleanday_id, req_name)
-            
-            # Удаляем требования, которых больше нет
-            for req in existing_reqs:
-                if req.name not in new_req_names:
-                    cleanday_repo.delete_requirement(cleanday_id, req.key)
-            
+            # Приводим требования к новому списку одним запросом
+            cleanday_repo.sync_requirements(cleanday_id, cleanday.requirements)
+
             # Записываем в лог обновление требований
             log_repo.create(
                 repo_model.CreateLog(
@@ -146,17 +178,27 @@ async def update_cleanday(cleanday_id: str, cleanday: UpdateCleanday,
             )
         )
 
+        VersionRepo(trans).bump_data()
+
     except Exception as e:
         trans.abort_transaction()
         raise e
     else:
         trans.commit_transaction()
+        schedule_bump(log_repo.versioned)
+        schedule_refresh(CubeKind.CLEANDAY, [cleanday_id])
 
     return static_cleanday_repo.get_by_key(cleanday_id)
 
 
 @router.get("/{cleanday_id}/images")
-async def get_cleanday_images(cleanday_id: str) -> ImageListResponse:
+async def get_cleanday_images(cleanday_id: str, request: Request, response: Response) -> ImageListResponse:
+    version = static_cleanday_repo.get_version(cleanday_id)
+    if version is None:
+        raise HTTPException(status_code=404, detail="Cleanday not found")
+    if (not_modified := check_version(request, response, version)) is not None:
+        return not_modified
+
     images = static_cleanday_repo.get_images(cleanday_id)
     if images is None:
         raise HTTPException(status_code=404, detail="Cleanday not found")
@@ -165,7 +207,14 @@ async def get_cleanday_images(cleanday_id: str) -> ImageListResponse:
 
 
 @router.get("/{cleanday_id}/members")
-async def get_cleanday_members(cleanday_id: str, query: Annotated[GetMembersParams, Query()]) -> GetMembersResponse:
+async def get_cleanday_members(cleanday_id: str, query: Annotated[GetMembersParams, Query()],
+                               request: Request, response: Response) -> GetMembersResponse:
+    version = static_cleanday_repo.get_members_version(cleanday_id)
+    if version is None:
+        raise HTTPException(status_code=404, detail="Cleanday not found")
+    if (not_modified := check_version(request, response, version)) is not None:
+        return not_modified
+
     page_res = static_cleanday_repo.get_members(cleanday_id, query)
     if page_res is None:
         raise HTTPException(status_code=404, detail="Cleanday not found")
@@ -174,16 +223,46 @@ async def get_cleanday_members(cleanday_id: str, query: Annotated[GetMembersPara
 
 
 @router.get("/{cleanday_id}/logs")
-async def get_cleanday_logs(cleanday_id: str, query: Annotated[GetCleandayLogsParams, Query()]) -> CleandayLogListResponse:
-    page_res = static_cleanday_repo.get_logs(cleanday_id, query)
+async def get_cleanday_logs(cleanday_id: str, query: Annotated[GetCleandayLogsParams, Query()],
+                            request: Request, response: Response) -> CleandayLogListResponse:
+    version = static_cleanday_repo.get_version(cleanday_id)
+    if version is None:
+        raise HTTPException(status_code=404, detail="Cleanday not found")
+    if (not_modified := check_version(request, response, version)) is not None:
+        return not_modified
+
+    if query.before is not None and query.after is not None:
+        raise HTTPException(status_code=400, detail="Only one of before and after can be set")
+
+    try:
+        page_res = static_cleanday_repo.get_logs(cleanday_id, query)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     if page_res is None:
         raise HTTPException(status_code=404, detail="Cleanday not found")
     count, page = page_res
-    return CleandayLogListResponse(logs=page, total_count=count)
+
+    if not page:
+        return CleandayLogListResponse(logs=page, total_count=count)
+
+    oldest, newest = (page[0], page[-1]) if query.sort_order == SortOrder.ASC else (page[-1], page[0])
+    return CleandayLogListResponse(
+        logs=page,
+        total_count=count,
+        oldest_cursor=encode_log_cursor(oldest.date, oldest.key),
+        newest_cursor=encode_log_cursor(newest.date, newest.key)
+    )
 
 
 @router.get("/{cleanday_id}/comments")
-async def get_cleanday_comments(cleanday_id: str, query: Annotated[GetCommentsParams, Query()]) -> CommentListResponse:
+async def get_cleanday_comments(cleanday_id: str, query: Annotated[GetCommentsParams, Query()],
+                                request: Request, response: Response) -> CommentListResponse:
+    version = static_cleanday_repo.get_comments_version(cleanday_id)
+    if version is None:
+        raise HTTPException(status_code=404, detail="Cleanday not found")
+    if (not_modified := check_version(request, response, version)) is not None:
+        return not_modified
+
     page_res = static_cleanday_repo.get_comments(cleanday_id, query)
     if page_res is None:
         raise HTTPException(status_code=404, detail="Cleanday not found")
@@ -193,7 +272,12 @@ async def get_cleanday_comments(cleanday_id: str, query: Annotated[GetCommentsPa
 
 @router.post("/{cleanday_id}/comments")
 async def create_cleanday_comment(cleanday_id: str, create_comment: CreateComment,
-                                  current_user: User = Depends(get_current_user)) -> Comment:
+                                  current_user: User = Depends(get_current_user),
+                                  idempotency: Annotated[Optional[Idempotency], Depends(get_idempotency)] = None) \
+        -> Comment:
+    if idempotency and (stored := idempotency.replay()):
+        return stored.response
+
     if static_cleanday_repo.get_raw_by_key(cleanday_id) is None:
         raise HTTPException(status_code=404, detail="Cleanday not found")
 
@@ -202,7 +286,7 @@ async def create_cleanday_comment(cleanday_id: str, create_comment: CreateCommen
     trans = database.begin_transaction(
         read=['Participation', 'participation_in', 'has_participation'],
         write=['Comment', 'has_comment', 'authored', 'Log', 'relates_to_user', 'relates_to_cleanday',
-               'relates_to_comment']
+               'relates_to_comment', 'IdempotencyKey']
     )
     try:
         par_repo = ParticipationRepo(trans)
@@ -231,18 +315,26 @@ async def create_cleanday_comment(cleanday_id: str, create_comment: CreateCommen
                 )
             )
         )
+
+        if idempotency:
+            idempotency.record(trans, comm)
     except Exception as e:
         trans.abort_transaction()
         raise e
     else:
         trans.commit_transaction()
+        schedule_bump(log_repo.versioned)
 
     return comm
 
 
 @router.post("/{cleanday_id}/members")
 async def join_cleanday(cleanday_id: str, participation: CreateParticipation,
-                        current_user: User = Depends(get_current_user)):
+                        current_user: User = Depends(get_current_user),
+                        idempotency: Annotated[Optional[Idempotency], Depends(get_idempotency)] = None):
+    if idempotency and idempotency.replay():
+        return
+
     cleanday = static_cleanday_repo.get_raw_by_key(cleanday_id)
     if cleanday is None:
         raise HTTPException(status_code=404, detail="Cleanday not found")
@@ -250,7 +342,8 @@ async def join_cleanday(cleanday_id: str, participation: CreateParticipation,
     trans = database.begin_transaction(
         read=['Participation', 'participation_in', 'has_participation'],
         write=['Participation', 'fullfills', 'Log', 'relates_to_user', 'relates_to_cleanday',
-               'has_participation', 'participation_in']
+               'has_participation', 'participation_in', 'IdempotencyKey', 'Stats',
+               'DailyRollup', 'DataVersion']
     )
     try:
         par_repo = ParticipationRepo(trans)
@@ -261,6 +354,9 @@ async def join_cleanday(cleanday_id: str, participation: CreateParticipation,
         if res == CreateResult.PARTICIPATION_ALREADY_EXISTS:
             raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Participation already exists")
 
+        StatRepo(trans).record_participation(current_user.key)
+        RollupRepo(trans).add(cleanday_id, datetime.now(UTC), participants=1)
+
         log_repo.create(
             repo_model.CreateLog(
                 date=datetime.now(UTC),
@@ -273,12 +369,19 @@ async def join_cleanday(cleanday_id: str, participation: CreateParticipation,
             )
         )
 
+        if idempotency:
+            idempotency.record(trans, None)
+
+        VersionRepo(trans).bump_data()
 
     except Exception as e:
         trans.abort_transaction()
         raise e
     else:
         trans.commit_transaction()
+        schedule_bump(log_repo.versioned)
+        schedule_refresh(CubeKind.CLEANDAY, [cleanday_id])
+        schedule_refresh(CubeKind.USER, [current_user.key])
 
     return
 
@@ -296,7 +399,7 @@ async def update_participation(cleanday_id: str, participation: UpdateParticipat
 
     trans = database.begin_transaction(
         read=['Participation', 'participation_in', 'has_participation'],
-        write=['Participation', 'fullfills', 'Log', 'relates_to_user', 'relates_to_cleanday']
+        write=['Participation', 'fullfills', 'Log', 'relates_to_user', 'relates_to_cleanday', 'DataVersion']
     )
     try:
         par_repo = ParticipationRepo(trans)
@@ -339,11 +442,15 @@ async def update_participation(cleanday_id: str, participation: UpdateParticipat
                 )
             )
 
+        VersionRepo(trans).bump_data()
+
     except Exception as e:
         trans.abort_transaction()
         raise e
     else:
         trans.commit_transaction()
+        schedule_bump(log_repo.versioned)
+        schedule_refresh(CubeKind.USER, [current_user.key])
 
     return
 
@@ -361,52 +468,74 @@ async def end_cleanday(cleanday_id: str, results: CleandayResults,
     if cleanday.status == CleanDayStatus.ENDED:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Cleanday already ended")
 
-    trans = database.begin_transaction(
-        read=['Participation', 'participation_in', 'has_participation', 'CleanDay'],
-        write=['Participation', 'Log', 'CleanDay', 'relates_to_cleanday', 'Image', 'cleanday_image']
-    )
-    try:
-        cleanday_repo = CleandayRepo(trans)
-        log_repo = LogRepo(trans)
-
-        participation_repo = ParticipationRepo(trans)
-
-        cleanday_repo.update(cleanday_id,
-                             repo_model.UpdateCleanday(results=results.results,
-                                                       status=CleanDayStatus.ENDED))
-
-        for user_key in results.participated_user_keys:
-            participation_repo.update(
-                user_key, cleanday_id,
-                repo_model.UpdateParticipation(real_presence=True, stat=cleanday.area)
-            )
+    with collect_blobs() as saved_blobs:
+        trans = database.begin_transaction(
+            read=['Participation', 'participation_in', 'has_participation', 'CleanDay'],
+            write=['Participation', 'Log', 'CleanDay', 'relates_to_cleanday', 'Image', 'cleanday_image', 'Stats',
+                   'DailyRollup', 'DataVersion']
+        )
+        try:
+            cleanday_repo = CleandayRepo(trans)
+            log_repo = LogRepo(trans)
+
+            participation_repo = ParticipationRepo(trans)
+
+            cleanday_repo.update(cleanday_id,
+                                 repo_model.UpdateCleanday(results=results.results,
+                                                           status=CleanDayStatus.ENDED),
+                                 touch=False)
+            StatRepo(trans).increment(past_cleanday_count=1, cleanday_metric=cleanday.area)
+            RollupRepo(trans).add(cleanday_id, datetime.now(UTC), completed=1, area=cleanday.area)
+
+            for user_key in results.participated_user_keys:
+                participation_repo.update(
+                    user_key, cleanday_id,
+                    repo_model.UpdateParticipation(real_presence=True, stat=cleanday.area)
+                )
 
-        cleanday_repo.create_images(cleanday_id, results.images)
+            try:
+                cleanday_repo.create_images(cleanday_id, results.images)
+            except ValueError:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid image data")
 
-        log_repo.create(
-            repo_model.CreateLog(
-                date=datetime.now(UTC),
-                type='EndCleanday',
-                description=f'Субботник завершён',
-                keys=repo_model.LogRelations(
-                    cleanday_key=cleanday_id
+            log_repo.create(
+                repo_model.CreateLog(
+                    date=datetime.now(UTC),
+                    type='EndCleanday',
+                    description=f'Субботник завершён',
+                    keys=repo_model.LogRelations(
+                        cleanday_key=cleanday_id
+                    )
                 )
             )
-        )
 
-    except Exception as e:
-        trans.abort_transaction()
-        raise e
-    else:
-        trans.commit_transaction()
+            VersionRepo(trans).bump_data()
+
+        except Exception as e:
+            trans.abort_transaction()
+            raise e
+        else:
+            trans.commit_transaction()
+            schedule_bump(log_repo.versioned)
+            # Статистика участников изменилась без записи в их лог
+            schedule_bump({'User': set(results.participated_user_keys)})
+            schedule_refresh(CubeKind.CLEANDAY, [cleanday_id])
+            schedule_refresh(CubeKind.USER, results.participated_user_keys)
+            schedule_variants(*saved_blobs)
     return
 
 
 @router.get("/{cleanday_id}/requirements")
-async def get_cleanday_requirements(cleanday_id: str) -> RequirementListResponse:
+async def get_cleanday_requirements(cleanday_id: str, request: Request, response: Response) -> RequirementListResponse:
     """
     Получение списка требований для конкретного субботника
     """
+    version = static_cleanday_repo.get_version(cleanday_id)
+    if version is None:
+        raise HTTPException(status_code=404, detail="Cleanday not found")
+    if (not_modified := check_version(request, response, version)) is not None:
+        return not_modified
+
     requirements = static_cleanday_repo.get_raw_requirements(cleanday_id)
     if requirements is None:
         raise HTTPException(status_code=404, detail="Cleanday not found")
@@ -0,0 +1,35 @@
+from typing import Annotated
+
+from fastapi import APIRouter, Query, Depends, HTTPException
+
+from auth.service import get_current_user
+from data.query import GetFeedParams, FeedResponse
+from repo.cleanday_repo import encode_log_cursor
+from repo.client import database
+from repo.feed_repo import FeedRepo
+from repo.result_cache import feed_cache, cache_key
+
+router = APIRouter(prefix="/feed", tags=["feed"],
+                   dependencies=[Depends(get_current_user)])
+
+static_feed_repo = FeedRepo(database)
+
+
+@router.get("/")
+async def get_feed(query: Annotated[GetFeedParams, Query()]) -> FeedResponse:
+    """
+    Последние события по всем субботникам, с фильтрами по городу, тегам и подпискам
+    """
+    try:
+        # Первые страницы одинаковы у всех жителей города, поэтому ненадолго кэшируются;
+        # limit не входит в общий ключ кэша, но здесь меняет результат
+        if query.before is None:
+            page, has_more = await feed_cache.get(cache_key(f"feed:{query.limit}", query),
+                                                  lambda: static_feed_repo.get_page(query))
+        else:
+            page, has_more = static_feed_repo.get_page(query)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    next_cursor = encode_log_cursor(page[-1].date, page[-1].key) if has_more else None
+    return FeedResponse(logs=page, next_cursor=next_cursor)
@@ -0,0 +1,60 @@
+import hashlib
+from typing import Annotated, Optional, Any
+
+from arango.database import StandardDatabase
+from arango.exceptions import AQLQueryExecuteError
+from fastapi import Request, Header, Depends, HTTPException, status
+from fastapi.encoders import jsonable_encoder
+
+from auth.service import get_current_user
+from config.environment import IDEMPOTENCY_KEY_TTL
+from data.entity import User
+from repo.client import database
+from repo.idempotency_repo import IdempotencyRepo
+from repo.model import IdempotentResponse
+
+# Коды ArangoDB для конфликта записи и нарушения уникальности ключа
+CONFLICT_ERROR_CODES = {1200, 1210}
+
+static_idempotency_repo = IdempotencyRepo(database)
+
+
+class Idempotency:
+    def __init__(self, key: str, request_hash: str):
+        self.key = key
+        self.request_hash = request_hash
+
+    def replay(self) -> Optional[IdempotentResponse]:
+        stored = static_idempotency_repo.get(self.key)
+        if stored is None:
+            return None
+
+        if stored.request_hash != self.request_hash:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                                detail="Idempotency-Key has already been used with a different request")
+
+        return stored
+
+    def record(self, trans: StandardDatabase, response: Any) -> None:
+        """Save the response inside the write transaction, so it is committed together with the result."""
+        try:
+            IdempotencyRepo(trans).create(self.key, self.request_hash, jsonable_encoder(response),
+                                          IDEMPOTENCY_KEY_TTL)
+        except AQLQueryExecuteError as e:
+            if e.error_code in CONFLICT_ERROR_CODES:
+                raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                                    detail="Request with this Idempotency-Key is already being processed")
+            raise e
+
+
+async def get_idempotency(request: Request,
+                          idempotency_key: Annotated[Optional[str], Header(alias="Idempotency-Key")] = None,
+                          current_user: User = Depends(get_current_user)) -> Optional[Idempotency]:
+    if idempotency_key is None:
+        return None
+
+    scope = f"{current_user.key}:{request.method}:{request.url.path}:{idempotency_key}"
+    key = hashlib.sha256(scope.encode()).hexdigest()
+    request_hash = hashlib.sha256(await request.body()).hexdigest()
+
+    return Idempotency(key, request_hash)
@@ -0,0 +1,101 @@
+import re
+from typing import Optional, Tuple, Annotated
+
+from fastapi import APIRouter, HTTPException, Request, status, Query
+from fastapi.responses import StreamingResponse, Response
+
+from api.caching import etag_matches
+from repo.client import database
+from repo.image_repo import ImageRepo
+from storage.blob_store import get_blob_store, is_valid_hash
+
+# Блобы адресуются SHA-256 от содержимого, поэтому ссылка на изображение сама по себе
+# служит пропуском: роутер открыт, чтобы изображения можно было подставлять в <img src>
+router = APIRouter(prefix="/images", tags=["images"])
+
+static_image_repo = ImageRepo(database)
+
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parse_range(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single-range `Range` header into inclusive byte offsets.
+
+    Returns None when the header should be ignored (unsupported syntax or several ranges),
+    raises HTTPException 416 when the range cannot be satisfied.
+    """
+    match = RANGE_PATTERN.match(range_header.strip())
+    if not match:
+        return None
+
+    start, end = match.groups()
+    if start == '' and end == '':
+        return None
+
+    if start == '':
+        # Суффикс: последние N байт
+        length = int(end)
+        if length == 0:
+            raise HTTPException(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                                headers={"Content-Range": f"bytes */{size}"})
+        return max(size - length, 0), size - 1
+
+    start = int(start)
+    end = size - 1 if end == '' else min(int(end), size - 1)
+    if start >= size or start > end:
+        raise HTTPException(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                            headers={"Content-Range": f"bytes */{size}"})
+
+    return start, end
+
+
+@router.get("/{blob_hash}")
+async def get_image(blob_hash: str, request: Request,
+                    size: Annotated[Optional[int], Query(gt=0)] = None) -> Response:
+    """
+    Получение изображения; с параметром size отдаётся ближайшая уменьшенная копия не меньше size пикселей
+    """
+    if not is_valid_hash(blob_hash):
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    cache_control = "public, max-age=31536000, immutable"
+    variant = static_image_repo.get_variant(blob_hash, size) if size is not None else None
+    if variant is not None:
+        blob_hash, content_type = variant['hash'], variant['content_type']
+    else:
+        content_type = static_image_repo.get_content_type(blob_hash) or "application/octet-stream"
+        if size is not None:
+            # Копия может быть ещё не готова, поэтому оригинал вместо неё кэшируем ненадолго
+            cache_control = "public, max-age=60"
+
+    blob_size = get_blob_store().size(blob_hash)
+    if blob_size is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": f'"{blob_hash}"',
+        "Cache-Control": cache_control
+    }
+
+    if etag_matches(request.headers.get('if-none-match', ''), headers["ETag"]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    byte_range = None
+    if 'range' in request.headers and blob_size > 0:
+        byte_range = parse_range(request.headers['range'], blob_size)
+
+    if byte_range is None:
+        if blob_size == 0:
+            return Response(content=b'', media_type=content_type, headers=headers)
+        headers["Content-Length"] = str(blob_size)
+        return StreamingResponse(get_blob_store().read_range(blob_hash, 0, blob_size - 1),
+                                 media_type=content_type, headers=headers)
+
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{blob_size}"
+    headers["Content-Length"] = str(end - start + 1)
+
+    return StreamingResponse(get_blob_store().read_range(blob_hash, start, end),
+                             status_code=status.HTTP_206_PARTIAL_CONTENT,
+                             media_type=content_type, headers=headers)
@@ -1,7 +1,9 @@
-from typing import Annotated
+from typing import Annotated, Optional
 
-from fastapi import APIRouter, Query, Depends, HTTPException
+from fastapi import APIRouter, Query, Depends, HTTPException, Request, Response
 
+from api.caching import check_version
+from api.idempotency import Idempotency, get_idempotency
 from auth.service import get_current_user
 from data.entity import Location, City
 from data.query import CreateLocation, GetLocationsParams, LocationListResponse, CreateImages, ImageListResponse, \
@@ -9,6 +11,7 @@ from data.query import CreateLocation, GetLocationsParams, LocationListResponse,
 from repo.city_repo import CityRepo
 from repo.client import database
 from repo.location_repo import LocationRepo
+from storage.variants import collect_blobs, schedule_variants
 
 router = APIRouter(prefix="/locations", tags=["location"],
                    dependencies=[Depends(get_current_user)])
@@ -17,8 +20,13 @@ static_loc_repo = LocationRepo(database)
 
 
 @router.post("/")
-async def create_location(location: CreateLocation) -> GetLocation:
-    trans = database.begin_transaction(read=['City', 'Location'], write=['in_city', 'Location'])
+async def create_location(location: CreateLocation,
+                          idempotency: Annotated[Optional[Idempotency], Depends(get_idempotency)] = None) \
+        -> GetLocation:
+    if idempotency and (stored := idempotency.replay()):
+        return stored.response
+
+    trans = database.begin_transaction(read=['City', 'Location'], write=['in_city', 'Location', 'IdempotencyKey'])
 
     try:
         loc_repo = LocationRepo(trans)
@@ -30,6 +38,9 @@ async def create_location(location: CreateLocation) -> GetLocation:
         res = loc_repo.create(location)
         key = res.key
 
+        if idempotency:
+            idempotency.record(trans, loc_repo.get_by_key(key))
+
     except Exception as e:
         trans.abort_transaction()
         raise e
@@ -46,7 +57,13 @@ async def get_locations(query: Annotated[GetLocationsParams, Query()]) -> Locati
 
 
 @router.get("/{loc_key}")
-async def get_location(loc_key: str) -> GetLocation:
+async def get_location(loc_key: str, request: Request, response: Response) -> GetLocation:
+    version = static_loc_repo.get_version(loc_key)
+    if version is None:
+        raise HTTPException(status_code=404, detail="Location not found")
+    if (not_modified := check_version(request, response, version)) is not None:
+        return not_modified
+
     loc = static_loc_repo.get_by_key(loc_key)
     if not loc:
         raise HTTPException(status_code=404, detail="Location not found")
@@ -55,25 +72,37 @@ async def get_location(loc_key: str) -> GetLocation:
 
 @router.post("/{loc_key}/images")
 async def create_location_images(loc_key: str, images: CreateImages) -> int:
-    trans = database.begin_transaction(read=['Image', 'Location'], write=['location_image', 'Location', 'Image'])
-
-    try:
-        loc_repo = LocationRepo(trans)
-        res = loc_repo.create_images(loc_key, images.images)
-        if not res:
-            raise HTTPException(status_code=404, detail="Location not found")
-
-    except Exception as e:
-        trans.abort_transaction()
-        raise e
-    else:
-        trans.commit_transaction()
+    with collect_blobs() as saved_blobs:
+        trans = database.begin_transaction(read=['Image', 'Location'],
+                                           write=['location_image', 'Location', 'Image'])
+
+        try:
+            loc_repo = LocationRepo(trans)
+            try:
+                res = loc_repo.create_images(loc_key, images.images)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Invalid image data")
+            if not res:
+                raise HTTPException(status_code=404, detail="Location not found")
+
+        except Exception as e:
+            trans.abort_transaction()
+            raise e
+        else:
+            trans.commit_transaction()
+            schedule_variants(*saved_blobs)
 
     return res
 
 
 @router.get("/{loc_key}/images")
-async def get_location_images(loc_key: str) -> ImageListResponse:
+async def get_location_images(loc_key: str, request: Request, response: Response) -> ImageListResponse:
+    version = static_loc_repo.get_version(loc_key)
+    if version is None:
+        raise HTTPException(status_code=404, detail="Location not found")
+    if (not_modified := check_version(request, response, version)) is not None:
+        return not_modified
+
     images = static_loc_repo.get_images(loc_key)
     if images is None:
         raise HTTPException(status_code=404, detail="Location not found")
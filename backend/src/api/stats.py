@@ -1,54 +1,129 @@
+import asyncio
 import os
-import subprocess
 import tempfile
-import zipfile
-from typing import Annotated
+from typing import Annotated, Optional, Callable
 
-from fastapi import APIRouter, UploadFile, File, Depends, HTTPException, Query
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
+from fastapi.responses import StreamingResponse, FileResponse
+from python_multipart.multipart import MultipartParser, parse_options_header
 
+from analytics.engine import analytics_engine
 from api.cleanday import static_cleanday_repo
 from api.user import static_user_repo
 from auth.service import get_current_user
-from config.environment import ARANGO_ROOT_PASSWORD, DATABASE_NAME
-from data.query import UserHeatmapQuery, HeatmapResponse, CleandayHeatmapQuery
+from backup.archive import stream_zipped_dump, restore_dump
+from backup.extract import extract_archive
+from backup.columnar import stream_dataset, has_pyarrow, media_types
+from backup.incremental import stream_changes, apply_changes, tick_for_date, WalRangeError
+from backup.model import Job, JobType, JobStatus, AnalyticsFormat
+from backup.service import job_manager
+from config.environment import DATABASE_NAME, IMPORT_MAX_UPLOAD_SIZE
+from data.query import UserHeatmapQuery, HeatmapResponse, CleandayHeatmapQuery, IncrementalExportParams, \
+    AnalyticsExportParams, TimeseriesParams, TimeseriesResponse, cleanday_date_fields, cleanday_numeric_fields, \
+    user_numeric_fields, CleandayHeatmapBatchQuery, HeatmapBatchResponse, HeatmapGrid, HeatmapEntry
+from repo.bucketing import parse_bucket, DATE_BUCKETS, apply_quantiles
 from repo.client import database
+from repo.heatmap_repo import CubeKind
 from repo.model import RepoStats
+from repo.result_cache import result_cache, cache_key, invalidate_results
+from repo.rollup_repo import RollupRepo
 from repo.stat_repo import StatRepo
 
 
-def dump_and_zip_arango_db(db_name: str,
-                           username: str = "root",
-                           password: str = ARANGO_ROOT_PASSWORD,
-                           endpoint: str = "tcp://db:8529"):
-    # Use TemporaryDirectory for dump folder (auto cleanup)
-    with tempfile.TemporaryDirectory() as dump_dir:
-        # Run arangodump
-        result = subprocess.run([
-            "arangodump",
-            "--server.endpoint", endpoint,
-            "--server.username", username,
-            "--server.password", password,
-            "--server.database", db_name,
-            "--output-directory", dump_dir,
-            "--overwrite", "true"
-        ], capture_output=True, text=True)
-
-        if result.returncode != 0:
-            raise RuntimeError(f"arangodump failed: {result.stderr}")
-
-        # Create a temp file for the zip archive
-        fd, zip_path = tempfile.mkstemp(suffix=".zip")
-        os.close(fd)  # Close the low-level file descriptor
-
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for root, _, files in os.walk(dump_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, dump_dir)
-                    zipf.write(file_path, arcname)
-
-        return zip_path  # Return path of zip file (dump_dir is already cleaned)
+# Заголовки multipart и поля кроме файла: запас к IMPORT_MAX_UPLOAD_SIZE при проверке Content-Length
+MULTIPART_OVERHEAD = 64 * 1024
+
+# Описание тела запроса в OpenAPI: файл читается из потока запроса, а не через File(...)
+upload_body = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "properties": {"file": {"type": "string", "format": "binary"}},
+                    "required": ["file"]
+                }
+            }
+        }
+    }
+}
+
+
+async def save_upload(request: Request, path: str, extension: str = ".zip"):
+    """Stream the `file` field of a multipart request to disk, enforcing IMPORT_MAX_UPLOAD_SIZE.
+
+    The body is parsed while it arrives, so an oversized upload is rejected before it is
+    stored anywhere, and the file is written once, straight to `path`.
+    """
+    too_large = HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                              detail=f"Archive is larger than {IMPORT_MAX_UPLOAD_SIZE} bytes")
+
+    content_length = request.headers.get("content-length")
+    if content_length is not None and content_length.isdigit() \
+            and int(content_length) > IMPORT_MAX_UPLOAD_SIZE + MULTIPART_OVERHEAD:
+        raise too_large
+
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in options:
+        raise HTTPException(status_code=400, detail="Expected a multipart/form-data request")
+
+    header_field = bytearray()
+    header_value = bytearray()
+    headers = {}
+    part = {"is_file": False, "found": False, "size": 0, "pending": []}
+
+    def on_part_begin():
+        headers.clear()
+        part["is_file"] = False
+
+    def on_header_field(data: bytes, start: int, end: int):
+        header_field.extend(data[start:end])
+
+    def on_header_value(data: bytes, start: int, end: int):
+        header_value.extend(data[start:end])
+
+    def on_header_end():
+        headers[bytes(header_field).lower()] = bytes(header_value)
+        header_field.clear()
+        header_value.clear()
+
+    def on_headers_finished():
+        _, disposition = parse_options_header(headers.get(b"content-disposition", b""))
+        if disposition.get(b"name") != b"file":
+            return
+        filename = disposition.get(b"filename", b"").decode(errors="replace")
+        if not filename.endswith(extension):
+            raise HTTPException(status_code=400, detail=f"Only {extension} files are supported")
+        part["is_file"] = part["found"] = True
+
+    def on_part_data(data: bytes, start: int, end: int):
+        if not part["is_file"]:
+            return
+        part["size"] += end - start
+        if part["size"] > IMPORT_MAX_UPLOAD_SIZE:
+            raise too_large
+        part["pending"].append(data[start:end])
+
+    parser = MultipartParser(options[b"boundary"], {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+    })
+
+    with open(path, "wb") as f:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            if part["pending"]:
+                await asyncio.to_thread(f.writelines, part["pending"])
+                part["pending"] = []
+        parser.finalize()
+
+    if not part["found"]:
+        raise HTTPException(status_code=400, detail="The file field is required")
 
 
 router = APIRouter(prefix="/stats", tags=["stats"],
@@ -56,60 +131,50 @@ router = APIRouter(prefix="/stats", tags=["stats"],
 
 
 static_stats_repo = StatRepo(database)
+static_rollup_repo = RollupRepo(database)
 
 
 @router.get("/")
 async def get_stats() -> RepoStats:
-    return static_stats_repo.get_stats()
+    return await result_cache.get(cache_key("stats"), static_stats_repo.get_stats)
 
 
-@router.post("/import")
-async def import_db(
-    file: UploadFile = File(...)
-):
-    # Only allow zip files (optional check)
-    if not file.filename.endswith(".zip"):
-        raise HTTPException(status_code=400, detail="Only zip files are supported")
+@router.get("/timeseries")
+async def get_timeseries(query: Annotated[TimeseriesParams, Query()]) -> TimeseriesResponse:
+    """
+    Число созданных и завершённых субботников, участников и убранная площадь по дням, неделям или месяцам
+    """
+    if query.date_from > query.date_to:
+        raise HTTPException(status_code=400, detail="date_from must not be after date_to")
 
-    # Create temp files/dirs
+    return TimeseriesResponse(data=static_rollup_repo.get_timeseries(query))
+
+
+@router.post("/import", openapi_extra=upload_body)
+async def import_db(request: Request):
     fd, tmp_zip_path = tempfile.mkstemp(suffix=".zip")
-    os.close(fd)  # Close low-level fd
+    os.close(fd)
 
     try:
-        # Save uploaded zip file to temp location
-        with open(tmp_zip_path, "wb") as f:
-            content = await file.read()
-            f.write(content)
+        await save_upload(request, tmp_zip_path)
 
-        # Extract zip to temp directory
         with tempfile.TemporaryDirectory() as extract_dir:
-            # Validate zip file
             try:
-                with zipfile.ZipFile(tmp_zip_path, 'r') as zip_ref:
-                    zip_ref.extractall(extract_dir)
-            except zipfile.BadZipFile:
-                raise HTTPException(status_code=400, detail="Invalid zip file format")
-
-            # Run arangorestore
-            result = subprocess.run([
-                "arangorestore",
-                "--server.endpoint", "tcp://db:8529",
-                "--server.username", "root",
-                "--server.password", ARANGO_ROOT_PASSWORD,
-                "--input-directory", extract_dir,
-                "--server.database", DATABASE_NAME,
-                "--overwrite", "true"
-            ], capture_output=True, text=True)
-
-            print(result.stdout)
-
-            if result.returncode != 0:
-                raise HTTPException(status_code=500, detail=f"Database restore failed: {result.stderr}")
+                await asyncio.to_thread(extract_archive, tmp_zip_path, extract_dir)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+
+            try:
+                await restore_dump(DATABASE_NAME, extract_dir)
+                await asyncio.to_thread(invalidate_results)
+            except RuntimeError as e:
+                raise HTTPException(status_code=500, detail=f"Database restore failed: {str(e)}")
 
         return {"message": "Database restored successfully"}
 
+    except HTTPException as e:
+        raise e
     except Exception as e:
-        # Catch any other exceptions
         raise HTTPException(status_code=500, detail=f"Import failed: {str(e)}")
     finally:
         if os.path.exists(tmp_zip_path):
@@ -118,35 +183,210 @@ async def import_db(
 
 @router.get("/export/")
 async def export_db() -> StreamingResponse:
+    stream = stream_zipped_dump(DATABASE_NAME)
     try:
-        zip_path = dump_and_zip_arango_db(DATABASE_NAME)
+        # Первую коллекцию выгружаем до ответа, чтобы ошибка arangodump вернулась как 500
+        first_chunk = await anext(stream)
+    except Exception as e:
+        await stream.aclose()
+        raise HTTPException(detail=str(e), status_code=500)
 
-        def iterfile():
-            with open(zip_path, mode="rb") as file_like:
-                while True:
-                    chunk = file_like.read(4096)
-                    if not chunk:
-                        break
-                    yield chunk
-            os.remove(zip_path)  # Delete zip after streaming is done
+    async def content():
+        yield first_chunk
+        async for chunk in stream:
+            yield chunk
+
+    return StreamingResponse(content(),
+                             media_type="application/zip",
+                             headers={"Content-Disposition": "attachment; filename=arangodump.zip"})
+
+
+@router.get("/export/incremental")
+async def export_db_incremental(query: Annotated[IncrementalExportParams, Query()]) -> StreamingResponse:
+    """
+    Выгрузка изменений документов после тика WAL или момента времени в формате NDJSON
+    """
+    if query.since_tick is not None:
+        from_tick = query.since_tick
+    elif query.since is not None:
+        from_tick = await asyncio.to_thread(tick_for_date, query.since)
+        if from_tick is None:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                                detail="No backup checkpoint before this time, a full export is required")
+    else:
+        raise HTTPException(status_code=400, detail="since_tick or since is required")
+
+    stream = stream_changes(from_tick)
+    try:
+        # Заголовок читаем до ответа, чтобы отсутствие нужной части WAL вернулось как 409
+        header = await anext(stream)
+    except WalRangeError as e:
+        await stream.aclose()
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail=f"{str(e)}, a full export is required")
+
+    async def content():
+        yield header
+        async for chunk in stream:
+            yield chunk
+
+    return StreamingResponse(content(),
+                             media_type="application/x-ndjson",
+                             headers={"Content-Disposition": "attachment; filename=incremental.ndjson"})
+
+
+@router.get("/export/analytics")
+async def export_analytics(query: Annotated[AnalyticsExportParams, Query()]) -> StreamingResponse:
+    """
+    Выгрузка плоской таблицы субботников, пользователей или участий для аналитики
+    """
+    fmt = query.format
+    if fmt is None:
+        fmt = AnalyticsFormat.PARQUET if has_pyarrow() else AnalyticsFormat.CSV
+    elif fmt != AnalyticsFormat.CSV and not has_pyarrow():
+        raise HTTPException(status_code=status.HTTP_501_NOT_IMPLEMENTED,
+                            detail=f"{fmt} export requires the pyarrow package, use format=csv")
+
+    extension = "arrow" if fmt == AnalyticsFormat.ARROW else str(fmt)
+    # Синхронный генератор StreamingResponse выполняет в пуле потоков, курсор читается по порциям
+    return StreamingResponse(stream_dataset(database, query.dataset, fmt),
+                             media_type=media_types[fmt],
+                             headers={"Content-Disposition": f"attachment; filename={query.dataset}.{extension}"})
+
+
+@router.post("/import/incremental", openapi_extra=upload_body)
+async def import_db_incremental(request: Request):
+    """
+    Применение инкрементальной выгрузки поверх восстановленной базы
+    """
+    fd, tmp_path = tempfile.mkstemp(suffix=".ndjson")
+    os.close(fd)
 
-        return StreamingResponse(iterfile(),
-                                 media_type="application/zip",
-                                 headers={"Content-Disposition": "attachment; filename=arangodump.zip"})
+    try:
+        await save_upload(request, tmp_path, extension=".ndjson")
+        try:
+            applied = await asyncio.to_thread(apply_changes, tmp_path)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        await asyncio.to_thread(invalidate_results)
+
+        return {"message": "Changes applied successfully", "applied": applied}
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
-    except Exception as e:
-        raise HTTPException(detail=str(e), status_code=500)
+
+@router.post("/jobs/export", status_code=status.HTTP_202_ACCEPTED)
+async def create_export_job() -> Job:
+    """
+    Запуск выгрузки базы в фоне; архив доступен по download_url после завершения
+    """
+    return job_manager.start_export(DATABASE_NAME)
+
+
+@router.post("/jobs/import", status_code=status.HTTP_202_ACCEPTED, openapi_extra=upload_body)
+async def create_import_job(request: Request) -> Job:
+    """
+    Запуск восстановления базы из архива в фоне
+    """
+    upload_path = job_manager.upload_path()
+    try:
+        await save_upload(request, upload_path)
+        return job_manager.start_import(DATABASE_NAME, upload_path)
+    finally:
+        if os.path.exists(upload_path):
+            os.remove(upload_path)
+
+
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str) -> Job:
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@router.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str) -> Job:
+    """
+    Отмена выполняющейся задачи или удаление завершённой вместе с архивом
+    """
+    job = job_manager.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@router.get("/jobs/{job_id}/download")
+async def download_job_archive(job_id: str) -> FileResponse:
+    job = job_manager.get(job_id)
+    if job is None or job.type != JobType.EXPORT:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.status != JobStatus.SUCCEEDED:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Export is not finished")
+
+    return FileResponse(job_manager.archive_path(job), media_type="application/zip", filename="arangodump.zip")
+
+
+def check_bucket(field: str, bucket: Optional[str], date_fields: set[str], numeric_fields: set[str]):
+    if bucket is None:
+        return
+    kind, value = parse_bucket(bucket)
+    if kind in DATE_BUCKETS and field not in date_fields:
+        raise HTTPException(status_code=400, detail=f"Field {field} is not a date, '{kind}' buckets are not supported")
+    if kind not in DATE_BUCKETS and field not in numeric_fields:
+        raise HTTPException(status_code=400, detail=f"Field {field} is not numeric, '{kind}' buckets are not supported")
+    if value is not None and value <= 0:
+        raise HTTPException(status_code=400, detail="Bucket width and quantile count must be positive")
+
+
+def heatmap_from_snapshot(kind: CubeKind, version: str, query: UserHeatmapQuery | CleandayHeatmapQuery,
+                          compute: Callable[..., list[HeatmapEntry]]) -> list[HeatmapEntry]:
+    """Heatmap from the in-process analytics snapshot, or from the repository when the engine cannot answer."""
+    data = analytics_engine.get_heatmap(kind, version, query.x_field, query.y_field, query,
+                                        query.x_bucket, query.y_bucket)
+    if data is None:
+        return compute(query.x_field, query.y_field, query)
+    return apply_quantiles(data, query.x_bucket, query.y_bucket)
 
 
 @router.get("/user-heatmap")
 async def get_users_graph(query: Annotated[UserHeatmapQuery, Query()]) -> HeatmapResponse:
-    res = static_user_repo.get_heatmap(query.x_field, query.y_field, query)
+    check_bucket(query.x_field, query.x_bucket, set(), user_numeric_fields)
+    check_bucket(query.y_field, query.y_bucket, set(), user_numeric_fields)
+
+    # Версия уже прочитана кэшем, движку не нужно запрашивать её повторно
+    res = await result_cache.get_at_version(
+        cache_key("user-heatmap", query),
+        lambda version: heatmap_from_snapshot(CubeKind.USER, version, query, static_user_repo.get_heatmap)
+    )
 
     return HeatmapResponse(data=res)
 
 
 @router.get("/cleanday-heatmap")
 async def get_cleanday_heatmap(query: Annotated[CleandayHeatmapQuery, Query()]) -> HeatmapResponse:
-    res = static_cleanday_repo.get_heatmap(query.x_field, query.y_field, query)
+    check_bucket(query.x_field, query.x_bucket, cleanday_date_fields, cleanday_numeric_fields)
+    check_bucket(query.y_field, query.y_bucket, cleanday_date_fields, cleanday_numeric_fields)
+
+    res = await result_cache.get_at_version(
+        cache_key("cleanday-heatmap", query),
+        lambda version: heatmap_from_snapshot(CubeKind.CLEANDAY, version, query, static_cleanday_repo.get_heatmap)
+    )
 
     return HeatmapResponse(data=res)
+
+
+@router.post("/cleanday-heatmap/batch")
+async def get_cleanday_heatmaps(query: CleandayHeatmapBatchQuery) -> HeatmapBatchResponse:
+    """
+    Несколько тепловых карт субботников с общими фильтрами за один проход по коллекции
+    """
+    for axes in query.grids:
+        check_bucket(axes.x_field, axes.x_bucket, cleanday_date_fields, cleanday_numeric_fields)
+        check_bucket(axes.y_field, axes.y_bucket, cleanday_date_fields, cleanday_numeric_fields)
+
+    res = static_cleanday_repo.get_heatmaps(query.grids, query.filters)
+
+    return HeatmapBatchResponse(grids=[HeatmapGrid(**axes.model_dump(), data=data)
+                                       for axes, data in zip(query.grids, res)])
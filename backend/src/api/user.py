@@ -1,18 +1,24 @@
 from datetime import datetime, UTC
 from typing import Annotated
 
-from fastapi import APIRouter, Query, Depends, HTTPException, status
+from fastapi import APIRouter, Query, Depends, HTTPException, status, Request, Response
 
+from api.caching import check_version
 from auth.service import get_current_user
 import auth.service as auth_service
 from data.entity import User, Image
 from data.query import GetUsersParams, UserListResponse, GetUser, CleandayListResponse, PaginationParams, UpdateUser, \
     CreateCleanday, GetExtendedUser, SetAvatar, GetCleandaysParams, UserHeatmapQuery, HeatmapResponse
 from repo.client import database
+from repo.heatmap_repo import CubeKind
 from repo.log_repo import LogRepo
 from repo.model import CreateLog, LogRelations
 from repo.user_repo import UserRepo
+from repo.version_repo import VersionRepo
 from repo import model as repo_model
+from storage.variants import collect_blobs, schedule_variants
+from task.heatmap import schedule_refresh
+from task.versions import schedule_bump
 
 router = APIRouter(prefix="/users", tags=["users"],
                    dependencies=[Depends(get_current_user)])
@@ -27,7 +33,13 @@ async def get_users(query: Annotated[GetUsersParams, Query()]) -> UserListRespon
 
 
 @router.get("/{user_id}")
-async def get_user(user_id: str) -> GetExtendedUser:
+async def get_user(user_id: str, request: Request, response: Response) -> GetExtendedUser:
+    version = static_user_repo.get_version(user_id)
+    if version is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    if (not_modified := check_version(request, response, version)) is not None:
+        return not_modified
+
     user = static_user_repo.get_by_key(user_id)
 
     if not user:
@@ -43,7 +55,8 @@ async def update_user(user_id: str, payload: UpdateUser,
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Cannot modify other users")
 
     trans = database.begin_transaction(read=['User', 'lives_in', 'Log'],
-                                       write=['User', 'lives_in', 'Log', 'relates_to_user', 'relates_to_city'])
+                                       write=['User', 'lives_in', 'Log', 'relates_to_user', 'relates_to_city',
+                                              'DataVersion'])
     try:
         user_repo = UserRepo(trans)
         log_repo = LogRepo(trans)
@@ -87,18 +100,28 @@ async def update_user(user_id: str, payload: UpdateUser,
                 )
             )
 
+        VersionRepo(trans).bump_data()
+
     except Exception as e:
         trans.abort_transaction()
         raise e
     else:
         trans.commit_transaction()
+        schedule_bump(log_repo.versioned)
+        schedule_refresh(CubeKind.USER, [user_id])
 
     user = static_user_repo.get_by_key(user_id)
     return user
 
 
 @router.get("/{user_id}/avatar")
-async def get_user_avatar(user_id: str) -> Image:
+async def get_user_avatar(user_id: str, request: Request, response: Response) -> Image:
+    version = static_user_repo.get_version(user_id)
+    if version is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    if (not_modified := check_version(request, response, version)) is not None:
+        return not_modified
+
     image = static_user_repo.get_image(user_id)
     if not image:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
@@ -111,33 +134,40 @@ async def upload_user_avatar(user_id: str, avatar: SetAvatar,
     if user_id != current_user.key:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Cannot modify other users")
 
-    trans = database.begin_transaction(read=['User', 'lives_in', 'Log'],
-                                       write=['User', 'lives_in', 'Log', 'relates_to_user', 'relates_to_city', 'Image'])
+    with collect_blobs() as saved_blobs:
+        trans = database.begin_transaction(read=['User', 'lives_in', 'Log'],
+                                           write=['User', 'lives_in', 'Log', 'relates_to_user', 'relates_to_city',
+                                                  'Image'])
 
-    try:
-        user_repo = UserRepo(trans)
-        log_repo = LogRepo(trans)
+        try:
+            user_repo = UserRepo(trans)
+            log_repo = LogRepo(trans)
 
-        res = user_repo.set_image(user_id, avatar.photo)
+            try:
+                res = user_repo.set_image(user_id, avatar.photo)
+            except ValueError:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid image data")
 
-        if not res:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='User not found')
+            if not res:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='User not found')
 
-        log_repo.create(
-            CreateLog(
-                date=datetime.now(UTC),
-                type="UpdateUserAvatar",
-                description=f"Пользователь '{current_user.login}' обновил свой аватар",
-                keys=LogRelations(
-                    user_key=user_id
+            log_repo.create(
+                CreateLog(
+                    date=datetime.now(UTC),
+                    type="UpdateUserAvatar",
+                    description=f"Пользователь '{current_user.login}' обновил свой аватар",
+                    keys=LogRelations(
+                        user_key=user_id
+                    )
                 )
             )
-        )
-    except Exception as e:
-        trans.abort_transaction()
-        raise e
-    else:
-        trans.commit_transaction()
+        except Exception as e:
+            trans.abort_transaction()
+            raise e
+        else:
+            trans.commit_transaction()
+            schedule_bump(log_repo.versioned)
+            schedule_variants(*saved_blobs)
 
     return True
 
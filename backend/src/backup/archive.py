@@ -0,0 +1,232 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import zipfile
+from typing import AsyncIterator, Iterator, Optional, Callable
+
+from backup.incremental import record_checkpoint
+from backup.model import JobProgress
+from config.environment import ARANGO_ROOT_PASSWORD, EXPORT_COMPRESSION_LEVEL
+from repo.client import database
+
+ARANGO_ENDPOINT = "tcp://db:8529"
+
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+# Как часто проверять, какие файлы arangodump уже дописал
+DUMP_POLL_INTERVAL = 0.5
+
+
+class ChunkWriter:
+    """Write-only file object that keeps the written bytes until the response takes them.
+
+    It has no tell()/seek(), so zipfile writes entries with data descriptors
+    and the archive can be sent while it is being built.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def connection_args(db_name: str, username: str = "root", password: str = ARANGO_ROOT_PASSWORD) -> list[str]:
+    return [
+        "--server.endpoint", ARANGO_ENDPOINT,
+        "--server.username", username,
+        "--server.password", password,
+        "--server.database", db_name,
+    ]
+
+
+async def run_tool(args: list[str], on_line: Optional[Callable[[str], None]] = None,
+                   on_start: Optional[Callable[[int], None]] = None):
+    """Run arangodump/arangorestore without blocking the event loop; the process is killed on cancellation."""
+    process = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.PIPE)
+    if on_start is not None:
+        on_start(process.pid)
+    stderr_task = asyncio.create_task(process.stderr.read())
+    try:
+        async for line in process.stdout:
+            if on_line is not None:
+                on_line(line.decode(errors='replace'))
+        stderr = await stderr_task
+        returncode = await process.wait()
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        stderr_task.cancel()
+
+    if returncode != 0:
+        raise RuntimeError(f"{args[0]} failed: {stderr.decode(errors='replace')}")
+
+
+async def dump_database(db_name: str, output_dir: str, on_line: Optional[Callable[[str], None]] = None,
+                        on_start: Optional[Callable[[int], None]] = None) -> str:
+    await run_tool([
+        "arangodump",
+        *connection_args(db_name),
+        "--output-directory", output_dir,
+        "--overwrite", "true"
+    ], on_line, on_start)
+    return output_dir
+
+
+def open_files(pid: int) -> Optional[set[str]]:
+    """Paths of the files the process keeps open, or None where /proc is not available."""
+    fd_dir = f"/proc/{pid}/fd"
+    try:
+        fds = os.listdir(fd_dir)
+    except OSError:
+        return None
+
+    paths = set()
+    for fd in fds:
+        try:
+            paths.add(os.readlink(os.path.join(fd_dir, fd)))
+        except OSError:
+            # Дескриптор закрыт между чтением каталога и ссылки
+            continue
+    return paths
+
+
+def finished_files(dump_dir: str, pid: Optional[int], archived: set[str]) -> list[str]:
+    """Collection files of a running dump that arangodump has already written and closed.
+
+    Other files, like dump.json, are taken only after the dump ends.
+    """
+    if pid is None:
+        return []
+
+    # Сначала список файлов, потом дескрипторы: файл, созданный между ними, ещё открыт
+    files = sorted(file for file in os.listdir(dump_dir)
+                   if file not in archived and (file.endswith('.structure.json') or '.data.json' in file))
+    opened = open_files(pid)
+    if opened is None:
+        return []
+    return [file for file in files if os.path.join(dump_dir, file) not in opened]
+
+
+async def restore_dump(db_name: str, input_dir: str, progress: Optional[JobProgress] = None):
+    if progress is not None:
+        progress.stage = "restoring"
+        progress.done = 0
+        progress.total = sum(1 for file in os.listdir(input_dir) if file.endswith('.structure.json'))
+
+    def on_line(line: str):
+        if progress is not None and "Loading data into" in line:
+            progress.done += 1
+
+    await run_tool([
+        "arangorestore",
+        *connection_args(db_name),
+        "--input-directory", input_dir,
+        "--overwrite", "true"
+    ], on_line)
+
+
+def zip_file_entry(zipf: zipfile.ZipFile, writer: ChunkWriter, path: str, arcname: str) -> Iterator[bytes]:
+    # Файлы данных arangodump уже сжаты gzip, повторно их не сжимаем
+    if EXPORT_COMPRESSION_LEVEL == 0 or arcname.endswith('.gz'):
+        zipf.compression = zipfile.ZIP_STORED
+    else:
+        zipf.compression = zipfile.ZIP_DEFLATED
+
+    with open(path, 'rb') as src, zipf.open(arcname, 'w', force_zip64=True) as dest:
+        while chunk := src.read(EXPORT_CHUNK_SIZE):
+            dest.write(chunk)
+            if writer.chunks:
+                yield writer.take()
+
+
+async def stream_zipped_dump(db_name: str, progress: Optional[JobProgress] = None) -> AsyncIterator[bytes]:
+    """Dump the database with one arangodump run and yield the zip archive while the dump runs.
+
+    arangodump (3.12, parallel dump) reads all collections of one run from the same
+    RocksDB snapshot, so edges and the documents they point to are consistent. A file is
+    zipped as soon as arangodump closes it and is deleted once it is in the archive.
+    """
+    # Точка отсчёта для следующей инкрементальной выгрузки
+    await asyncio.to_thread(record_checkpoint)
+
+    if progress is not None:
+        progress.stage = "dumping"
+        progress.done = 0
+        progress.total = sum(1 for c in database.collections() if not c['system'])
+
+    def on_line(line: str):
+        if progress is not None and "# Dumping" in line:
+            progress.done += 1
+
+    dump_pid = None
+
+    def on_start(pid: int):
+        nonlocal dump_pid
+        dump_pid = pid
+
+    dump_dir = tempfile.mkdtemp()
+    dump = asyncio.create_task(dump_database(db_name, dump_dir, on_line, on_start))
+    archived: set[str] = set()
+    writer = ChunkWriter()
+
+    async def archive(files: list[str]) -> AsyncIterator[bytes]:
+        for arcname in files:
+            file_path = os.path.join(dump_dir, arcname)
+            # Сжатие идёт в отдельном потоке, чтобы не занимать цикл событий
+            entry = zip_file_entry(zipf, writer, file_path, arcname)
+            while (chunk := await asyncio.to_thread(next, entry, None)) is not None:
+                yield chunk
+
+            os.remove(file_path)
+            archived.add(arcname)
+            if progress is not None and progress.stage == "archiving":
+                progress.done += 1
+
+    try:
+        with zipfile.ZipFile(writer, 'w', compresslevel=EXPORT_COMPRESSION_LEVEL or None) as zipf:
+            while not dump.done():
+                files = await asyncio.to_thread(finished_files, dump_dir, dump_pid, archived)
+                if not files:
+                    await asyncio.wait([dump], timeout=DUMP_POLL_INTERVAL)
+                    continue
+                async for chunk in archive(files):
+                    yield chunk
+
+            # Ошибка arangodump прерывает выгрузку до записи оглавления архива
+            await dump
+
+            files = sorted(os.path.relpath(os.path.join(root, file), dump_dir)
+                           for root, _, names in os.walk(dump_dir) for file in names)
+            if progress is not None:
+                progress.stage = "archiving"
+                progress.done = 0
+                progress.total = len(files)
+
+            async for chunk in archive(files):
+                yield chunk
+
+        yield writer.take()
+    finally:
+        if not dump.done():
+            dump.cancel()
+            await asyncio.gather(dump, return_exceptions=True)
+        shutil.rmtree(dump_dir, ignore_errors=True)
+
+
+async def write_zipped_dump(db_name: str, path: str, progress: Optional[JobProgress] = None):
+    with open(path, 'wb') as f:
+        async for chunk in stream_zipped_dump(db_name, progress):
+            await asyncio.to_thread(f.write, chunk)
@@ -0,0 +1,253 @@
+import csv
+import io
+from datetime import datetime, UTC
+from itertools import islice
+from typing import Iterator, Optional
+
+from arango.database import StandardDatabase
+
+from backup.model import AnalyticsDataset, AnalyticsFormat
+
+ANALYTICS_BATCH_SIZE = 5000
+
+# Сколько секунд сервер держит потоковый курсор между запросами следующей порции
+CURSOR_TTL = 600
+
+
+media_types = {
+    AnalyticsFormat.PARQUET: "application/vnd.apache.parquet",
+    AnalyticsFormat.ARROW: "application/vnd.apache.arrow.file",
+    AnalyticsFormat.CSV: "text/csv; charset=utf-8",
+}
+
+# Колонки: имя и тип (string, int, bool, datetime, string_list)
+datasets = {
+    AnalyticsDataset.CLEANDAYS: (
+        """
+        FOR cd IN CleanDay
+            LET loc = FIRST(FOR l IN OUTBOUND cd in_location LIMIT 1 RETURN l)
+            LET city = FIRST(FOR c IN OUTBOUND loc in_city LIMIT 1 RETURN c.name)
+            LET participations = (FOR par IN INBOUND cd participation_in RETURN par)
+            LET organizer_key = FIRST(
+                FOR par IN participations
+                    FILTER par.type == "Организатор"
+                    LIMIT 1
+                    FOR user IN INBOUND par has_participation
+                        RETURN user._key
+            )
+            RETURN {
+                key: cd._key,
+                name: cd.name,
+                status: cd.status,
+                begin_date: cd.begin_date,
+                end_date: cd.end_date,
+                created_at: cd.created_at,
+                updated_at: cd.updated_at,
+                organization: cd.organization,
+                area: cd.area,
+                recommended_count: cd.recommended_count,
+                participant_count: LENGTH(participations),
+                city: city,
+                location_key: loc._key,
+                location_address: loc.address,
+                organizer_key: organizer_key,
+                tags: cd.tags
+            }
+        """,
+        [
+            ("key", "string"), ("name", "string"), ("status", "string"),
+            ("begin_date", "datetime"), ("end_date", "datetime"),
+            ("created_at", "datetime"), ("updated_at", "datetime"),
+            ("organization", "string"), ("area", "int"), ("recommended_count", "int"),
+            ("participant_count", "int"), ("city", "string"), ("location_key", "string"),
+            ("location_address", "string"), ("organizer_key", "string"), ("tags", "string_list"),
+        ]
+    ),
+    AnalyticsDataset.USERS: (
+        """
+        FOR u IN User
+            LET city = FIRST(FOR c IN OUTBOUND u lives_in LIMIT 1 RETURN c.name)
+            RETURN {
+                key: u._key,
+                login: u.login,
+                first_name: u.first_name,
+                last_name: u.last_name,
+                sex: u.sex,
+                city: city,
+                score: u.score,
+                level: u.level,
+                created_at: u.created_at,
+                updated_at: u.updated_at
+            }
+        """,
+        [
+            ("key", "string"), ("login", "string"), ("first_name", "string"), ("last_name", "string"),
+            ("sex", "string"), ("city", "string"), ("score", "int"), ("level", "int"),
+            ("created_at", "datetime"), ("updated_at", "datetime"),
+        ]
+    ),
+    AnalyticsDataset.PARTICIPATIONS: (
+        """
+        FOR par IN Participation
+            LET user_key = FIRST(FOR u IN INBOUND par has_participation LIMIT 1 RETURN u._key)
+            LET cleanday_key = FIRST(FOR cd IN OUTBOUND par participation_in LIMIT 1 RETURN cd._key)
+            RETURN {
+                key: par._key,
+                user_key: user_key,
+                cleanday_key: cleanday_key,
+                type: par.type,
+                real_presence: par.real_presence,
+                stat: par.stat
+            }
+        """,
+        [
+            ("key", "string"), ("user_key", "string"), ("cleanday_key", "string"), ("type", "string"),
+            ("real_presence", "bool"), ("stat", "int"),
+        ]
+    ),
+}
+
+
+def has_pyarrow() -> bool:
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class PositionWriter:
+    """Write-only file object for pyarrow writers: keeps written bytes until they are taken and reports tell()."""
+
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def parse_datetime(value) -> Optional[datetime]:
+    if not value:
+        return None
+    date = datetime.fromisoformat(value)
+    # Старые документы хранят время без часового пояса, оно записано в UTC
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=UTC)
+    return date.astimezone(UTC)
+
+
+def read_batches(db: StandardDatabase, dataset: AnalyticsDataset) -> Iterator[list[dict]]:
+    """Run the dataset query with a streaming cursor and yield its rows batch by batch."""
+    query, _ = datasets[dataset]
+    cursor = db.aql.execute(query, stream=True, batch_size=ANALYTICS_BATCH_SIZE, ttl=CURSOR_TTL)
+    try:
+        # Курсор подгружает следующую порцию, только когда текущая разобрана
+        while batch := list(islice(cursor, ANALYTICS_BATCH_SIZE)):
+            yield batch
+    finally:
+        cursor.close(ignore_missing=True)
+
+
+def arrow_schema(columns: list[tuple[str, str]]):
+    import pyarrow as pa
+
+    types = {
+        "string": pa.string(),
+        "int": pa.int64(),
+        "bool": pa.bool_(),
+        "datetime": pa.timestamp("us", tz="UTC"),
+        "string_list": pa.list_(pa.string()),
+    }
+    return pa.schema([(name, types[kind]) for name, kind in columns])
+
+
+def to_record_batch(rows: list[dict], columns: list[tuple[str, str]], schema):
+    import pyarrow as pa
+
+    arrays = []
+    for name, kind in columns:
+        values = [row.get(name) for row in rows]
+        if kind == "datetime":
+            values = [parse_datetime(value) for value in values]
+        arrays.append(pa.array(values, type=schema.field(name).type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def stream_arrow(db: StandardDatabase, dataset: AnalyticsDataset, fmt: AnalyticsFormat) -> Iterator[bytes]:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    _, columns = datasets[dataset]
+    schema = arrow_schema(columns)
+    sink = PositionWriter()
+
+    if fmt == AnalyticsFormat.PARQUET:
+        writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    else:
+        writer = pa.ipc.new_file(sink, schema)
+
+    with writer:
+        for rows in read_batches(db, dataset):
+            batch = to_record_batch(rows, columns, schema)
+            if fmt == AnalyticsFormat.PARQUET:
+                # Каждая порция курсора становится отдельной группой строк
+                writer.write_table(pa.Table.from_batches([batch]))
+            else:
+                writer.write_batch(batch)
+            if sink.chunks:
+                yield sink.take()
+
+    yield sink.take()
+
+
+def csv_value(value, kind: str):
+    if value is None:
+        return ""
+    if kind == "string_list":
+        return ";".join(value)
+    if kind == "datetime":
+        return parse_datetime(value).isoformat()
+    return value
+
+
+def stream_csv(db: StandardDatabase, dataset: AnalyticsDataset) -> Iterator[bytes]:
+    _, columns = datasets[dataset]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    writer.writerow([name for name, _ in columns])
+    for rows in read_batches(db, dataset):
+        for row in rows:
+            writer.writerow([csv_value(row.get(name), kind) for name, kind in columns])
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def stream_dataset(db: StandardDatabase, dataset: AnalyticsDataset, fmt: AnalyticsFormat) -> Iterator[bytes]:
+    """Yield the flattened dataset in the requested format; Parquet and Arrow need the pyarrow package."""
+    if fmt == AnalyticsFormat.CSV:
+        return stream_csv(db, dataset)
+    return stream_arrow(db, dataset, fmt)
@@ -0,0 +1,64 @@
+import os
+import stat
+import zipfile
+
+from config.environment import IMPORT_MAX_ENTRIES, IMPORT_MAX_UNCOMPRESSED_SIZE
+
+EXTRACT_CHUNK_SIZE = 64 * 1024
+
+
+def member_path(extract_dir: str, info: zipfile.ZipInfo) -> str:
+    """Target path of an archive entry; raises ValueError for entries that would escape extract_dir."""
+    name = info.filename.replace('\\', '/')
+    if name.startswith('/') or os.path.isabs(name) or ':' in name.split('/')[0] \
+            or '..' in name.split('/'):
+        raise ValueError(f"Unsafe path in archive: {info.filename}")
+
+    # Символические ссылки в zip хранятся как файлы с особыми атрибутами
+    if stat.S_ISLNK(info.external_attr >> 16):
+        raise ValueError(f"Symbolic link in archive: {info.filename}")
+
+    path = os.path.realpath(os.path.join(extract_dir, name))
+    if os.path.commonpath([path, os.path.realpath(extract_dir)]) != os.path.realpath(extract_dir):
+        raise ValueError(f"Unsafe path in archive: {info.filename}")
+
+    return path
+
+
+def extract_archive(zip_path: str, extract_dir: str):
+    """Validate the dump archive and extract it entry by entry in bounded memory.
+
+    Raises ValueError if the file is not a zip archive, exceeds the import limits
+    or does not look like an arangodump.
+    """
+    try:
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            members = zip_ref.infolist()
+            if len(members) > IMPORT_MAX_ENTRIES:
+                raise ValueError(f"Archive has more than {IMPORT_MAX_ENTRIES} entries")
+
+            if sum(info.file_size for info in members) > IMPORT_MAX_UNCOMPRESSED_SIZE:
+                raise ValueError("Archive is too large when uncompressed")
+
+            names = [os.path.basename(info.filename) for info in members]
+            if 'dump.json' not in names and not any(name.endswith('.structure.json') for name in names):
+                raise ValueError("Archive does not contain an arangodump")
+
+            paths = [member_path(extract_dir, info) for info in members]
+
+            extracted = 0
+            for info, path in zip(members, paths):
+                if info.is_dir():
+                    os.makedirs(path, exist_ok=True)
+                    continue
+
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with zip_ref.open(info) as src, open(path, 'wb') as dest:
+                    while chunk := src.read(EXTRACT_CHUNK_SIZE):
+                        # Заголовкам архива не доверяем: считаем реально распакованные байты
+                        extracted += len(chunk)
+                        if extracted > IMPORT_MAX_UNCOMPRESSED_SIZE:
+                            raise ValueError("Archive is too large when uncompressed")
+                        dest.write(chunk)
+    except zipfile.BadZipFile:
+        raise ValueError("Invalid zip file format")
@@ -0,0 +1,186 @@
+import asyncio
+import json
+from datetime import datetime, UTC
+from typing import AsyncIterator, Iterator, Optional
+
+from repo.checkpoint_repo import CheckpointRepo
+from repo.client import database
+
+FORMAT_NAME = "cleanday-incremental"
+FORMAT_VERSION = 1
+
+# Типы записей WAL (формат репликации ArangoDB)
+MARKER_TRANSACTION_BEGIN = 2200
+MARKER_TRANSACTION_COMMIT = 2201
+MARKER_TRANSACTION_ABORT = 2202
+MARKER_DOCUMENT = 2300
+MARKER_REMOVE = 2302
+
+# Служебные коллекции, изменения которых не переносятся
+excluded_collections = {'BackupCheckpoint', 'IdempotencyKey'}
+
+WAL_CHUNK_SIZE = 4 * 1024 * 1024
+
+IMPORT_BATCH_SIZE = 1000
+
+
+class WalRangeError(Exception):
+    """The WAL no longer contains the requested tick, so a full export is needed."""
+
+
+def current_tick() -> str:
+    return database.wal.last_tick()['tick']
+
+
+def record_checkpoint() -> str:
+    tick = current_tick()
+    CheckpointRepo(database).create(tick, datetime.now(UTC))
+    return tick
+
+
+def tick_for_date(since: datetime) -> Optional[str]:
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=UTC)
+    return CheckpointRepo(database).get_tick_before(since.astimezone(UTC))
+
+
+def collection_names() -> dict[str, str]:
+    """Map both the numeric and the globally unique collection ids to collection names."""
+    names = {}
+    for collection in database.collections():
+        if collection['system'] or collection['name'] in excluded_collections:
+            continue
+        properties = database.collection(collection['name']).properties()
+        names[str(properties['id'])] = collection['name']
+        if properties.get('global_id'):
+            names[properties['global_id']] = collection['name']
+    return names
+
+
+def ndjson(record: dict) -> bytes:
+    return (json.dumps(record, ensure_ascii=False) + "\n").encode()
+
+
+def to_operation(entry: dict, names: dict[str, str]) -> Optional[dict]:
+    collection = entry.get('cname') or names.get(str(entry.get('cuid'))) or names.get(str(entry.get('cid')))
+    if collection is None or collection in excluded_collections or collection not in names.values():
+        return None
+
+    if entry['type'] == MARKER_DOCUMENT:
+        return {"type": "upsert", "collection": collection, "document": entry['data']}
+
+    return {"type": "remove", "collection": collection, "key": entry['data']['_key']}
+
+
+async def stream_changes(from_tick: str) -> AsyncIterator[bytes]:
+    """Yield committed document changes after `from_tick` as NDJSON operations.
+
+    Relies on the server keeping archived WAL files between exports (--rocksdb.wal-file-timeout in
+    docker-compose.yml). Raises WalRangeError before yielding anything if the WAL does not reach back
+    to `from_tick`.
+    """
+    tick_range = await asyncio.to_thread(database.wal.tick_ranges)
+    if int(tick_range['tick_min']) > int(from_tick) + 1:
+        raise WalRangeError(f"WAL starts at tick {tick_range['tick_min']}, requested {from_tick}")
+
+    # Верхняя граница фиксируется сразу, а точка восстановления записывается для выборок по времени
+    to_tick = await asyncio.to_thread(record_checkpoint)
+    names = await asyncio.to_thread(collection_names)
+
+    lower, last_scanned = from_tick, "0"
+    # Операции транзакций держим до коммита: отменённые транзакции не выгружаются
+    transactions: dict[str, list[dict]] = {}
+    first = True
+
+    while True:
+        result = await asyncio.to_thread(database.wal.tail, lower=lower, upper=to_tick,
+                                         last_scanned=last_scanned, chunk_size=WAL_CHUNK_SIZE, deserialize=True)
+        if first:
+            if not result.get('from_present', True):
+                raise WalRangeError(f"WAL no longer contains tick {from_tick}")
+            yield ndjson({"type": "header", "format": FORMAT_NAME, "version": FORMAT_VERSION,
+                          "from_tick": from_tick, "to_tick": to_tick})
+            first = False
+
+        chunk = []
+        for entry in result['content']:
+            tid = str(entry.get('tid', '0'))
+            if entry['type'] == MARKER_TRANSACTION_BEGIN:
+                transactions[tid] = []
+            elif entry['type'] == MARKER_TRANSACTION_COMMIT:
+                chunk.extend(transactions.pop(tid, []))
+            elif entry['type'] == MARKER_TRANSACTION_ABORT:
+                transactions.pop(tid, None)
+            elif entry['type'] in (MARKER_DOCUMENT, MARKER_REMOVE):
+                operation = to_operation(entry, names)
+                if operation is None:
+                    continue
+                # Маркер начала транзакции может лежать до from_tick, поэтому ждём коммита по tid
+                if tid != '0':
+                    transactions.setdefault(tid, []).append(operation)
+                else:
+                    chunk.append(operation)
+
+        if chunk:
+            yield b''.join(ndjson(operation) for operation in chunk)
+
+        if not result.get('check_more'):
+            break
+        if result.get('last_included', '0') != '0':
+            lower = result['last_included']
+        last_scanned = result.get('last_scanned', '0')
+
+    yield ndjson({"type": "footer", "to_tick": to_tick})
+
+
+def read_operations(path: str) -> Iterator[dict]:
+    """Read an incremental export from disk line by line; raises ValueError for foreign files."""
+    with open(path, 'r', encoding='utf-8') as f:
+        try:
+            header = json.loads(f.readline())
+        except json.JSONDecodeError:
+            header = None
+        if not isinstance(header, dict) or header.get('format') != FORMAT_NAME \
+                or header.get('version') != FORMAT_VERSION:
+            raise ValueError("File is not an incremental export")
+
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                raise ValueError("Incremental export is corrupted")
+            if record.get('type') in ('upsert', 'remove'):
+                yield record
+
+
+def apply_changes(path: str) -> int:
+    """Apply the operations in file order, batching consecutive operations of one kind on one collection."""
+    known = {collection['name'] for collection in database.collections() if not collection['system']}
+    applied = 0
+    batch: list[dict] = []
+
+    def flush():
+        nonlocal applied
+        if not batch:
+            return
+        collection = database.collection(batch[0]['collection'])
+        if batch[0]['type'] == 'upsert':
+            documents = [{k: v for k, v in op['document'].items() if k not in ('_id', '_rev')} for op in batch]
+            collection.insert_many(documents, overwrite=True, overwrite_mode='replace', silent=True)
+        else:
+            collection.delete_many([{'_key': op['key']} for op in batch], silent=True)
+        applied += len(batch)
+        batch.clear()
+
+    for operation in read_operations(path):
+        if operation['collection'] not in known:
+            raise ValueError(f"Unknown collection {operation['collection']}")
+        if batch and (batch[0]['type'], batch[0]['collection']) != (operation['type'], operation['collection']) \
+                or len(batch) >= IMPORT_BATCH_SIZE:
+            flush()
+        batch.append(operation)
+
+    flush()
+    return applied
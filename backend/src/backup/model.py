@@ -0,0 +1,47 @@
+from datetime import datetime
+from enum import StrEnum, auto
+from typing import Optional
+
+from pydantic import BaseModel
+
+
+class JobType(StrEnum):
+    EXPORT = auto()
+    IMPORT = auto()
+
+
+class JobStatus(StrEnum):
+    PENDING = auto()
+    RUNNING = auto()
+    SUCCEEDED = auto()
+    FAILED = auto()
+    CANCELLED = auto()
+
+
+class JobProgress(BaseModel):
+    stage: str = "pending"
+    done: int = 0
+    total: int = 0
+
+
+class Job(BaseModel):
+    id: str
+    type: JobType
+    status: JobStatus
+    progress: JobProgress
+    created_at: datetime
+    finished_at: Optional[datetime] = None
+    error: Optional[str] = None
+    download_url: Optional[str] = None
+
+
+class AnalyticsDataset(StrEnum):
+    CLEANDAYS = auto()
+    USERS = auto()
+    PARTICIPATIONS = auto()
+
+
+class AnalyticsFormat(StrEnum):
+    PARQUET = auto()
+    ARROW = auto()
+    CSV = auto()
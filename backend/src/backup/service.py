@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import os
+import shutil
+import uuid
+from datetime import datetime, UTC, timedelta
+from typing import Optional, Callable, Awaitable
+
+from backup.archive import write_zipped_dump, restore_dump
+from backup.extract import extract_archive
+from backup.model import Job, JobType, JobStatus, JobProgress
+from config.environment import BACKUP_JOBS_PATH, BACKUP_JOB_TTL
+from repo.result_cache import invalidate_results
+
+logger = logging.getLogger(__name__)
+
+EXPORT_ARCHIVE = "arangodump.zip"
+IMPORT_ARCHIVE = "upload.zip"
+
+
+class JobManager:
+    """In-memory registry of export/import jobs running as asyncio tasks.
+
+    Every job gets its own directory; finished jobs and their files are removed after BACKUP_JOB_TTL.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.jobs: dict[str, Job] = {}
+        self.tasks: dict[str, asyncio.Task] = {}
+
+    def job_dir(self, job_id: str) -> str:
+        return os.path.join(self.root, job_id)
+
+    def archive_path(self, job: Job) -> str:
+        return os.path.join(self.job_dir(job.id), EXPORT_ARCHIVE if job.type == JobType.EXPORT else IMPORT_ARCHIVE)
+
+    def upload_path(self) -> str:
+        """A fresh path for an uploaded archive that is later handed to start_import."""
+        os.makedirs(self.root, exist_ok=True)
+        return os.path.join(self.root, f"upload-{uuid.uuid4().hex}.zip")
+
+    def start_export(self, db_name: str) -> Job:
+        async def work(job: Job):
+            await write_zipped_dump(db_name, self.archive_path(job), job.progress)
+            job.download_url = f"/api/stats/jobs/{job.id}/download"
+
+        return self._start(JobType.EXPORT, work)
+
+    def start_import(self, db_name: str, upload_path: str) -> Job:
+        async def work(job: Job):
+            extract_dir = os.path.join(self.job_dir(job.id), "dump")
+            job.progress.stage = "extracting"
+            await asyncio.to_thread(extract_archive, self.archive_path(job), extract_dir)
+            await restore_dump(db_name, extract_dir, job.progress)
+            await asyncio.to_thread(invalidate_results)
+            shutil.rmtree(self.job_dir(job.id), ignore_errors=True)
+
+        job = self._start(JobType.IMPORT, work, start=False)
+        try:
+            os.replace(upload_path, self.archive_path(job))
+        except OSError as e:
+            self._remove(job)
+            raise e
+
+        self._run(job, work)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        self.prune()
+        return self.jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        """Cancel a running job or discard a finished one together with its files."""
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+
+        task = self.tasks.get(job_id)
+        if task is not None:
+            task.cancel()
+        else:
+            self._remove(job)
+
+        return job
+
+    async def wait(self, job_id: str):
+        task = self.tasks.get(job_id)
+        if task is not None:
+            await asyncio.shield(task)
+
+    def prune(self):
+        expire_before = datetime.now(UTC) - timedelta(seconds=BACKUP_JOB_TTL)
+        for job in list(self.jobs.values()):
+            if job.finished_at is not None and job.finished_at < expire_before:
+                self._remove(job)
+
+    async def shutdown(self):
+        for task in list(self.tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+
+    def _start(self, job_type: JobType, work: Callable[[Job], Awaitable[None]], start: bool = True) -> Job:
+        self.prune()
+
+        job = Job(id=uuid.uuid4().hex, type=job_type, status=JobStatus.PENDING, progress=JobProgress(),
+                  created_at=datetime.now(UTC))
+        os.makedirs(self.job_dir(job.id), exist_ok=True)
+        self.jobs[job.id] = job
+
+        if start:
+            self._run(job, work)
+
+        return job
+
+    def _run(self, job: Job, work: Callable[[Job], Awaitable[None]]):
+        self.tasks[job.id] = asyncio.create_task(self._execute(job, work))
+
+    async def _execute(self, job: Job, work: Callable[[Job], Awaitable[None]]):
+        job.status = JobStatus.RUNNING
+        try:
+            await work(job)
+            job.status = JobStatus.SUCCEEDED
+            job.progress.stage = "finished"
+        except asyncio.CancelledError:
+            job.status = JobStatus.CANCELLED
+        except Exception as e:
+            logger.exception(f'Job {job.id} failed')
+            job.status = JobStatus.FAILED
+            job.error = str(e)
+        finally:
+            job.finished_at = datetime.now(UTC)
+            self.tasks.pop(job.id, None)
+            if job.status != JobStatus.SUCCEEDED:
+                shutil.rmtree(self.job_dir(job.id), ignore_errors=True)
+
+    def _remove(self, job: Job):
+        self.jobs.pop(job.id, None)
+        shutil.rmtree(self.job_dir(job.id), ignore_errors=True)
+
+
+job_manager = JobManager(BACKUP_JOBS_PATH)
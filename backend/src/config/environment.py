@@ -5,3 +5,74 @@ ARANGO_ROOT_PASSWORD = os.getenv("ARANGO_ROOT_PASSWORD")
 SECRET_KEY = os.getenv("SECRET_KEY")
 
 DATABASE_NAME = os.getenv("DATABASE_NAME")
+
+IDEMPOTENCY_KEY_TTL = int(os.getenv("IDEMPOTENCY_KEY_TTL", "86400"))
+
+BLOB_STORE = os.getenv("BLOB_STORE", "local")
+
+BLOB_STORE_PATH = os.getenv("BLOB_STORE_PATH", "/var/lib/cleanday/blobs")
+
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
+
+S3_BUCKET = os.getenv("S3_BUCKET", "cleanday-images")
+
+S3_ACCESS_KEY = os.getenv("S3_ACCESS_KEY")
+
+S3_SECRET_KEY = os.getenv("S3_SECRET_KEY")
+
+# Длины большей стороны уменьшенных копий изображений, через запятую
+IMAGE_VARIANT_SIZES = [int(size) for size in os.getenv("IMAGE_VARIANT_SIZES", "64,256,1024").split(",")]
+
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+
+# Уровень сжатия архива выгрузки (0 - без сжатия, 1-9 - deflate)
+EXPORT_COMPRESSION_LEVEL = int(os.getenv("EXPORT_COMPRESSION_LEVEL", "6"))
+
+# Каталог для архивов фоновых задач выгрузки и загрузки
+BACKUP_JOBS_PATH = os.getenv("BACKUP_JOBS_PATH", "/var/lib/cleanday/jobs")
+
+# Сколько секунд хранить завершённые задачи и их архивы
+BACKUP_JOB_TTL = int(os.getenv("BACKUP_JOB_TTL", "3600"))
+
+# Ограничения для загружаемых архивов восстановления
+IMPORT_MAX_UPLOAD_SIZE = int(os.getenv("IMPORT_MAX_UPLOAD_SIZE", str(10 * 1024 ** 3)))
+
+IMPORT_MAX_ENTRIES = int(os.getenv("IMPORT_MAX_ENTRIES", "10000"))
+
+IMPORT_MAX_UNCOMPRESSED_SIZE = int(os.getenv("IMPORT_MAX_UNCOMPRESSED_SIZE", str(50 * 1024 ** 3)))
+
+# Период полного пересчёта счётчиков статистики, в секундах
+STATS_RECONCILE_INTERVAL = int(os.getenv("STATS_RECONCILE_INTERVAL", "3600"))
+
+# Период полной перестройки кубов тепловых карт, в секундах
+HEATMAP_REBUILD_INTERVAL = int(os.getenv("HEATMAP_REBUILD_INTERVAL", "86400"))
+
+# Число запомненных результатов статистики и тепловых карт
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "256"))
+
+# Отдавать устаревший результат, пока новый считается в фоне
+RESULT_CACHE_STALE_WHILE_REVALIDATE = os.getenv("RESULT_CACHE_STALE_WHILE_REVALIDATE", "true").lower() in ("1", "true")
+
+# Сколько секунд после вычисления результат может отдаваться устаревшим
+RESULT_CACHE_MAX_STALE = int(os.getenv("RESULT_CACHE_MAX_STALE", "300"))
+
+# Считать тепловые карты по колоночному снимку в памяти процесса (нужен пакет numpy)
+ANALYTICS_ENGINE = os.getenv("ANALYTICS_ENGINE", "false").lower() in ("1", "true")
+
+# Период проверки и перезагрузки снимка аналитики, в секундах
+ANALYTICS_REFRESH_INTERVAL = int(os.getenv("ANALYTICS_REFRESH_INTERVAL", "30"))
+
+# Записи журнала старше этого числа дней, кроме событий создания, переносятся в LogArchive (0 - не переносить)
+LOG_RETENTION_DAYS = int(os.getenv("LOG_RETENTION_DAYS", "365"))
+
+# Период переноса старых записей журнала в архив, в секундах
+LOG_ARCHIVE_INTERVAL = int(os.getenv("LOG_ARCHIVE_INTERVAL", "86400"))
+
+# Дублировать ключи связанных документов записи журнала рёбрами relates_to_* (для внешних обходов графа)
+LOG_RELATION_EDGES = os.getenv("LOG_RELATION_EDGES", "false").lower() in ("1", "true")
+
+# Первые страницы ленты событий кэшируются на это число секунд
+FEED_CACHE_TTL = float(os.getenv("FEED_CACHE_TTL", "10"))
+
+# Число закэшированных первых страниц ленты (по городу и фильтрам)
+FEED_CACHE_SIZE = int(os.getenv("FEED_CACHE_SIZE", "256"))
@@ -1,4 +1,6 @@
 from datetime import datetime
+from typing import Optional
+
 from pydantic import BaseModel
 from enum import StrEnum, auto
 
@@ -95,7 +97,12 @@ class Location(BaseModel):
 class Image(BaseModel):
     key: str
     description: str
-    photo: str
+    # Ссылка на байты изображения; None для аватара по умолчанию
+    url: Optional[str] = None
+    size: int = 0
+    width: Optional[int] = None
+    height: Optional[int] = None
+    content_type: Optional[str] = None
 
 
 class Log(BaseModel):
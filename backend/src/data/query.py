@@ -1,9 +1,10 @@
-from datetime import datetime
+from datetime import datetime, date
 from enum import StrEnum, auto
 from typing import Optional, List
 
 from pydantic import BaseModel, Field
 
+from backup.model import AnalyticsDataset, AnalyticsFormat
 from data.entity import User, Sex, CleanDayStatus, CleanDayTag, Requirement, Log, Comment, ParticipationType, Location, \
     City, Image, Participation
 from repo.model import CreateImage
@@ -168,7 +169,23 @@ class CleandayLog(Log):
 
 class CleandayLogListResponse(BaseModel):
     logs: list[CleandayLog]
-    total_count: int
+    # Не считается для страниц, запрошенных по курсору
+    total_count: Optional[int] = None
+    # Курсоры для before (более старые записи) и after (более новые записи)
+    oldest_cursor: Optional[str] = None
+    newest_cursor: Optional[str] = None
+
+
+class FeedLog(CleandayLog):
+    cleanday_key: Optional[str] = None
+    cleanday_name: Optional[str] = None
+    city_key: Optional[str] = None
+
+
+class FeedResponse(BaseModel):
+    logs: list[FeedLog]
+    # Курсор для before следующей (более старой) страницы, None на последней странице
+    next_cursor: Optional[str] = None
 
 
 class GetComment(Comment):
@@ -304,6 +321,22 @@ class GetCleandayLogsParams(PaginationParams):
     date_from: Optional[datetime] = None
     date_to: Optional[datetime] = None
 
+    # Курсоры из oldest_cursor/newest_cursor предыдущей страницы, offset отсчитывается от них
+    before: Optional[str] = None
+    after: Optional[str] = None
+
+
+class GetFeedParams(BaseModel):
+    limit: int = Field(20, ge=1, le=50)
+
+    city_key: Optional[str] = None
+    tags: Optional[list[CleanDayTag]] = None
+    # Субботники, на которые подписан пользователь
+    cleanday_keys: Optional[list[str]] = None
+
+    # Курсор из next_cursor предыдущей страницы
+    before: Optional[str] = None
+
 
 class GetCommentsParams(PaginationParams):
     sort_by: LogSortField = LogSortField.DATE
@@ -341,9 +374,19 @@ class UserHeatmapField(StrEnum):
     stat = "stat"
 
 
+# Группировка значений оси: day, week, month для дат, width:N или quantile:N для чисел
+HEATMAP_BUCKET_PATTERN = r'^(day|week|month|width:\d+(\.\d+)?|quantile:\d+)$'
+
+
+user_numeric_fields = {UserHeatmapField.score, UserHeatmapField.level, UserHeatmapField.cleanday_count,
+                       UserHeatmapField.organized_count, UserHeatmapField.stat}
+
+
 class UserHeatmapQuery(GetUsersParams):
     x_field: UserHeatmapField
     y_field: UserHeatmapField
+    x_bucket: Optional[str] = Field(None, pattern=HEATMAP_BUCKET_PATTERN)
+    y_bucket: Optional[str] = Field(None, pattern=HEATMAP_BUCKET_PATTERN)
 
 
 class CleandayHeatmapField(StrEnum):
@@ -366,9 +409,38 @@ class CleandayHeatmapField(StrEnum):
     location_address = "location.address"
 
 
+cleanday_date_fields = {CleandayHeatmapField.begin_date, CleandayHeatmapField.end_date,
+                        CleandayHeatmapField.created_at, CleandayHeatmapField.updated_at}
+
+cleanday_numeric_fields = {CleandayHeatmapField.participant_count, CleandayHeatmapField.recommended_count,
+                           CleandayHeatmapField.area}
+
+
 class CleandayHeatmapQuery(GetCleandaysParams):
     x_field: CleandayHeatmapField
     y_field: CleandayHeatmapField
+    x_bucket: Optional[str] = Field(None, pattern=HEATMAP_BUCKET_PATTERN)
+    y_bucket: Optional[str] = Field(None, pattern=HEATMAP_BUCKET_PATTERN)
+
+
+class HeatmapAxes(BaseModel):
+    x_field: CleandayHeatmapField
+    y_field: CleandayHeatmapField
+    x_bucket: Optional[str] = Field(None, pattern=HEATMAP_BUCKET_PATTERN)
+    y_bucket: Optional[str] = Field(None, pattern=HEATMAP_BUCKET_PATTERN)
+
+
+class CleandayHeatmapBatchQuery(BaseModel):
+    grids: list[HeatmapAxes] = Field(min_length=1, max_length=20)
+    filters: GetCleandaysParams = GetCleandaysParams()
+
+
+class HeatmapGrid(HeatmapAxes):
+    data: list[HeatmapEntry]
+
+
+class HeatmapBatchResponse(BaseModel):
+    grids: list[HeatmapGrid]
 
 
 class CreateComment(BaseModel):
@@ -383,3 +455,44 @@ class GetMembersResponse(BaseModel):
 class RequirementListResponse(BaseModel):
     contents: List[Requirement]
     total_count: int
+
+
+class IncrementalExportParams(BaseModel):
+    since_tick: Optional[str] = Field(default=None, pattern=r'^\d+$')
+    since: Optional[datetime] = None
+
+
+class AnalyticsExportParams(BaseModel):
+    dataset: AnalyticsDataset
+    # По умолчанию Parquet, если установлен pyarrow, иначе CSV
+    format: Optional[AnalyticsFormat] = None
+
+
+class TimeseriesGranularity(StrEnum):
+    DAY = auto()
+    WEEK = auto()
+    MONTH = auto()
+
+
+class TimeseriesParams(BaseModel):
+    date_from: date
+    date_to: date
+    granularity: TimeseriesGranularity = TimeseriesGranularity.DAY
+    city_key: Optional[str] = None
+    tag: Optional[CleanDayTag] = None
+    # Отдельный ряд для каждого города
+    by_city: bool = False
+
+
+class TimeseriesPoint(BaseModel):
+    period: date
+    city_key: Optional[str] = None
+    city: Optional[str] = None
+    created: int
+    completed: int
+    participants: int
+    area: int
+
+
+class TimeseriesResponse(BaseModel):
+    data: list[TimeseriesPoint]
@@ -8,13 +8,38 @@ from api.auth import router as auth_router
 from api.stats import router as stats_router
 from api.city import router as city_router
 from api.location import router as location_router
+from api.image import router as image_router
+from api.feed import router as feed_router
+from backup.service import job_manager
+from analytics.engine import analytics_engine
+from config.environment import STATS_RECONCILE_INTERVAL, HEATMAP_REBUILD_INTERVAL, ANALYTICS_REFRESH_INTERVAL, \
+    LOG_RETENTION_DAYS, LOG_ARCHIVE_INTERVAL
 from repo import migration
+from storage import variants
+from storage.blob_store import get_blob_store
+from task.scheduler import scheduler
+from task.heatmap import rebuild_cubes
+from task.stats import reconcile_stats
+from task.analytics import refresh_snapshot
+from task.logs import archive_logs
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # Хранилище блобов создаётся при запуске, а не при импорте: ошибки настройки видны сразу
+    get_blob_store()
     await migration.apply()
+    scheduler.every('stats-reconcile', STATS_RECONCILE_INTERVAL, reconcile_stats)
+    scheduler.every('heatmap-rebuild', HEATMAP_REBUILD_INTERVAL, rebuild_cubes)
+    if analytics_engine.enabled:
+        scheduler.every('analytics-refresh', ANALYTICS_REFRESH_INTERVAL, refresh_snapshot)
+    if LOG_RETENTION_DAYS > 0:
+        scheduler.every('log-archive', LOG_ARCHIVE_INTERVAL, archive_logs)
+    scheduler.start()
     yield
+    await scheduler.shutdown()
+    await job_manager.shutdown()
+    variants.shutdown()
 
 api_router = APIRouter(prefix="/api")
 api_router.include_router(user_router)
@@ -23,6 +48,8 @@ api_router.include_router(auth_router)
 api_router.include_router(stats_router)
 api_router.include_router(city_router)
 api_router.include_router(location_router)
+api_router.include_router(image_router)
+api_router.include_router(feed_router)
 
 server = FastAPI(lifespan=lifespan)
 
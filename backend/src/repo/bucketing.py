@@ -0,0 +1,99 @@
+from bisect import bisect_right
+from collections import defaultdict
+from typing import Optional
+
+from data.query import HeatmapEntry
+
+DATE_BUCKETS = {'day', 'week', 'month'}
+
+
+def parse_bucket(bucket: str) -> tuple[str, Optional[float]]:
+    """Split 'width:10' into ('width', 10.0); date granularities have no argument."""
+    kind, _, value = bucket.partition(':')
+    return kind, float(value) if value else None
+
+
+def format_number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else str(value)
+
+
+def bucket_expression(expression: str, bucket: Optional[str]) -> str:
+    """AQL expression for the heatmap label of `expression`.
+
+    Dates are truncated to a day, a week starting on Monday or a month; numbers are put into
+    half-open bins of the given width. Quantile bins need the whole distribution and are
+    applied to the result by apply_quantiles.
+    """
+    if bucket is None:
+        return f"TO_STRING({expression})"
+
+    kind, value = parse_bucket(bucket)
+    if kind == 'day':
+        label = f"SUBSTRING({expression}, 0, 10)"
+    elif kind == 'week':
+        day = f"SUBSTRING({expression}, 0, 10)"
+        label = f'DATE_FORMAT(DATE_SUBTRACT({day}, (DATE_DAYOFWEEK({day}) + 6) % 7, "day"), "%yyyy-%mm-%dd")'
+    elif kind == 'month':
+        label = f"SUBSTRING({expression}, 0, 7)"
+    elif kind == 'width':
+        width = format_number(value)
+        start = f"FLOOR({expression} / {width}) * {width}"
+        label = f'CONCAT("[", {start}, ", ", {start} + {width}, ")")'
+    else:
+        return f"TO_STRING({expression})"
+
+    return f'({expression} == null ? "" : {label})'
+
+
+def quantile_bins(weights: dict[str, int], count: int) -> dict[str, str]:
+    """Map numeric labels to the labels of `count` bins holding roughly equal numbers of entities."""
+    values = sorted((float(label), weight) for label, weight in weights.items() if label != "")
+    if not values:
+        return {}
+
+    total = sum(weight for _, weight in values)
+    bounds = [values[0][0]]
+    seen = 0
+    for value, weight in values:
+        # Граница ставится на значение, с которого начинается следующая доля
+        if seen >= total * len(bounds) / count and value > bounds[-1]:
+            bounds.append(value)
+        seen += weight
+
+    last = values[-1][0]
+    labels = {}
+    for label in weights:
+        if label == "":
+            continue
+        index = bisect_right(bounds, float(label)) - 1
+        if index + 1 < len(bounds):
+            labels[label] = f"[{format_number(bounds[index])}, {format_number(bounds[index + 1])})"
+        else:
+            labels[label] = f"[{format_number(bounds[index])}, {format_number(last)}]"
+    return labels
+
+
+def apply_quantiles(entries: list[HeatmapEntry], x_bucket: Optional[str],
+                    y_bucket: Optional[str]) -> list[HeatmapEntry]:
+    x_kind, x_count = parse_bucket(x_bucket) if x_bucket else (None, None)
+    y_kind, y_count = parse_bucket(y_bucket) if y_bucket else (None, None)
+    if x_kind != 'quantile' and y_kind != 'quantile':
+        return entries
+
+    x_labels, y_labels = {}, {}
+    if x_kind == 'quantile':
+        weights = defaultdict(int)
+        for entry in entries:
+            weights[entry.x_label] += entry.count
+        x_labels = quantile_bins(weights, int(x_count))
+    if y_kind == 'quantile':
+        weights = defaultdict(int)
+        for entry in entries:
+            weights[entry.y_label] += entry.count
+        y_labels = quantile_bins(weights, int(y_count))
+
+    cells = defaultdict(int)
+    for entry in entries:
+        cells[(x_labels.get(entry.x_label, entry.x_label), y_labels.get(entry.y_label, entry.y_label))] += entry.count
+
+    return [HeatmapEntry(x_label=x, y_label=y, count=count) for (x, y), count in cells.items()]
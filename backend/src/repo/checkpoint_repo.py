@@ -0,0 +1,37 @@
+from datetime import datetime
+from typing import Optional
+
+from arango.database import StandardDatabase
+
+
+class CheckpointRepo:
+    """Points in time with the WAL tick that was current at that moment; used to turn timestamps into ticks."""
+
+    def __init__(self, database: StandardDatabase):
+        self.db = database
+
+    def create(self, tick: str, date: datetime):
+        self.db.aql.execute(
+            """
+            INSERT {tick: @tick, date: @date} INTO BackupCheckpoint
+            """,
+            bind_vars={"tick": tick, "date": date.isoformat()}
+        )
+
+    def get_tick_before(self, date: datetime) -> Optional[str]:
+        """Latest recorded tick not later than `date`: changes after `date` all have greater ticks."""
+        cursor = self.db.aql.execute(
+            """
+            FOR checkpoint IN BackupCheckpoint
+                FILTER checkpoint.date <= @date
+                SORT checkpoint.date DESC
+                LIMIT 1
+                RETURN checkpoint.tick
+            """,
+            bind_vars={"date": date.isoformat()}
+        )
+
+        if cursor.empty():
+            return None
+
+        return cursor.next()
@@ -1,4 +1,6 @@
-from datetime import datetime
+import base64
+import json
+from datetime import datetime, UTC
 from enum import StrEnum, auto
 from typing import Optional, Tuple
 
@@ -7,12 +9,16 @@ from arango.database import StandardDatabase
 
 from data.entity import CleanDay, CleanDayTag, CleanDayStatus, ParticipationType, Requirement, Image
 from data.query import GetCleanday, GetCleandaysParams, GetUser, GetMembersParams, PaginationParams, CleandayLog, \
-    GetComment, GetMember, GetCleandayLogsParams, GetCommentsParams, CleandayHeatmapField, HeatmapEntry
+    GetComment, GetMember, GetCleandayLogsParams, GetCommentsParams, CleandayHeatmapField, HeatmapEntry, \
+    CleandayHeatmapQuery, HeatmapAxes, SortOrder
 from repo import util
+from repo.bucketing import apply_quantiles
 from repo.client import database
+from repo.heatmap_repo import HeatmapCubeRepo, CubeKind, cube_filters
 from repo.location_repo import LocationRepo
-from repo.model import CreateCleanday, UpdateCleanday, CreateImage
+from repo.model import CreateCleanday, UpdateCleanday, CreateImage, EntityVersion
 from repo.user_repo import setup_get_users_params
+from storage.image import save_photo, load_metadata
 
 
 class DeleteReqResult(StrEnum):
@@ -27,6 +33,34 @@ log_from_filters = ['date_from']
 log_to_filters = ['date_to']
 time_fields = ['date']
 
+# Связанные документы указаны ключами прямо в записи журнала
+log_relation_fields = ['cleanday_key', 'user_key', 'comment_key', 'location_key', 'city_key', 'archived_at']
+log_lookups = {
+    'user': 'LET user = FIRST(FOR usr IN [DOCUMENT(CONCAT("User/", log.user_key))] FILTER usr != null '
+            'RETURN MERGE(usr, {password: "", key: usr._key}))',
+    'comment': 'LET comment = FIRST(FOR comm IN [DOCUMENT(CONCAT("Comment/", log.comment_key))] FILTER comm != null '
+               'RETURN MERGE(comm, {key: comm._key}))',
+    'location': 'LET location = FIRST(FOR loc IN [DOCUMENT(CONCAT("Location/", log.location_key))] FILTER loc != null '
+                'RETURN MERGE(loc, {key: loc._key}))',
+}
+
+
+def encode_log_cursor(date: datetime, key: str) -> str:
+    """Opaque position of a log in the (date, key) order."""
+    data = json.dumps([date.isoformat(), key])
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+
+def decode_log_cursor(cursor: str) -> (str, str):
+    try:
+        date, key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError) as e:
+        raise ValueError("Invalid log cursor") from e
+    if not isinstance(date, str) or not isinstance(key, str):
+        raise ValueError("Invalid log cursor")
+    return date, key
+
+
 comment_contains_filters = ['text']
 comment_from_filters = ['date_from']
 comment_to_filters = ['date_to']
@@ -72,21 +106,6 @@ class CleandayRepo:
                     RETURN MERGE(req, {"users_amount": fulfills, "key": req._key})    
             )
             
-            LET created_at = FIRST(
-                FOR log IN INBOUND cdId relates_to_cleanday
-                    FILTER log.type == "CreateCleanday"
-                    LIMIT 1
-                    RETURN log.date
-            )
-            
-            LET updated_at = NOT_NULL(FIRST(
-                FOR log IN INBOUND cdId relates_to_cleanday
-                    FILTER log.type == "UpdateCleanday"
-                    SORT log.date DESC
-                    LIMIT 1
-                    RETURN log.date
-            ), created_at)
-            
             LET organizer = FIRST(
                 FOR par IN INBOUND cdId participation_in
                     FILTER par.type == "Организатор"
@@ -109,8 +128,6 @@ class CleandayRepo:
                 "participant_count": participant_count,
                 "requirements": requirements,
                 "location": loc,
-                "created_at": created_at,
-                "updated_at": updated_at,
                 "organizer": organizer,
                 "organizer_key": organizer_key
             }
@@ -145,11 +162,99 @@ class CleandayRepo:
         result_dict['key'] = result_dict["_key"]
         return CleanDay.model_validate(result_dict)
 
+    def get_version(self, cleanday_key: str) -> Optional[EntityVersion]:
+        """Version of the cleanday card: the cleanday itself, its location and organizer."""
+        cursor = self.db.aql.execute(
+            """
+            LET cl_day = DOCUMENT(CONCAT("CleanDay/", @cleanday_key))
+            FILTER cl_day != null
+            
+            LET loc = FIRST(
+                FOR loc IN OUTBOUND cl_day in_location
+                    LIMIT 1
+                    RETURN loc
+            )
+            LET organizer = FIRST(
+                FOR par IN INBOUND cl_day participation_in
+                    FILTER par.type == "Организатор"
+                    LIMIT 1
+                    FOR user IN INBOUND par has_participation
+                        RETURN user
+            )
+            
+            RETURN {
+                tag: CONCAT_SEPARATOR(":", cl_day._rev, loc._rev, organizer._rev),
+                modified_at: MAX([cl_day.modified_at, loc.modified_at, organizer.modified_at])
+            }
+            """,
+            bind_vars={"cleanday_key": cleanday_key}
+        )
+
+        if cursor.empty():
+            return None
+
+        return EntityVersion.model_validate(cursor.next())
+
+    def get_members_version(self, cleanday_key: str) -> Optional[EntityVersion]:
+        """Version of the member list: the cleanday and every member."""
+        cursor = self.db.aql.execute(
+            """
+            LET cl_day = DOCUMENT(CONCAT("CleanDay/", @cleanday_key))
+            FILTER cl_day != null
+            
+            LET members = (
+                FOR par IN INBOUND cl_day participation_in
+                    FOR user IN INBOUND par has_participation
+                        RETURN {rev: user._rev, modified_at: user.modified_at}
+            )
+            
+            RETURN {
+                tag: CONCAT(cl_day._rev, ":", MD5(CONCAT_SEPARATOR(",", members[*].rev))),
+                modified_at: MAX(APPEND([cl_day.modified_at], members[*].modified_at))
+            }
+            """,
+            bind_vars={"cleanday_key": cleanday_key}
+        )
+
+        if cursor.empty():
+            return None
+
+        return EntityVersion.model_validate(cursor.next())
+
+    def get_comments_version(self, cleanday_key: str) -> Optional[EntityVersion]:
+        """Version of the comment list: the cleanday and the comment authors."""
+        cursor = self.db.aql.execute(
+            """
+            LET cl_day = DOCUMENT(CONCAT("CleanDay/", @cleanday_key))
+            FILTER cl_day != null
+            
+            LET authors = UNIQUE(
+                FOR comment IN OUTBOUND cl_day has_comment
+                    FOR par IN INBOUND comment authored
+                        FOR user IN INBOUND par has_participation
+                            RETURN {rev: user._rev, modified_at: user.modified_at}
+            )
+            
+            RETURN {
+                tag: CONCAT(cl_day._rev, ":", MD5(CONCAT_SEPARATOR(",", authors[*].rev))),
+                modified_at: MAX(APPEND([cl_day.modified_at], authors[*].modified_at))
+            }
+            """,
+            bind_vars={"cleanday_key": cleanday_key}
+        )
+
+        if cursor.empty():
+            return None
+
+        return EntityVersion.model_validate(cursor.next())
+
     def create(self, user_key: str, cleanday: CreateCleanday) -> CleanDay:
         cleanday_dict = cleanday.model_dump()
         cleanday_dict.pop('requirements')
         cleanday_dict['begin_date'] = cleanday_dict['begin_date'].isoformat()
         cleanday_dict['end_date'] = cleanday_dict['end_date'].isoformat()
+        cleanday_dict['created_at'] = datetime.now(UTC).isoformat()
+        cleanday_dict['updated_at'] = cleanday_dict['created_at']
 
         cursor = self.db.aql.execute(
             """
@@ -204,7 +309,8 @@ class CleandayRepo:
 
         return CleanDay.model_validate(result_dict)
 
-    def update(self, cleanday_key: str, cleanday: UpdateCleanday) -> Optional[CleanDay]:
+    def update(self, cleanday_key: str, cleanday: UpdateCleanday, touch: bool = True) -> Optional[CleanDay]:
+        """Apply the changes; `touch` bumps updated_at, which follows edits of the cleanday (UpdateCleanday logs)."""
         if self.get_raw_by_key(cleanday_key) is None:
             return None
 
@@ -213,6 +319,8 @@ class CleandayRepo:
             cleanday_dict['begin_date'] = cleanday_dict['begin_date'].isoformat()
         if 'end_date' in cleanday_dict:
             cleanday_dict['end_date'] = cleanday_dict['end_date'].isoformat()
+        if touch:
+            cleanday_dict['updated_at'] = datetime.now(UTC).isoformat()
 
         cursor = self.db.aql.execute(
             """
@@ -402,151 +510,121 @@ class CleandayRepo:
         return page_dict["count"], list(map(lambda u: GetMember.model_validate(u), page_dict["page"]))
         pass
 
-    def get_logs(self, cleanday_key: str, params: GetCleandayLogsParams) -> Optional[Tuple[int, list[CleandayLog]]]:
+    def get_logs(self, cleanday_key: str, params: GetCleandayLogsParams) \
+            -> Optional[Tuple[Optional[int], list[CleandayLog]]]:
+        """Page of the cleanday's logs ordered by (date, key).
+
+        Logs are read from the cleanday_key index in sort order, starting after the
+        `before`/`after` cursor; related documents are looked up only for filters that need
+        them and for the returned logs. Archived logs are merged in the same order from LogArchive.
+        The total count is computed only for pages without a cursor.
+        """
         if self.get_raw_by_key(cleanday_key) is None:
             return None
 
-        bind_vars = params.model_dump(exclude_none=True)
-        bind_vars["cleanday_key"] = cleanday_key
-        bind_vars.pop('sort_order')
-        bind_vars.pop('sort_by')
+        params_dict = params.model_dump(exclude_none=True)
+        bind_vars = {"cleanday_key": cleanday_key, "offset": params.offset, "limit": params.limit}
 
-        filters = []
+        date_filters = []
+        log_filters = []
+        lookup_filters = []
+        used_lookups = set()
 
         for contains_filter in log_contains_filters:
-            if contains_filter in bind_vars:
-                filters.append(
-                    f"    FILTER CONTAINS(LOWER(full_log.{contains_filter}), LOWER(@{contains_filter}))"
-                )
-
-        for from_filter in log_from_filters:
-            if from_filter in bind_vars:
-                field_name = from_filter[:-5]
-                filters.append(
-                    f"    FILTER full_log.{field_name} >= @{from_filter}"
-                )
-                if field_name in time_fields:
-                    bind_vars[from_filter] = bind_vars[from_filter].isoformat()
-
-        for to_filter in log_to_filters:
-            if to_filter in bind_vars:
-                field_name = to_filter[:-3]
-                filters.append(
-                    f"    FILTER full_log.{field_name} <= @{to_filter}"
-                )
-                if field_name in time_fields:
-                    bind_vars[to_filter] = bind_vars[to_filter].isoformat()
-
-        if 'user_login' in bind_vars:
-            filters.append(
-                f"    FILTER CONTAINS(LOWER(full_log.user.login), LOWER(@user_login))"
-            )
-
-        if 'location_address' in bind_vars:
-            filters.append(
-                f"    FILTER CONTAINS(LOWER(full_log.location.address), LOWER(@location_address))"
-            )
-
-        if 'comment_text' in bind_vars:
-            filters.append(
-                f"    FILTER CONTAINS(LOWER(full_log.comment.text), LOWER(@comment_text))"
-            )
-
-        if 'search_query' in bind_vars and bind_vars['search_query'] == "":
-            bind_vars.pop('search_query')
-
-        if 'search_query' in bind_vars:
-            filters.append(
-                f"    FILTER (CONTAINS(LOWER(full_log.comment.text), LOWER(@search_query)) OR "
-                f"CONTAINS(LOWER(full_log.location.address), LOWER(@search_query)) OR "
-                f"CONTAINS(LOWER(full_log.user.login), LOWER(@search_query)) OR "
-                f"CONTAINS(LOWER(full_log.type), LOWER(@search_query)) OR "
-                f"CONTAINS(LOWER(full_log.description), LOWER(@search_query)))"
+            if contains_filter in params_dict:
+                log_filters.append(f"FILTER CONTAINS(LOWER(log.{contains_filter}), LOWER(@{contains_filter}))")
+                bind_vars[contains_filter] = params_dict[contains_filter]
+
+        # Диапазон дат ограничивает чтение индекса по (cleanday_key, date, _key)
+        if 'date_from' in params_dict:
+            date_filters.append("FILTER log.date >= @date_from")
+            bind_vars['date_from'] = params_dict['date_from'].isoformat()
+        if 'date_to' in params_dict:
+            date_filters.append("FILTER log.date <= @date_to")
+            bind_vars['date_to'] = params_dict['date_to'].isoformat()
+
+        for name, lookup, attribute in (('user_login', 'user', 'login'),
+                                        ('location_address', 'location', 'address'),
+                                        ('comment_text', 'comment', 'text')):
+            if name in params_dict:
+                lookup_filters.append(f"FILTER CONTAINS(LOWER({lookup}.{attribute}), LOWER(@{name}))")
+                bind_vars[name] = params_dict[name]
+                used_lookups.add(lookup)
+
+        if params_dict.get('search_query', "") != "":
+            lookup_filters.append(
+                "FILTER (CONTAINS(LOWER(comment.text), LOWER(@search_query)) OR "
+                "CONTAINS(LOWER(location.address), LOWER(@search_query)) OR "
+                "CONTAINS(LOWER(user.login), LOWER(@search_query)) OR "
+                "CONTAINS(LOWER(log.type), LOWER(@search_query)) OR "
+                "CONTAINS(LOWER(log.description), LOWER(@search_query)))"
             )
-
-        query = f"""
-            LET cdId = CONCAT("CleanDay/", @cleanday_key)
-            
-            LET count = COUNT(
-                FOR log IN INBOUND cdId relates_to_cleanday
-                    LET user = FIRST(
-                        FOR usr IN OUTBOUND log relates_to_user
-                            LIMIT 1
-                            RETURN MERGE(usr, {{password: "", key: usr._key}})
-                    )
-                    LET comment = FIRST(
-                        FOR comm IN OUTBOUND log relates_to_comment
-                            LIMIT 1
-                            RETURN MERGE(comm, {{key: comm._key}})
-                    )
-                    LET location = FIRST(
-                        FOR loc IN OUTBOUND log relates_to_location
-                            LIMIT 1
-                            RETURN MERGE(loc, {{key: loc._key}})
-                    )
-                    
-                    LET full_log = MERGE(log, {{
-                        user: user,
-                        comment: comment,
+            bind_vars['search_query'] = params_dict['search_query']
+            used_lookups.update(log_lookups)
+
+        # Курсор after выбирает ближайшие более новые записи: они читаются по возрастанию
+        # и переворачиваются, если страница запрошена в обратном порядке
+        cursor_value = params.before or params.after
+        direction = params.sort_order
+        cursor_filters = []
+        if cursor_value is not None:
+            cursor_date, cursor_key = decode_log_cursor(cursor_value)
+            bind_vars["cursor_date"] = cursor_date
+            bind_vars["cursor_key"] = cursor_key
+            operator, direction = ("<", SortOrder.DESC) if params.before is not None else (">", SortOrder.ASC)
+            cursor_filters = [
+                f"FILTER log.date {operator}= @cursor_date",
+                f"FILTER log.date {operator} @cursor_date OR log._key {operator} @cursor_key"
+            ]
+
+        # Записи старше срока хранения лежат в LogArchive: обе части читаются по индексам
+        # в одном порядке, и страница собирается из первых offset + limit записей каждой
+        sources = []
+        counts = []
+        for collection in ('Log', 'LogArchive'):
+            matches = f"""
+                FOR log IN {collection}
+                    FILTER log.cleanday_key == @cleanday_key
+                    {'\n'.join(date_filters)}
+                    {{cursor_filters}}
+                    {'\n'.join(log_filters)}
+                    {'\n'.join(log_lookups[name] for name in log_lookups if name in used_lookups)}
+                    {'\n'.join(lookup_filters)}
+            """
+            counts.append(f"COUNT({matches.replace('{cursor_filters}', '')} RETURN 1)")
+            sources.append(f"""(
+                {matches.replace('{cursor_filters}', '\n'.join(cursor_filters))}
+                    SORT log.date {direction}, log._key {direction}
+                    LIMIT @offset + @limit
+                    {'\n'.join(log_lookups[name] for name in log_lookups if name not in used_lookups)}
+                    RETURN MERGE(UNSET(log, @relation_fields), {{
                         key: log._key,
-                        location: location
-                    }})
-                    
-                    {'\n'.join(filters)}
-                    
-                    RETURN 1
-            )
-            
-            LET page = (
-                FOR log IN INBOUND cdId relates_to_cleanday
-                             
-                    LET user = FIRST(
-                        FOR usr IN OUTBOUND log relates_to_user
-                            LIMIT 1
-                            RETURN MERGE(usr, {{password: "", key: usr._key}})
-                    )
-                    LET comment = FIRST(
-                        FOR comm IN OUTBOUND log relates_to_comment
-                            LIMIT 1
-                            RETURN MERGE(comm, {{key: comm._key}})
-                    )
-                    LET location = FIRST(
-                        FOR loc IN OUTBOUND log relates_to_location
-                            LIMIT 1
-                            RETURN MERGE(loc, {{key: loc._key}})
-                    )
-                    
-                    LET full_log = MERGE(log, {{
                         user: user,
                         comment: comment,
-                        key: log._key,
                         location: location
                     }})
-                    
-                    {'\n'.join(filters)}
-                    
-                    LIMIT @offset, @limit
-                    SORT full_log.{params.sort_by} {params.sort_order}
-                    
-                    RETURN full_log
-            )
-            
-            RETURN {{
-                page: page,
-                count: count
-            }}
-            """
-        print(query)
+            )""")
+
+        count = None
+        if params.before is None and params.after is None:
+            count = self.db.aql.execute(f"RETURN {' + '.join(counts)}", bind_vars={
+                name: value for name, value in bind_vars.items() if name not in ('offset', 'limit')
+            }).next()
 
         cursor = self.db.aql.execute(
-            query,
-            bind_vars=bind_vars
+            f"""
+            FOR log IN UNION({', '.join(sources)})
+                SORT log.date {direction}, log.key {direction}
+                LIMIT @offset, @limit
+                RETURN log
+            """,
+            bind_vars={**bind_vars, "relation_fields": log_relation_fields}
         )
 
-        result_dict = cursor.next()
-        print(result_dict["page"])
-        page = list(map(lambda c: CleandayLog.model_validate(c), result_dict["page"]))
-        return result_dict["count"], page
+        page = [CleandayLog.model_validate(log) for log in cursor]
+        if direction != params.sort_order:
+            page.reverse()
+        return count, page
 
     def get_comments(self, cleanday_key: str, params: GetCommentsParams) -> Optional[Tuple[int, list[GetComment]]]:
         if self.get_raw_by_key(cleanday_key) is None:
@@ -809,12 +887,68 @@ class CleandayRepo:
 
         return DeleteReqResult.SUCCESS
 
+    def sync_requirements(self, cleanday_key: str, names: list[str]) -> Optional[Tuple[list[str], list[str]]]:
+        """Make the cleanday's requirements match `names` with one remove and one insert statement.
+
+        AQL does not allow inserting into a collection after removing from it in the same
+        query, so both run as separate statements in the caller's transaction.
+        Returns keys of the added and removed requirements.
+        """
+        if self.get_raw_by_key(cleanday_key) is None:
+            return None
+
+        bind_vars = {'cleanday_key': cleanday_key, 'names': names}
+
+        removed = list(self.db.aql.execute(
+            """
+            LET cdId = CONCAT("CleanDay/", @cleanday_key)
+
+            FOR req, edge IN OUTBOUND cdId has_requirement
+                FILTER req.name NOT IN @names
+                LET fulfilled = (
+                    FOR f IN fullfills
+                        FILTER f._to == req._id
+                        REMOVE f IN fullfills
+                )
+                REMOVE edge IN has_requirement
+                REMOVE req IN Requirement
+                RETURN req._key
+            """,
+            bind_vars=bind_vars
+        ))
+
+        added = list(self.db.aql.execute(
+            """
+            LET cdId = CONCAT("CleanDay/", @cleanday_key)
+            LET existing = (
+                FOR req IN OUTBOUND cdId has_requirement
+                    RETURN req.name
+            )
+
+            FOR name IN MINUS(UNIQUE(@names), existing)
+                LET req = FIRST(
+                    INSERT {
+                        name: name
+                    } INTO Requirement
+                    RETURN NEW
+                )
+                INSERT {
+                    _from: cdId,
+                    _to: req._id
+                } INTO has_requirement
+                RETURN req._key
+            """,
+            bind_vars=bind_vars
+        ))
+
+        return added, removed
+
     def create_images(self, cleanday_key: str, image_data: list[CreateImage]) -> Optional[int]:
 
         if not self.get_raw_by_key(cleanday_key):
             return None
 
-        image_data = list(map(lambda img: img.model_dump(), image_data))
+        image_data = list(map(lambda img: {"description": img.description, **save_photo(img.photo)}, image_data))
 
         cursor = self.db.aql.execute(
             """
@@ -846,7 +980,10 @@ class CleandayRepo:
             LET cdId = CONCAT("CleanDay/", @cleanday_key)
             
             FOR img IN OUTBOUND cdId cleanday_image
-                RETURN MERGE(img, {key: img._key})
+                RETURN {
+                    key: img._key, description: img.description, hash: img.hash,
+                    size: img.size, width: img.width, height: img.height, content_type: img.content_type
+                }
             """,
             bind_vars={"cleanday_key": cleanday_key}
         )
@@ -854,13 +991,42 @@ class CleandayRepo:
         img_list = []
 
         for row in cursor:
-            img_list.append(Image.model_validate(row))
+            img_list.append(Image.model_validate(load_metadata(row)))
 
         return img_list
 
-    def get_heatmap(self, x_field: CleandayHeatmapField, y_field: CleandayHeatmapField, params: GetCleandaysParams) \
-            -> list[HeatmapEntry]:
-        return util.get_heatmap(self.db, x_field, y_field, params)
+    def get_heatmap(self, x_field: CleandayHeatmapField, y_field: CleandayHeatmapField,
+                    params: CleandayHeatmapQuery) -> list[HeatmapEntry]:
+        filters = cube_filters(CubeKind.CLEANDAY, params,
+                               [(x_field, params.x_bucket), (y_field, params.y_bucket)],
+                               util.cube_in_filters, util.cube_range_filters)
+        if filters is not None:
+            data = HeatmapCubeRepo(self.db).get_heatmap(CubeKind.CLEANDAY, x_field, y_field, filters,
+                                                        params.x_bucket, params.y_bucket)
+        else:
+            data = util.get_heatmap(self.db, x_field, y_field, params)
+
+        return apply_quantiles(data, params.x_bucket, params.y_bucket)
+
+    def get_heatmaps(self, grids: list[HeatmapAxes], params: GetCleandaysParams) -> list[list[HeatmapEntry]]:
+        """Several heatmaps with shared filters: cube-answerable grids are summed, the rest share one scan."""
+        results: list[Optional[list[HeatmapEntry]]] = [None] * len(grids)
+        scanned = []
+        for i, axes in enumerate(grids):
+            filters = cube_filters(CubeKind.CLEANDAY, params,
+                                   [(axes.x_field, axes.x_bucket), (axes.y_field, axes.y_bucket)],
+                                   util.cube_in_filters, util.cube_range_filters)
+            if filters is not None:
+                results[i] = HeatmapCubeRepo(self.db).get_heatmap(CubeKind.CLEANDAY, axes.x_field, axes.y_field,
+                                                                  filters, axes.x_bucket, axes.y_bucket)
+            else:
+                scanned.append(i)
+
+        if scanned:
+            for i, data in zip(scanned, util.get_heatmaps(self.db, [grids[i] for i in scanned], params)):
+                results[i] = data
+
+        return [apply_quantiles(data, axes.x_bucket, axes.y_bucket) for data, axes in zip(results, grids)]
 
 
 if __name__ == "__main__":
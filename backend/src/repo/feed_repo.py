@@ -0,0 +1,64 @@
+from arango.database import StandardDatabase
+
+from data.query import GetFeedParams, FeedLog
+from repo.cleanday_repo import log_lookups, log_relation_fields, decode_log_cursor
+
+
+class FeedRepo:
+    def __init__(self, database: StandardDatabase):
+        self.db = database
+
+    def get_page(self, params: GetFeedParams) -> (list[FeedLog], bool):
+        """Newest logs across all cleandays, older than the `before` cursor, and whether there are more.
+
+        With a city the logs are read from the (city_key, date, _key) index in sort order;
+        the cleanday is looked up only to filter by tags and for the returned logs.
+        """
+        bind_vars = {"limit": params.limit + 1, "relation_fields": log_relation_fields}
+        filters = []
+
+        if params.city_key is not None:
+            filters.append("FILTER log.city_key == @city_key")
+            bind_vars["city_key"] = params.city_key
+
+        if params.cleanday_keys:
+            filters.append("FILTER log.cleanday_key IN @cleanday_keys")
+            bind_vars["cleanday_keys"] = params.cleanday_keys
+
+        if params.before is not None:
+            cursor_date, cursor_key = decode_log_cursor(params.before)
+            filters.append("FILTER log.date <= @cursor_date")
+            filters.append("FILTER log.date < @cursor_date OR log._key < @cursor_key")
+            bind_vars["cursor_date"] = cursor_date
+            bind_vars["cursor_key"] = cursor_key
+
+        cleanday_let = 'LET cd = DOCUMENT(CONCAT("CleanDay/", log.cleanday_key))'
+        tag_filters = []
+        if params.tags:
+            tag_filters = [cleanday_let, "FILTER cd != null AND LENGTH(INTERSECTION(cd.tags, @tags)) > 0"]
+            bind_vars["tags"] = params.tags
+
+        cursor = self.db.aql.execute(
+            f"""
+            FOR log IN Log
+                {'\n'.join(filters)}
+                SORT log.date DESC, log._key DESC
+                {'\n'.join(tag_filters)}
+                LIMIT @limit
+                {cleanday_let if not tag_filters else ''}
+                {'\n'.join(log_lookups.values())}
+                RETURN MERGE(UNSET(log, @relation_fields), {{
+                    key: log._key,
+                    cleanday_key: log.cleanday_key,
+                    cleanday_name: cd.name,
+                    city_key: log.city_key,
+                    user: user,
+                    comment: comment,
+                    location: location
+                }})
+            """,
+            bind_vars=bind_vars
+        )
+
+        page = [FeedLog.model_validate(log) for log in cursor]
+        return page[:params.limit], len(page) > params.limit
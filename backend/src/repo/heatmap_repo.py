@@ -0,0 +1,337 @@
+import hashlib
+import json
+from collections import Counter
+from enum import StrEnum
+from typing import Any, Optional
+
+from arango.database import StandardDatabase
+from pydantic import BaseModel
+
+from data.query import HeatmapEntry
+from repo.bucketing import bucket_expression, parse_bucket
+from repo.version_repo import VersionRepo
+
+CELL_BATCH_SIZE = 10000
+
+# Параметры запроса, которые не влияют на состав тепловой карты
+ignored_params = {'offset', 'limit', 'sort_by', 'sort_order', 'x_field', 'y_field', 'x_bucket', 'y_bucket'}
+
+
+class CubeKind(StrEnum):
+    CLEANDAY = "cleanday"
+    USER = "user"
+
+
+# Поля-списки: сущность попадает в ячейку для каждого элемента списка
+list_fields = {'tags', 'requirements'}
+
+# Измерения куба: только поля с небольшим числом значений. Пары с почти уникальными и текстовыми
+# полями (название, описание, адрес) читали бы из куба столько же ячеек, сколько сущностей,
+# и переписывали бы сотни ячеек при каждом изменении, поэтому они считаются сканированием
+cube_fields = {
+    CubeKind.CLEANDAY: {'status', 'city', 'tags', 'organization', 'begin_date', 'end_date', 'created_at'},
+    CubeKind.USER: {'sex', 'city', 'level'},
+}
+
+# Даты хранятся в кубе с точностью до дня, поэтому куб отвечает по ним только с группировкой
+# по дню, неделе или месяцу и без фильтров по диапазону дат
+cube_day_fields = {'begin_date', 'end_date', 'created_at'}
+cube_date_buckets = {'day', 'week', 'month'}
+
+# Значения измерений тепловых карт (CleandayHeatmapField и UserHeatmapField) для сущностей
+dimension_queries = {
+    CubeKind.CLEANDAY: """
+        FOR cl_day IN CleanDay
+            {key_filter}
+            LET loc = FIRST(FOR loc IN OUTBOUND cl_day in_location LIMIT 1 RETURN loc)
+            LET city = FIRST(FOR city IN OUTBOUND loc in_city LIMIT 1 RETURN city)
+            LET organizer = FIRST(
+                FOR par IN INBOUND cl_day participation_in
+                    FILTER par.type == "Организатор"
+                    LIMIT 1
+                    FOR user IN INBOUND par has_participation
+                        RETURN user
+            )
+            RETURN {{
+                key: cl_day._key,
+                dims: {{
+                    name: cl_day.name,
+                    description: cl_day.description,
+                    participant_count: COUNT(FOR par IN INBOUND cl_day participation_in RETURN 1),
+                    recommended_count: cl_day.recommended_count,
+                    city: city.name,
+                    begin_date: cl_day.begin_date,
+                    end_date: cl_day.end_date,
+                    created_at: cl_day.created_at,
+                    updated_at: cl_day.updated_at,
+                    organization: cl_day.organization,
+                    organizer: organizer.login,
+                    organizer_key: organizer._key,
+                    area: cl_day.area,
+                    status: cl_day.status,
+                    tags: NOT_NULL(cl_day.tags, []),
+                    requirements: (FOR req IN OUTBOUND cl_day has_requirement RETURN req.name),
+                    "location.address": loc.address
+                }}
+            }}
+    """,
+    CubeKind.USER: """
+        FOR u IN User
+            {key_filter}
+            LET city = FIRST(FOR city IN OUTBOUND u lives_in LIMIT 1 RETURN city)
+            LET pars = (FOR p IN OUTBOUND u has_participation RETURN p)
+            RETURN {{
+                key: u._key,
+                dims: {{
+                    first_name: u.first_name,
+                    last_name: u.last_name,
+                    login: u.login,
+                    sex: u.sex,
+                    city: city.name,
+                    about_me: u.about_me,
+                    score: u.score,
+                    level: u.level,
+                    cleanday_count: COUNT(
+                        FOR p IN pars
+                            FOR cl_day IN OUTBOUND p participation_in
+                                RETURN 1
+                    ),
+                    organized_count: COUNT(
+                        FOR p IN pars
+                            FILTER p.type == "Организатор"
+                            FOR cl_day IN OUTBOUND p participation_in
+                                RETURN 1
+                    ),
+                    stat: SUM(pars[*].stat)
+                }}
+            }}
+    """,
+}
+
+dimension_collections = ['CleanDay', 'User', 'Location', 'City', 'Participation', 'Requirement', 'in_location',
+                         'in_city', 'lives_in', 'participation_in', 'has_participation', 'has_requirement']
+
+
+def field_values(dims: dict, field: str) -> list:
+    if field in list_fields:
+        return dims.get(field) or []
+    return [dims.get(field)]
+
+
+def cube_dims(kind: CubeKind, dims: dict) -> dict:
+    """Values of the cube dimensions of one entity, dates truncated to a day."""
+    return {
+        field: str(value)[:10] if field in cube_day_fields and value is not None else value
+        for field, value in dims.items() if field in cube_fields[kind]
+    }
+
+
+def cube_cells(kind: CubeKind, dims: dict) -> Counter:
+    """Cells that one entity contributes to: every unordered pair of cube fields and their values."""
+    dims = cube_dims(kind, dims)
+    fields = sorted(dims.keys())
+    cells = Counter()
+    for i, x_field in enumerate(fields):
+        for y_field in fields[i:]:
+            for x in field_values(dims, x_field):
+                for y in field_values(dims, y_field):
+                    cells[(x_field, y_field, x, y)] += 1
+    return cells
+
+
+def cube_axes(kind: CubeKind, axes: list[tuple[str, Optional[str]]]) -> bool:
+    """Whether the heatmap over these (field, bucket) axes can be read from the cube."""
+    for field, bucket in axes:
+        if field not in cube_fields[kind]:
+            return False
+        if field in cube_day_fields and (bucket is None or parse_bucket(bucket)[0] not in cube_date_buckets):
+            return False
+    return True
+
+
+def cell_document(kind: CubeKind, cell: tuple, count: int) -> dict:
+    x_field, y_field, x, y = cell
+    key = hashlib.sha1(json.dumps([kind, x_field, y_field, x, y], ensure_ascii=False).encode()).hexdigest()
+    return {"_key": key, "kind": kind, "xf": x_field, "yf": y_field, "xv": x, "yv": y, "count": count}
+
+
+def cube_filters(kind: CubeKind, params: BaseModel, axes: list[tuple[str, Optional[str]]], in_filters: dict[str, str],
+                 range_filters: dict[str, tuple[str, str]]) -> Optional[list[tuple[str, str, Any]]]:
+    """Translate heatmap query filters into filters on cube cells.
+
+    `axes` are the (field, bucket) pairs of the two axes. Only axes in the cube and IN
+    and range filters on one of them can be answered from the cube; otherwise None is
+    returned and the heatmap has to be computed by a scan.
+    """
+    if not cube_axes(kind, axes):
+        return None
+    axes = {field for field, _ in axes}
+
+    result = []
+    for name, value in params.model_dump(exclude_none=True, exclude=ignored_params).items():
+        if value == "":
+            continue
+        if name in in_filters and in_filters[name] in axes:
+            result.append((in_filters[name], "IN", value))
+        elif name in range_filters and range_filters[name][0] in axes \
+                and range_filters[name][0] not in cube_day_fields:
+            field, operator = range_filters[name]
+            result.append((field, operator, value.isoformat() if hasattr(value, 'isoformat') else value))
+        else:
+            return None
+    return result
+
+
+class HeatmapCubeRepo:
+
+    def __init__(self, database: StandardDatabase):
+        self.db = database
+
+    def get_dimensions(self, kind: CubeKind, keys: Optional[list[str]] = None):
+        key_filter = "" if keys is None else "FILTER cl_day._key IN @keys" if kind == CubeKind.CLEANDAY \
+            else "FILTER u._key IN @keys"
+        return self.db.aql.execute(
+            dimension_queries[kind].format(key_filter=key_filter),
+            bind_vars={} if keys is None else {"keys": keys},
+            stream=keys is None
+        )
+
+    def apply(self, kind: CubeKind, deltas: Counter):
+        cells = [cell_document(kind, cell, count) for cell, count in deltas.items() if count != 0]
+        for start in range(0, len(cells), CELL_BATCH_SIZE):
+            batch = cells[start:start + CELL_BATCH_SIZE]
+            self.db.aql.execute(
+                """
+                FOR c IN @cells
+                    UPSERT {_key: c._key}
+                    INSERT c
+                    UPDATE {count: OLD.count + c.count}
+                    IN HeatmapCell
+                """,
+                bind_vars={"cells": batch}
+            )
+            self.db.aql.execute(
+                """
+                FOR c IN HeatmapCell
+                    FILTER c._key IN @keys AND c.count <= 0
+                    REMOVE c IN HeatmapCell
+                """,
+                bind_vars={"keys": [c["_key"] for c in batch]}
+            )
+
+    def refresh(self, kind: CubeKind, keys: list[str]):
+        """Recompute the dimensions of the entities and move their counts to the new cells.
+
+        Runs in its own transaction; concurrent refreshes of the same cells fail with a conflict and should be retried.
+        """
+        trans = self.db.begin_transaction(read=dimension_collections,
+                                          write=['HeatmapCell', 'HeatmapMember', 'DataVersion'])
+        try:
+            repo = HeatmapCubeRepo(trans)
+            current = {row['key']: row['dims'] for row in repo.get_dimensions(kind, keys)}
+            stored = {
+                member['key']: member['dims'] for member in trans.aql.execute(
+                    """
+                    FOR m IN HeatmapMember
+                        FILTER m._key IN @member_keys
+                        RETURN m
+                    """,
+                    bind_vars={"member_keys": [f"{kind}:{key}" for key in keys]}
+                )
+            }
+
+            deltas = Counter()
+            for key in keys:
+                if key in stored:
+                    deltas.subtract(cube_cells(kind, stored[key]))
+                if key in current:
+                    deltas.update(cube_cells(kind, current[key]))
+            repo.apply(kind, deltas)
+
+            trans.aql.execute(
+                """
+                FOR key IN @keys
+                    LET member_key = CONCAT(@kind, ":", key)
+                    LET dims = @current[key]
+                    FILTER dims != null
+                    UPSERT {_key: member_key}
+                    INSERT {_key: member_key, kind: @kind, key: key, dims: dims}
+                    UPDATE {dims: dims}
+                    IN HeatmapMember OPTIONS { mergeObjects: false }
+                """,
+                bind_vars={"keys": keys, "kind": kind, "current": current}
+            )
+            trans.aql.execute(
+                """
+                FOR key IN @removed
+                    REMOVE CONCAT(@kind, ":", key) IN HeatmapMember OPTIONS { ignoreErrors: true }
+                """,
+                bind_vars={"removed": [key for key in keys if key not in current], "kind": kind}
+            )
+            # Ответы из куба, закэшированные до обновления, больше не актуальны
+            VersionRepo(trans).bump_data()
+        except Exception as e:
+            trans.abort_transaction()
+            raise e
+        else:
+            trans.commit_transaction()
+
+    def rebuild(self):
+        """Rebuild both cubes from scratch."""
+        trans = self.db.begin_transaction(read=dimension_collections, exclusive=['HeatmapCell', 'HeatmapMember'])
+        try:
+            trans.aql.execute("FOR c IN HeatmapCell REMOVE c IN HeatmapCell")
+            trans.aql.execute("FOR m IN HeatmapMember REMOVE m IN HeatmapMember")
+
+            repo = HeatmapCubeRepo(trans)
+            for kind in CubeKind:
+                cells = Counter()
+                members = []
+                for row in repo.get_dimensions(kind):
+                    cells.update(cube_cells(kind, row['dims']))
+                    members.append({"_key": f"{kind}:{row['key']}", "kind": kind, "key": row['key'],
+                                    "dims": row['dims']})
+                    if len(members) >= CELL_BATCH_SIZE:
+                        trans.collection('HeatmapMember').insert_many(members, silent=True)
+                        members.clear()
+                if members:
+                    trans.collection('HeatmapMember').insert_many(members, silent=True)
+
+                documents = [cell_document(kind, cell, count) for cell, count in cells.items()]
+                for start in range(0, len(documents), CELL_BATCH_SIZE):
+                    trans.collection('HeatmapCell').insert_many(documents[start:start + CELL_BATCH_SIZE], silent=True)
+        except Exception as e:
+            trans.abort_transaction()
+            raise e
+        else:
+            trans.commit_transaction()
+
+    def get_heatmap(self, kind: CubeKind, x_field: str, y_field: str, filters: list[tuple[str, str, Any]],
+                    x_bucket: Optional[str] = None, y_bucket: Optional[str] = None) -> list[HeatmapEntry]:
+        # Ячейки хранятся для упорядоченной пары полей, при обратном порядке оси меняются местами
+        swapped = x_field > y_field
+        stored_x, stored_y = (y_field, x_field) if swapped else (x_field, y_field)
+
+        bind_vars = {"kind": kind, "xf": stored_x, "yf": stored_y}
+        conditions = []
+        for i, (field, operator, value) in enumerate(filters):
+            bind_vars[f"filter_{i}"] = value
+            for attribute, axis in (("xv", stored_x), ("yv", stored_y)):
+                if axis == field:
+                    conditions.append(f"FILTER c.{attribute} {operator} @filter_{i}")
+
+        x_label, y_label = ("y", "x") if swapped else ("x", "y")
+        stored_x_bucket, stored_y_bucket = (y_bucket, x_bucket) if swapped else (x_bucket, y_bucket)
+        cursor = self.db.aql.execute(
+            f"""
+            FOR c IN HeatmapCell
+                FILTER c.kind == @kind AND c.xf == @xf AND c.yf == @yf
+                {'\n'.join(conditions)}
+                COLLECT x = {bucket_expression("c.xv", stored_x_bucket)}, y = {bucket_expression("c.yv", stored_y_bucket)}
+                AGGREGATE count = SUM(c.count)
+                RETURN {{ x_label: {x_label}, y_label: {y_label}, count: count }}
+            """,
+            bind_vars=bind_vars
+        )
+
+        return [HeatmapEntry.model_validate(doc) for doc in cursor]
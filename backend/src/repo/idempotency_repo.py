@@ -0,0 +1,55 @@
+import time
+from typing import Optional, Any
+
+from arango.database import StandardDatabase
+
+from repo.model import IdempotentResponse
+
+
+class IdempotencyRepo:
+
+    def __init__(self, database: StandardDatabase):
+        self.db = database
+
+    def get(self, key: str) -> Optional[IdempotentResponse]:
+        cursor = self.db.aql.execute(
+            """
+            LET record = DOCUMENT(CONCAT("IdempotencyKey/", @key))
+            FILTER record != null AND record.expires_at > @now
+            RETURN record
+            """,
+            bind_vars={"key": key, "now": time.time()}
+        )
+
+        if cursor.empty():
+            return None
+
+        return IdempotentResponse.model_validate(cursor.next())
+
+    def create(self, key: str, request_hash: str, response: Any, ttl: int) -> None:
+        """Store the response; an expired entry that the TTL index has not removed yet is replaced.
+
+        Raises a unique constraint violation if a live entry with the key exists, e.g. one
+        written by a parallel transaction.
+        """
+        now = time.time()
+        # Фильтр находит только истёкшую запись; при живой записи с тем же _key вставка падает
+        self.db.aql.execute(
+            """
+            UPSERT FILTER CURRENT._key == @key AND CURRENT.expires_at <= @now
+            INSERT {
+                _key: @key,
+                request_hash: @request_hash,
+                response: @response,
+                expires_at: @expires_at
+            }
+            REPLACE {
+                request_hash: @request_hash,
+                response: @response,
+                expires_at: @expires_at
+            }
+            IN IdempotencyKey
+            """,
+            bind_vars={"key": key, "request_hash": request_hash, "response": response,
+                       "now": now, "expires_at": now + ttl}
+        )
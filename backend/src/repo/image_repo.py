@@ -0,0 +1,65 @@
+from typing import Optional
+
+from arango.database import StandardDatabase
+
+
+class ImageRepo:
+
+    def __init__(self, database: StandardDatabase):
+        self.db = database
+
+    def get_content_type(self, blob_hash: str) -> Optional[str]:
+        cursor = self.db.aql.execute(
+            """
+            FOR img IN Image
+                FILTER img.hash == @hash
+                LIMIT 1
+                RETURN img.content_type
+            """,
+            bind_vars={"hash": blob_hash}
+        )
+
+        if cursor.empty():
+            return None
+
+        return cursor.next()
+
+    def has_variants(self, blob_hash: str) -> bool:
+        cursor = self.db.aql.execute(
+            """
+            FOR v IN ImageVariant
+                FILTER v.original == @hash
+                LIMIT 1
+                RETURN 1
+            """,
+            bind_vars={"hash": blob_hash}
+        )
+
+        return not cursor.empty()
+
+    def create_variants(self, blob_hash: str, variants: list[dict]):
+        self.db.aql.execute(
+            """
+            FOR v IN @variants
+                INSERT MERGE(v, {original: @hash}) INTO ImageVariant OPTIONS { ignoreErrors: true }
+            """,
+            bind_vars={"hash": blob_hash, "variants": variants}
+        )
+
+    def get_variant(self, blob_hash: str, size: int) -> Optional[dict]:
+        """Find the smallest variant that is at least `size` pixels on its longer side."""
+        cursor = self.db.aql.execute(
+            """
+            FOR v IN ImageVariant
+                FILTER v.original == @hash AND v.size >= @size
+                SORT v.size
+                LIMIT 1
+                RETURN {hash: v.hash, content_type: v.content_type}
+            """,
+            bind_vars={"hash": blob_hash, "size": size}
+        )
+
+        if cursor.empty():
+            return None
+
+        return cursor.next()
@@ -5,7 +5,9 @@ from arango.database import StandardDatabase
 from data.entity import Location, Image
 from data.query import GetLocationsParams, GetLocation, CreateLocation
 from repo.client import database
-from repo.model import CreateImage
+from repo.model import CreateImage, EntityVersion
+from repo.version_repo import VersionRepo
+from storage.image import save_photo, load_metadata
 
 
 class LocationRepo:
@@ -98,6 +100,21 @@ class LocationRepo:
 
         return Location.model_validate(cursor.next())
 
+    def get_version(self, loc_key: str) -> Optional[EntityVersion]:
+        cursor = self.db.aql.execute(
+            """
+            LET loc = DOCUMENT(CONCAT("Location/", @loc_key))
+            FILTER loc != null
+            RETURN {tag: loc._rev, modified_at: loc.modified_at}
+            """,
+            bind_vars={"loc_key": loc_key}
+        )
+
+        if cursor.empty():
+            return None
+
+        return EntityVersion.model_validate(cursor.next())
+
     def get_raw_by_key(self, loc_key: str) -> Optional[Location]:
         cursor = self.db.aql.execute(
             """
@@ -141,7 +158,7 @@ class LocationRepo:
         if not self.get_raw_by_key(loc_key):
             return None
 
-        image_data = list(map(lambda img: img.model_dump(), image_data))
+        image_data = list(map(lambda img: {"description": img.description, **save_photo(img.photo)}, image_data))
 
         cursor = self.db.aql.execute(
             """
@@ -162,6 +179,9 @@ class LocationRepo:
             bind_vars={"loc_key": loc_key, "image_data": image_data},
         )
 
+        # Изображения не пишут лог, поэтому версию локации меняем явно
+        VersionRepo(self.db).bump('Location', [loc_key])
+
         return cursor.next()
 
     def get_images(self, loc_key: str) -> Optional[list[Image]]:
@@ -173,7 +193,10 @@ class LocationRepo:
             LET locId = CONCAT("Location/", @loc_key)
 
             FOR img IN OUTBOUND locId location_image
-                RETURN MERGE(img, {key: img._key})
+                RETURN {
+                    key: img._key, description: img.description, hash: img.hash,
+                    size: img.size, width: img.width, height: img.height, content_type: img.content_type
+                }
             """,
             bind_vars={"loc_key": loc_key}
         )
@@ -181,7 +204,7 @@ class LocationRepo:
         img_list = []
 
         for row in cursor:
-            img_list.append(Image.model_validate(row))
+            img_list.append(Image.model_validate(load_metadata(row)))
 
         return img_list
 
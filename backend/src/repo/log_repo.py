@@ -1,10 +1,12 @@
-from datetime import datetime
+from datetime import datetime, UTC
 
 from arango.database import StandardDatabase
 
+from config.environment import LOG_RELATION_EDGES
 from data.entity import Log
 from repo.client import database
 from repo.model import CreateLog, LogRelations
+from repo.version_repo import versioned_collections
 
 edge_collections = {
     'cleanday_key': 'relates_to_cleanday',
@@ -22,35 +24,69 @@ collection_names = {
     'city_key': 'City'
 }
 
+# Город субботника @cleanday_key
+cleanday_city_query = """FIRST(
+                FOR loc IN OUTBOUND CONCAT("CleanDay/", @cleanday_key) in_location
+                    FOR c IN OUTBOUND loc in_city
+                        LIMIT 1
+                        RETURN c._key
+            )"""
+
+# События создания сущностей не архивируются: по ним восстанавливаются даты и счётчики
+ARCHIVE_KEPT_PREFIX = "Create"
+
+ARCHIVE_BATCH_SIZE = 1000
+
 
 class LogRepo:
 
     def __init__(self, database: StandardDatabase):
         self.db = database
+        # Сущности, к которым относятся созданные записи: коллекция -> ключи.
+        # Их версии меняются после коммита (task.versions.schedule_bump), иначе параллельные
+        # записи одного субботника конфликтовали бы на его документе
+        self.versioned: dict[str, set[str]] = {}
 
     def create(self, log: CreateLog) -> Log:
         log_data = log.model_dump()
         log_data.pop('keys')
         log_data['date'] = log_data['date'].isoformat()
-        bind_vars = {"data": log_data}
 
+        # Ключи связанных документов хранятся в самой записи и индексированы
         relation_keys = log.keys.model_dump(exclude_none=True)
+        log_data.update(relation_keys)
+        bind_vars = {"data": log_data}
+
         aql_insert = []
 
         for key in relation_keys.keys():
-            aql_insert.append(
-                f"""
-                INSERT {{
-                    _from: log._id,
-                    _to: CONCAT("{collection_names[key]}/", @{key}),
-                }} INTO {edge_collections[key]}
-                """
-            )
-            bind_vars[key] = relation_keys[key]
+            if LOG_RELATION_EDGES:
+                aql_insert.append(
+                    f"""
+                    INSERT {{
+                        _from: log._id,
+                        _to: CONCAT("{collection_names[key]}/", @{key}),
+                        date: @log_date
+                    }} INTO {edge_collections[key]}
+                    """
+                )
+                bind_vars[key] = relation_keys[key]
+                bind_vars["log_date"] = log_data['date']
+
+            # Любое событие сущности меняет её версию, по которой строится ETag
+            if key in versioned_collections:
+                self.versioned.setdefault(versioned_collections[key], set()).add(relation_keys[key])
+
+        # События субботника получают город его места проведения, по нему строится лента города
+        city_let = "LET city_key = null"
+        if 'cleanday_key' in relation_keys and 'city_key' not in relation_keys:
+            city_let = f"LET city_key = {cleanday_city_query}"
+            bind_vars["cleanday_key"] = relation_keys['cleanday_key']
 
         query = f"""
+            {city_let}
             LET log = FIRST(
-                INSERT @data INTO Log
+                INSERT city_key == null ? @data : MERGE(@data, {{city_key: city_key}}) INTO Log
                 RETURN NEW
             )
             
@@ -66,6 +102,54 @@ class LogRepo:
 
         return Log.model_validate(cursor.next())
 
+    def archive(self, before: datetime) -> int:
+        """Move logs older than `before`, except creation events, to LogArchive in batches.
+
+        Archived logs keep their key, date and relation keys; relates_to_* edges, if any,
+        are removed together with the logs.
+        """
+        archived = 0
+        while True:
+            trans = self.db.begin_transaction(read=['Log', *edge_collections.values()],
+                                              write=['Log', 'LogArchive', *edge_collections.values()])
+            try:
+                batch = list(trans.aql.execute(
+                    """
+                    FOR log IN Log
+                        FILTER log.date < @before AND NOT STARTS_WITH(log.type, @kept_prefix)
+                        LIMIT @batch_size
+                        RETURN MERGE(UNSET(log, "_id", "_rev"), {archived_at: @now})
+                    """,
+                    bind_vars={
+                        "before": before.isoformat(),
+                        "kept_prefix": ARCHIVE_KEPT_PREFIX,
+                        "batch_size": ARCHIVE_BATCH_SIZE,
+                        "now": datetime.now(UTC).isoformat()
+                    }
+                ))
+
+                if batch:
+                    trans.collection('LogArchive').insert_many(batch, silent=True)
+                    ids = [f"Log/{log['_key']}" for log in batch]
+                    for edge in edge_collections.values():
+                        trans.aql.execute(
+                            f"FOR e IN {edge} FILTER e._from IN @ids REMOVE e IN {edge}",
+                            bind_vars={"ids": ids}
+                        )
+                    trans.aql.execute(
+                        "FOR key IN @keys REMOVE key IN Log",
+                        bind_vars={"keys": [log['_key'] for log in batch]}
+                    )
+            except Exception as e:
+                trans.abort_transaction()
+                raise e
+            else:
+                trans.commit_transaction()
+
+            archived += len(batch)
+            if len(batch) < ARCHIVE_BATCH_SIZE:
+                return archived
+
 
 if __name__ == '__main__':
     repo = LogRepo(database)
@@ -6,8 +6,15 @@ from data.entity import Sex, CleanDayTag
 from data.query import GetUsersParams, CreateCleanday, CreateLocation
 from repo.city_repo import CityRepo
 from repo.client import database
+from repo.heatmap_repo import HeatmapCubeRepo
+from repo.log_repo import edge_collections as log_edge_collections, cleanday_city_query
+from repo.rollup_repo import RollupRepo
+from repo.stat_repo import StatRepo
 from api import auth, user, cleanday, location
 from repo.user_repo import UserRepo
+from storage.blob_store import get_blob_store
+from storage.image import save_photo, read_dimensions
+from storage.variants import schedule_variants
 
 document_collections = ['City', 'CleanDay', 'Comment', 'Image', 'Location', 'Log', 'Participation',
                         'Requirement', 'User']
@@ -19,15 +26,519 @@ edge_collections = ['authored', 'cleanday_image', 'fullfills', 'has_comment', 'h
 
 edge_collections2 = ['relates_to_comment']
 
+timestamp_indexes = {
+    'CleanDay': ['created_at', 'updated_at'],
+    'User': ['created_at', 'updated_at']
+}
+
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+def has_index(collection: str, name: str) -> bool:
+    return any(index.get('name') == name for index in database.collection(collection).indexes())
+
+
 async def apply():
     logger.info(' Applying migrations...')
-    await migration_1()
+    created = await migration_1()
     await migration_2()
+    await migration_3()
+    await migration_4()
+    await migration_5()
+    await migration_6()
+    await migration_7()
+    await migration_8()
+    await migration_9()
+    await migration_10()
+    rollup_created = await migration_11()
+    await migration_12()
+    await migration_13()
+    await migration_14()
+    await migration_15()
+    await migration_16()
+    await migration_17()
+    await migration_18()
+    await migration_19()
+    await migration_20()
+    await migration_21()
+
+    # Корзины восстанавливаются по журналу и его архиву с ключами субботников в самих записях,
+    # поэтому только после создания LogArchive и переноса ключей с рёбер (миграции 16 и 17)
+    if rollup_created:
+        RollupRepo(database).rebuild()
+
+    # Тестовые данные создаются через обработчики API, поэтому заполняем базу
+    # только после того, как применены все миграции схемы
+    if created:
+        await seed()
+        # Обработчики обновляют кубы в фоне, после заполнения пересчитываем их целиком
+        HeatmapCubeRepo(database).rebuild()
+
+
+async def migration_21():
+    logger.info(' [21] Applying...')
+    if has_index('DailyRollup', 'idx_daily_rollup_shard'):
+        logger.info(' [21] Rollup shard index exists, aborting migration')
+        return
+
+    # Корзина дня теперь разложена по частям; прежние документы остаются частью без номера
+    collection = database.collection('DailyRollup')
+    if has_index('DailyRollup', 'idx_daily_rollup_bucket'):
+        collection.delete_index('idx_daily_rollup_bucket')
+    collection.add_index({
+        'type': 'persistent',
+        'fields': ['tag', 'city_key', 'day', 'shard'],
+        'unique': True,
+        'name': 'idx_daily_rollup_shard'
+    })
+
+
+async def migration_20():
+    logger.info(' [20] Applying...')
+    # Прежняя миграция 3 подставляла DATE_ISO8601 ("...123Z") вместо isoformat ("...123000+00:00")
+    for collection in timestamp_indexes:
+        database.aql.execute(
+            """
+            FOR doc IN @@collection
+                FILTER LIKE(doc.created_at, "%Z") OR LIKE(doc.updated_at, "%Z")
+                LET created_at = LIKE(doc.created_at, "%Z")
+                    ? CONCAT(LEFT(doc.created_at, LENGTH(doc.created_at) - 1), "000+00:00") : doc.created_at
+                LET updated_at = LIKE(doc.updated_at, "%Z")
+                    ? CONCAT(LEFT(doc.updated_at, LENGTH(doc.updated_at) - 1), "000+00:00") : doc.updated_at
+                UPDATE doc WITH {created_at: created_at, updated_at: updated_at} IN @@collection
+            """,
+            bind_vars={"@collection": collection}
+        )
+
+
+async def migration_19():
+    logger.info(' [19] Applying...')
+    # Куб прежнего формата содержал пары всех измерений, в том числе (name, name)
+    outdated = database.aql.execute(
+        """
+        FOR c IN HeatmapCell
+            FILTER c.kind == "cleanday" AND c.xf == "name"
+            LIMIT 1
+            RETURN 1
+        """
+    )
+    if outdated.empty():
+        logger.info(' [19] Cube is up to date, aborting migration')
+        return
+
+    # Куб хранит только измерения с небольшим числом значений, даты с точностью до дня
+    HeatmapCubeRepo(database).rebuild()
+
+
+async def migration_18():
+    logger.info(' [18] Applying...')
+    if has_index('Log', 'idx_log_city_date'):
+        logger.info(' [18] Index exists, aborting migration')
+        return
+
+    # Лента города читается по индексу (city_key, date), события субботников получают его город
+    database.aql.execute(
+        f"""
+        FOR log IN Log
+            FILTER log.cleanday_key != null AND log.city_key == null
+            LET city_key = {cleanday_city_query.replace('@cleanday_key', 'log.cleanday_key')}
+            FILTER city_key != null
+            UPDATE log WITH {{city_key: city_key}} IN Log
+        """
+    )
+    database.collection('Log').add_index({
+        'type': 'persistent',
+        'fields': ['city_key', 'date', '_key'],
+        'name': 'idx_log_city_date'
+    })
+
+
+async def migration_17():
+    logger.info(' [17] Applying...')
+    if has_index('Log', 'idx_log_cleanday'):
+        logger.info(' [17] Indexes exist, aborting migration')
+        return
+
+    # Ключи связанных документов переносятся с рёбер relates_to_* в саму запись журнала
+    relation_keys = ", ".join(
+        f"{key}: FIRST(FOR e IN {edge} FILTER e._from == log._id LIMIT 1 RETURN PARSE_IDENTIFIER(e._to).key)"
+        for key, edge in log_edge_collections.items()
+    )
+    database.aql.execute(
+        f"""
+        FOR log IN Log
+            UPDATE log WITH {{{relation_keys}}} IN Log OPTIONS {{ keepNull: false }}
+        """
+    )
+
+    logs = database.collection('Log')
+    logs.add_index({
+        'type': 'persistent',
+        'fields': ['cleanday_key', 'date', '_key'],
+        'name': 'idx_log_cleanday'
+    })
+    logs.add_index({
+        'type': 'persistent',
+        'fields': ['user_key', 'date'],
+        'name': 'idx_log_user'
+    })
+    for key in ('comment_key', 'location_key', 'city_key'):
+        logs.add_index({
+            'type': 'persistent',
+            'fields': [key],
+            'sparse': True,
+            'name': f'idx_log_{key}'
+        })
+
+
+async def migration_16():
+    logger.info(' [16] Applying...')
+    if database.has_collection('LogArchive'):
+        logger.info(' [16] Collections exist, aborting migration')
+        return
+
+    archive = database.create_collection('LogArchive')
+    archive.add_index({
+        'type': 'persistent',
+        'fields': ['cleanday_key', 'date', '_key'],
+        'name': 'idx_log_archive_cleanday'
+    })
+    archive.add_index({
+        'type': 'persistent',
+        'fields': ['user_key', 'date'],
+        'name': 'idx_log_archive_user'
+    })
+    archive.add_index({
+        'type': 'persistent',
+        'fields': ['type', 'date'],
+        'name': 'idx_log_archive_type'
+    })
+    # Задача архивации выбирает старые записи по дате
+    database.collection('Log').add_index({
+        'type': 'persistent',
+        'fields': ['date'],
+        'name': 'idx_log_date'
+    })
+
+
+async def migration_15():
+    logger.info(' [15] Applying...')
+    if has_index('relates_to_cleanday', 'idx_relates_to_cleanday_date'):
+        logger.info(' [15] Index exists, aborting migration')
+        return
+
+    # Журнал субботника читается по индексу в порядке дат, для этого дата события хранится на ребре
+    database.aql.execute(
+        """
+        FOR e IN relates_to_cleanday
+            FILTER e.date == null
+            LET log = DOCUMENT(e._from)
+            UPDATE e WITH {date: log.date} IN relates_to_cleanday
+        """
+    )
+    database.collection('relates_to_cleanday').add_index({
+        'type': 'persistent',
+        'fields': ['_to', 'date', '_from'],
+        'name': 'idx_relates_to_cleanday_date'
+    })
+
+
+async def migration_14():
+    logger.info(' [14] Applying...')
+    if database.has_collection('DataVersion'):
+        logger.info(' [14] Collections exist, aborting migration')
+        return
+
+    database.create_collection('DataVersion')
+
+
+async def migration_13():
+    logger.info(' [13] Applying...')
+    if has_index('CleanDay', 'idx_cleanday_status'):
+        logger.info(' [13] Indexes exist, aborting migration')
+        return
+
+    # Фильтры тепловых карт и списков по статусу и дате начала применяются прямо к индексу
+    cleandays = database.collection('CleanDay')
+    cleandays.add_index({
+        'type': 'persistent',
+        'fields': ['status', 'begin_date'],
+        'name': 'idx_cleanday_status'
+    })
+    cleandays.add_index({
+        'type': 'persistent',
+        'fields': ['begin_date'],
+        'name': 'idx_cleanday_begin_date'
+    })
+
+
+async def migration_12():
+    logger.info(' [12] Applying...')
+    if database.has_collection('HeatmapCell'):
+        logger.info(' [12] Collections exist, aborting migration')
+        return
+
+    cells = database.create_collection('HeatmapCell')
+    cells.add_index({
+        'type': 'persistent',
+        'fields': ['kind', 'xf', 'yf'],
+        'name': 'idx_heatmap_cell_axes'
+    })
+    database.create_collection('HeatmapMember')
+    HeatmapCubeRepo(database).rebuild()
+
+
+async def migration_11() -> bool:
+    logger.info(' [11] Applying...')
+    if database.has_collection('DailyRollup'):
+        logger.info(' [11] Collections exist, aborting migration')
+        return False
+
+    collection = database.create_collection('DailyRollup')
+    collection.add_index({
+        'type': 'persistent',
+        'fields': ['tag', 'city_key', 'day'],
+        'unique': True,
+        'name': 'idx_daily_rollup_bucket'
+    })
+    collection.add_index({
+        'type': 'persistent',
+        'fields': ['tag', 'day'],
+        'name': 'idx_daily_rollup_day'
+    })
+    # Корзины за прошедшие дни восстанавливаются по журналу событий в apply()
+    return True
+
+
+async def migration_10():
+    logger.info(' [10] Applying...')
+    if database.has_collection('Stats'):
+        logger.info(' [10] Collections exist, aborting migration')
+        return
+
+    database.create_collection('Stats')
+    # Начальные значения счётчиков считаем по существующим данным
+    StatRepo(database).reconcile()
+
+
+async def migration_9():
+    logger.info(' [9] Applying...')
+    if database.has_collection('BackupCheckpoint'):
+        logger.info(' [9] Collections exist, aborting migration')
+        return
+
+    collection = database.create_collection('BackupCheckpoint')
+    collection.add_index({
+        'type': 'persistent',
+        'fields': ['date'],
+        'name': 'idx_backup_checkpoint_date'
+    })
+
+
+async def migration_8():
+    logger.info(' [8] Applying...')
+    if has_index('Location', 'idx_location_version'):
+        logger.info(' [8] Indexes exist, aborting migration')
+        return
+
+    # Начальные версии для ETag; время изменения берём из updated_at, если оно есть
+    for collection in ['CleanDay', 'User', 'Location']:
+        database.aql.execute(
+            f"""
+            FOR doc IN {collection}
+                FILTER doc.version == null
+                UPDATE doc WITH {{
+                    version: 0,
+                    modified_at: NOT_NULL(doc.updated_at, DATE_ISO8601(DATE_NOW()))
+                }} IN {collection}
+            """
+        )
+        # Индекс создаётся после заполнения и отмечает, что миграция применена
+        database.collection(collection).add_index({
+            'type': 'persistent',
+            'fields': ['version'],
+            'name': f'idx_{collection.lower()}_version'
+        })
+
+
+async def migration_7():
+    logger.info(' [7] Applying...')
+    if database.has_collection('ImageVariant'):
+        logger.info(' [7] Collections exist, aborting migration')
+        return
+
+    collection = database.create_collection('ImageVariant')
+    collection.add_index({
+        'type': 'persistent',
+        'fields': ['original', 'size'],
+        'unique': True,
+        'name': 'idx_image_variant_original_size'
+    })
+
+    # Копии для уже загруженных изображений строятся в фоне после старта
+    cursor = database.aql.execute(
+        """
+        FOR img IN Image
+            FILTER img.hash != null
+            RETURN DISTINCT img.hash
+        """
+    )
+    for blob_hash in cursor:
+        schedule_variants(blob_hash)
+
+
+async def migration_6():
+    logger.info(' [6] Applying...')
+    if has_index('Image', 'idx_image_dimensions'):
+        logger.info(' [6] Dimensions index exists, aborting migration')
+        return
+
+    # Размеры изображений, загруженных до появления полей width/height
+    images = database.collection('Image')
+    cursor = database.aql.execute(
+        """
+        FOR img IN Image
+            FILTER img.hash != null AND NOT HAS(img, "width")
+            RETURN {_key: img._key, hash: img.hash}
+        """,
+        batch_size=100
+    )
+
+    updated = 0
+    for img in cursor:
+        if get_blob_store().size(img['hash']) is None:
+            logger.warning(f' [6] Blob of image {img["_key"]} is missing, skipping')
+            continue
+
+        width, height = read_dimensions(get_blob_store().read(img['hash']))
+        images.update({'_key': img['_key'], 'width': width, 'height': height})
+        updated += 1
+
+    logger.info(f' [6] Filled dimensions of {updated} images')
+
+    # Индекс по хешу создаёт миграция 5, поэтому отметкой о применении служит собственный индекс
+    images.add_index({
+        'type': 'persistent',
+        'fields': ['width', 'height'],
+        'sparse': True,
+        'name': 'idx_image_dimensions'
+    })
+
+
+async def migration_5():
+    logger.info(' [5] Applying...')
+    if has_index('Image', 'idx_image_hash'):
+        logger.info(' [5] Image hash index exists, aborting migration')
+        return
+
+    # Переносим байты изображений из документов в хранилище блобов
+    images = database.collection('Image')
+    cursor = database.aql.execute(
+        """
+        FOR img IN Image
+            FILTER img.photo != null AND img.hash == null
+            RETURN {_key: img._key, photo: img.photo}
+        """,
+        batch_size=100
+    )
+
+    moved = 0
+    for img in cursor:
+        try:
+            metadata = save_photo(img['photo'])
+        except ValueError:
+            logger.warning(f' [5] Image {img["_key"]} has invalid data, skipping')
+            continue
+
+        images.update({'_key': img['_key'], 'photo': None, **metadata}, keep_none=False)
+        moved += 1
+
+    logger.info(f' [5] Moved {moved} images to the blob store')
+
+    images.add_index({
+        'type': 'persistent',
+        'fields': ['hash'],
+        'sparse': True,
+        'name': 'idx_image_hash'
+    })
+
+
+async def migration_4():
+    logger.info(' [4] Applying...')
+    if database.has_collection('IdempotencyKey'):
+        logger.info(' [4] Collections exist, aborting migration')
+        return
+
+    collection = database.create_collection('IdempotencyKey')
+    collection.add_index({
+        'type': 'ttl',
+        'fields': ['expires_at'],
+        'expireAfter': 0,
+        'name': 'idx_idempotency_key_expires_at'
+    })
+
+
+async def migration_3():
+    logger.info(' [3] Applying...')
+    if has_index('CleanDay', 'idx_cleanday_created_at'):
+        logger.info(' [3] Timestamp indexes exist, aborting migration')
+        return
+
+    database.aql.execute(
+        """
+        FOR cl_day IN CleanDay
+            FILTER cl_day.created_at == null
+            LET created_at = NOT_NULL(FIRST(
+                FOR log IN INBOUND cl_day relates_to_cleanday
+                    FILTER log.type == "CreateCleanday"
+                    LIMIT 1
+                    RETURN log.date
+            ), @now)
+            LET updated_at = NOT_NULL(FIRST(
+                FOR log IN INBOUND cl_day relates_to_cleanday
+                    FILTER log.type == "UpdateCleanday"
+                    SORT log.date DESC
+                    LIMIT 1
+                    RETURN log.date
+            ), created_at)
+            UPDATE cl_day WITH {created_at: created_at, updated_at: updated_at} IN CleanDay
+        """,
+        # Та же запись, что и у обработчиков (datetime.isoformat), иначе строки с "Z" и "+00:00"
+        # сравниваются в фильтрах по диапазону неверно
+        bind_vars={"now": datetime.now(UTC).isoformat()}
+    )
+
+    database.aql.execute(
+        """
+        FOR u IN User
+            FILTER u.created_at == null
+            LET created_at = NOT_NULL(FIRST(
+                FOR log IN INBOUND u relates_to_user
+                    FILTER log.type == "CreateUser"
+                    LIMIT 1
+                    RETURN log.date
+            ), @now)
+            LET updated_at = NOT_NULL(FIRST(
+                FOR log IN INBOUND u relates_to_user
+                    FILTER log.type == "UpdateUser"
+                    SORT log.date DESC
+                    LIMIT 1
+                    RETURN log.date
+            ), created_at)
+            UPDATE u WITH {created_at: created_at, updated_at: updated_at} IN User
+        """,
+        bind_vars={"now": datetime.now(UTC).isoformat()}
+    )
+
+    for collection, fields in timestamp_indexes.items():
+        for field in fields:
+            database.collection(collection).add_index({
+                'type': 'persistent',
+                'fields': [field],
+                'name': f'idx_{collection.lower()}_{field}'
+            })
 
 
 async def migration_2():
@@ -40,11 +551,11 @@ async def migration_2():
         database.create_collection(collection, edge=True)
 
 
-async def migration_1():
+async def migration_1() -> bool:
     logger.info(' [1] Applying...')
     if database.has_collection(document_collections[0]):
         logger.info(' [1] Collections exist, aborting migration')
-        return
+        return False
 
     for collection in document_collections:
         database.create_collection(collection)
@@ -67,6 +578,12 @@ async def migration_1():
 
     user_col.configure(computed_values=computed_values)
 
+    return True
+
+
+async def seed():
+    logger.info(' Seeding database...')
+
     trans = database.begin_transaction(
         read=document_collections+edge_collections,
         write=document_collections+edge_collections,
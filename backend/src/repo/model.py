@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import Optional
+from typing import Optional, Any
 
 from pydantic import BaseModel
 
@@ -88,3 +88,16 @@ class RepoStats(BaseModel):
     cleanday_count: int
     past_cleanday_count: int
     cleanday_metric: int
+    # Время последнего изменения счётчиков и последнего полного пересчёта
+    updated_at: Optional[datetime] = None
+    reconciled_at: Optional[datetime] = None
+
+
+class IdempotentResponse(BaseModel):
+    request_hash: str
+    response: Any
+
+
+class EntityVersion(BaseModel):
+    tag: str
+    modified_at: Optional[datetime] = None
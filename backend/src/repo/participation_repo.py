@@ -137,41 +137,52 @@ class ParticipationRepo:
         if participation is None:
             return SetReqResult.PARTICIPATION_DOES_NOT_EXIST
 
-        requirements = self.cleanday_repo.get_raw_requirements(cleanday_key)
-        existing_req_keys = set(map(lambda req: req.key, requirements))
-
-        print(existing_req_keys)
-
-        for key in requirement_keys:
-            if key not in existing_req_keys:
-                return SetReqResult.REQUIREMENT_DOES_NOT_EXIST
+        bind_vars = {"par_key": participation.key, "cleanday_key": cleanday_key, "req_keys": requirement_keys}
 
+        # AQL не позволяет вставлять в коллекцию после удаления из неё в том же запросе,
+        # поэтому удаление и вставка выполняются отдельными запросами в транзакции вызывающего
         cursor = self.db.aql.execute(
             """
             LET parId = CONCAT("Participation/", @par_key)
-            
-            FOR edge IN fullfills
-                FILTER edge._from == parId
-                REMOVE edge IN fullfills
-            
-            
+            LET cdId = CONCAT("CleanDay/", @cleanday_key)
+            LET req_keys = UNIQUE(@req_keys)
+
+            LET cleanday_req_keys = (
+                FOR req IN OUTBOUND cdId has_requirement
+                    RETURN req._key
+            )
+            LET valid = LENGTH(MINUS(req_keys, cleanday_req_keys)) == 0
+
+            LET removed = (
+                FOR req, edge IN OUTBOUND parId fullfills
+                    FILTER valid AND req._key NOT IN req_keys
+                    REMOVE edge IN fullfills
+                    RETURN req._key
+            )
+
+            RETURN valid
             """,
-            bind_vars={"par_key": participation.key}
+            bind_vars=bind_vars
         )
 
+        if not cursor.next():
+            return SetReqResult.REQUIREMENT_DOES_NOT_EXIST
+
         self.db.aql.execute(
             """
             LET parId = CONCAT("Participation/", @par_key)
-            
-            FOR key IN @req_keys
-                LET reqId = CONCAT("Requirement/", key)
+            LET existing = (
+                FOR req IN OUTBOUND parId fullfills
+                    RETURN req._key
+            )
+
+            FOR key IN MINUS(UNIQUE(@req_keys), existing)
                 INSERT {
                     _from: parId,
-                    _to: reqId
+                    _to: CONCAT("Requirement/", key)
                 } INTO fullfills
-                RETURN NEW
             """,
-            bind_vars={"par_key": participation.key, "req_keys": requirement_keys}
+            bind_vars={name: value for name, value in bind_vars.items() if name != "cleanday_key"}
         )
 
         return SetReqResult.SUCCESS
@@ -0,0 +1,163 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+from pydantic import BaseModel
+
+from config.environment import RESULT_CACHE_SIZE, RESULT_CACHE_STALE_WHILE_REVALIDATE, RESULT_CACHE_MAX_STALE, \
+    FEED_CACHE_TTL, FEED_CACHE_SIZE
+from repo.client import database
+from repo.version_repo import VersionRepo
+
+logger = logging.getLogger(__name__)
+
+# Параметры, которые не влияют на результат статистики и тепловых карт
+unkeyed_params = {'offset', 'limit', 'sort_by', 'sort_order'}
+
+
+def cache_key(name: str, params: Optional[BaseModel] = None) -> str:
+    """Key that does not depend on the order of parameters and of values in list filters."""
+    values = params.model_dump(mode='json', exclude_none=True, exclude=unkeyed_params) if params is not None else {}
+    normalized = {
+        field: sorted(value, key=str) if isinstance(value, list) else value
+        for field, value in values.items()
+        if value != "" and value != []
+    }
+    return json.dumps([name, normalized], sort_keys=True, ensure_ascii=False, default=str)
+
+
+@dataclass
+class CachedResult:
+    version: str
+    value: Any
+    computed_at: float
+
+
+class ResultCache:
+    """LRU cache of expensive read results, invalidated by the global data version.
+
+    Write handlers bump the version in their transactions, so a result is fresh while the
+    version it was computed at is current. With stale-while-revalidate an outdated result
+    younger than max_stale seconds is returned at once and recomputed in the background.
+    """
+
+    def __init__(self, version: Callable[[], str], size: int, stale_while_revalidate: bool, max_stale: float):
+        self.version = version
+        self.size = size
+        self.stale_while_revalidate = stale_while_revalidate
+        self.max_stale = max_stale
+        self.entries: OrderedDict[str, CachedResult] = OrderedDict()
+        self.lock = threading.Lock()
+        # Вычисления, которые уже выполняются: параллельные запросы ждут их вместо повторного пересчёта
+        self.pending: dict[str, asyncio.Task] = {}
+
+    async def get(self, key: str, compute: Callable[[], Any]) -> Any:
+        return await self.get_at_version(key, lambda _: compute())
+
+    async def get_at_version(self, key: str, compute: Callable[[str], Any]) -> Any:
+        """Like `get`, but `compute` receives the data version the cache has already read."""
+        version = await asyncio.to_thread(self.version)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+
+        if entry is not None and entry.version == version:
+            return entry.value
+
+        if entry is not None and self.stale_while_revalidate \
+                and time.monotonic() - entry.computed_at <= self.max_stale:
+            if key not in self.pending:
+                self._start(key, version, compute).add_done_callback(self._revalidated)
+            return entry.value
+
+        task = self.pending.get(key) or self._start(key, version, compute)
+        # Отмена одного запроса не должна прерывать вычисление, которого ждут другие
+        return await asyncio.shield(task)
+
+    def _start(self, key: str, version: str, compute: Callable[[str], Any]) -> asyncio.Task:
+        task = asyncio.create_task(self._compute(key, version, compute))
+        self.pending[key] = task
+        task.add_done_callback(lambda _: self.pending.pop(key, None))
+        return task
+
+    async def _compute(self, key: str, version: str, compute: Callable[[str], Any]) -> Any:
+        # Версия прочитана до вычисления: если данные изменятся во время него, результат сразу устареет
+        value = await asyncio.to_thread(compute, version)
+        self.put(key, CachedResult(version=version, value=value, computed_at=time.monotonic()))
+        return value
+
+    @staticmethod
+    def _revalidated(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f'Failed to recompute a cached result: {task.exception()}')
+
+    def put(self, key: str, entry: CachedResult):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class TimedCache:
+    """LRU cache whose results expire after `ttl` seconds.
+
+    For results that change with almost every write, like the activity feed, where
+    version-based invalidation would never hit.
+    """
+
+    def __init__(self, ttl: float, size: int):
+        self.ttl = ttl
+        self.size = size
+        self.entries: OrderedDict[str, CachedResult] = OrderedDict()
+        self.lock = threading.Lock()
+        self.pending: dict[str, asyncio.Task] = {}
+
+    async def get(self, key: str, compute: Callable[[], Any]) -> Any:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+
+        if entry is not None and time.monotonic() - entry.computed_at <= self.ttl:
+            return entry.value
+
+        task = self.pending.get(key)
+        if task is None:
+            task = asyncio.create_task(self._compute(key, compute))
+            self.pending[key] = task
+            task.add_done_callback(lambda _: self.pending.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _compute(self, key: str, compute: Callable[[], Any]) -> Any:
+        value = await asyncio.to_thread(compute)
+        with self.lock:
+            self.entries[key] = CachedResult(version="", value=value, computed_at=time.monotonic())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return value
+
+
+result_cache = ResultCache(VersionRepo(database).get_data_version, RESULT_CACHE_SIZE,
+                           RESULT_CACHE_STALE_WHILE_REVALIDATE, RESULT_CACHE_MAX_STALE)
+
+
+def invalidate_results():
+    """Make every cached result stale after data was changed outside the write handlers, e.g. by a restore."""
+    VersionRepo(database).bump_data()
+    result_cache.clear()
+
+
+feed_cache = TimedCache(FEED_CACHE_TTL, FEED_CACHE_SIZE)
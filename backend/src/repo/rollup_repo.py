@@ -0,0 +1,164 @@
+import random
+from datetime import datetime, UTC
+
+from arango.database import StandardDatabase
+
+from data.query import TimeseriesParams, TimeseriesGranularity, TimeseriesPoint
+
+# Корзина с этим тегом содержит все субботники города, без разбиения по тегам
+ALL_TAGS = "*"
+
+# Как и счётчики Stats, корзина дня разложена по документам: все события города за день
+# иначе обновляли бы один документ и параллельные транзакции конфликтовали бы на записи
+ROLLUP_SHARDS = 8
+
+rollup_metrics = ['created', 'completed', 'participants', 'area']
+
+period_expressions = {
+    TimeseriesGranularity.DAY: "r.day",
+    # Неделя начинается с понедельника
+    TimeseriesGranularity.WEEK: 'DATE_FORMAT(DATE_SUBTRACT(r.day, (DATE_DAYOFWEEK(r.day) + 6) % 7, "day"), '
+                                '"%yyyy-%mm-%dd")',
+    TimeseriesGranularity.MONTH: 'CONCAT(SUBSTRING(r.day, 0, 7), "-01")',
+}
+
+
+class RollupRepo:
+
+    def __init__(self, database: StandardDatabase):
+        self.db = database
+
+    def add(self, cleanday_key: str, date: datetime, **deltas: int):
+        """Add the deltas to the day buckets of the cleanday's city: the all-tags bucket and one per tag.
+
+        The deltas go to one randomly chosen shard of each bucket; the caller's transaction must write DailyRollup.
+        """
+        self.db.aql.execute(
+            """
+            LET cd = DOCUMENT(CONCAT("CleanDay/", @cleanday_key))
+            LET city = FIRST(
+                FOR loc IN OUTBOUND cd in_location
+                    FOR c IN OUTBOUND loc in_city
+                        LIMIT 1
+                        RETURN c
+            )
+            LET names = ATTRIBUTES(@deltas)
+
+            FOR tag IN APPEND([@all_tags], NOT_NULL(cd.tags, []))
+                UPSERT {tag: tag, city_key: city._key, day: @day, shard: @shard}
+                INSERT MERGE(
+                    {day: @day, city_key: city._key, city: city.name, tag: tag, shard: @shard},
+                    ZIP(@metrics, @metrics[* RETURN 0]),
+                    @deltas
+                )
+                UPDATE ZIP(names, (FOR name IN names RETURN NOT_NULL(OLD[name], 0) + @deltas[name]))
+                IN DailyRollup
+            """,
+            bind_vars={
+                "cleanday_key": cleanday_key,
+                "day": date.astimezone(UTC).date().isoformat(),
+                "deltas": deltas,
+                "metrics": rollup_metrics,
+                "all_tags": ALL_TAGS,
+                "shard": random.randrange(ROLLUP_SHARDS)
+            }
+        )
+
+    def rebuild(self):
+        """Recompute every bucket from the event log, including its archived part."""
+        trans = self.db.begin_transaction(read=['Log', 'LogArchive', 'CleanDay', 'in_location', 'in_city', 'City'],
+                                          exclusive=['DailyRollup'])
+        try:
+            trans.aql.execute("FOR r IN DailyRollup REMOVE r IN DailyRollup")
+            # Организатор вступает в субботник при его создании, отдельной записи об этом нет
+            trans.aql.execute(
+                """
+                LET live = (
+                    FOR log IN Log
+                        FILTER log.type IN @types
+                        RETURN KEEP(log, "type", "date", "cleanday_key")
+                )
+                LET archived = (
+                    FOR log IN LogArchive
+                        FILTER log.type IN @types
+                        RETURN KEEP(log, "type", "date", "cleanday_key")
+                )
+                FOR log IN UNION(live, archived)
+                    LET cd = DOCUMENT(CONCAT("CleanDay/", log.cleanday_key))
+                    FILTER cd != null
+                    LET city = FIRST(
+                        FOR loc IN OUTBOUND cd in_location
+                            FOR c IN OUTBOUND loc in_city
+                                LIMIT 1
+                                RETURN c
+                    )
+                    FOR tag IN APPEND([@all_tags], NOT_NULL(cd.tags, []))
+                        COLLECT day = SUBSTRING(log.date, 0, 10), city_key = city._key, tag_name = tag
+                        AGGREGATE
+                            city_name = MAX(city.name),
+                            created = SUM(log.type == "CreateCleanday" ? 1 : 0),
+                            completed = SUM(log.type == "EndCleanday" ? 1 : 0),
+                            participants = SUM(log.type != "EndCleanday" ? 1 : 0),
+                            area = SUM(log.type == "EndCleanday" ? NOT_NULL(cd.area, 0) : 0)
+                        INSERT {
+                            day: day,
+                            city_key: city_key,
+                            city: city_name,
+                            tag: tag_name,
+                            created: created,
+                            completed: completed,
+                            participants: participants,
+                            area: area
+                        } INTO DailyRollup
+                """,
+                bind_vars={"all_tags": ALL_TAGS, "types": ["CreateCleanday", "CreateParticipation", "EndCleanday"]}
+            )
+        except Exception as e:
+            trans.abort_transaction()
+            raise e
+        else:
+            trans.commit_transaction()
+
+    def get_timeseries(self, params: TimeseriesParams) -> list[TimeseriesPoint]:
+        bind_vars = {
+            "tag": params.tag or ALL_TAGS,
+            "date_from": params.date_from.isoformat(),
+            "date_to": params.date_to.isoformat()
+        }
+
+        filters = []
+        if params.city_key is not None:
+            filters.append("FILTER r.city_key == @city_key")
+            bind_vars["city_key"] = params.city_key
+
+        group_by_city = "r.city_key" if params.by_city else "null"
+
+        # Число прочитанных документов равно числу корзин в диапазоне, умноженному не более чем на число частей;
+        # части одной корзины суммируются вместе с днями периода
+        cursor = self.db.aql.execute(
+            f"""
+            FOR r IN DailyRollup
+                FILTER r.tag == @tag AND r.day >= @date_from AND r.day <= @date_to
+                {'\n'.join(filters)}
+                COLLECT period = {period_expressions[params.granularity]}, city_key = {group_by_city}
+                AGGREGATE
+                    city = MAX(r.city),
+                    created = SUM(r.created),
+                    completed = SUM(r.completed),
+                    participants = SUM(r.participants),
+                    area = SUM(r.area)
+                SORT period, city_key
+                RETURN {{
+                    period: period,
+                    city_key: city_key,
+                    city: city_key == null ? null : city,
+                    created: created,
+                    completed: completed,
+                    participants: participants,
+                    area: area
+                }}
+            """,
+            bind_vars=bind_vars
+        )
+
+        return [TimeseriesPoint.model_validate(point) for point in cursor]
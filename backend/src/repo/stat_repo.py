@@ -1,7 +1,17 @@
+import random
+from datetime import datetime, UTC
+
 from arango.database import StandardDatabase
 
 from repo.model import RepoStats
 
+# Счётчики разложены по нескольким документам, чтобы параллельные транзакции
+# не конфликтовали на записи одного документа; при чтении документы суммируются
+STATS_SHARDS = 8
+
+counter_fields = ['user_count', 'participated_user_count', 'cleanday_count', 'past_cleanday_count',
+                  'cleanday_metric']
+
 
 class StatRepo:
 
@@ -11,48 +21,121 @@ class StatRepo:
     def get_stats(self) -> RepoStats:
         cursor = self.db.aql.execute(
             """
-            LET user_count = COUNT(
-                FOR u in User
+            LET shards = (FOR s IN Stats RETURN s)
+
+            RETURN {
+                user_count: SUM(shards[*].user_count),
+                participated_user_count: SUM(shards[*].participated_user_count),
+                cleanday_count: SUM(shards[*].cleanday_count),
+                past_cleanday_count: SUM(shards[*].past_cleanday_count),
+                cleanday_metric: SUM(shards[*].cleanday_metric),
+                updated_at: MAX(shards[*].updated_at),
+                reconciled_at: MAX(shards[*].reconciled_at)
+            }
+            """
+        )
+
+        res_dict = cursor.next()
+
+        return RepoStats.model_validate(res_dict)
+
+    def increment(self, **deltas: int):
+        """Add the deltas to one randomly chosen counter shard; the caller's transaction must write Stats."""
+        self.db.aql.execute(
+            """
+            LET names = ATTRIBUTES(@deltas)
+            UPSERT {_key: @shard}
+            INSERT MERGE({_key: @shard, updated_at: @date}, @deltas)
+            UPDATE MERGE(
+                ZIP(names, (FOR name IN names RETURN NOT_NULL(OLD[name], 0) + @deltas[name])),
+                {updated_at: @date}
+            )
+            IN Stats
+            """,
+            bind_vars={
+                "shard": str(random.randrange(STATS_SHARDS)),
+                "deltas": deltas,
+                "date": datetime.now(UTC).isoformat()
+            }
+        )
+
+    def record_participation(self, user_key: str):
+        """Count the user as participating if the participation just created is their first one."""
+        cursor = self.db.aql.execute(
+            """
+            RETURN COUNT(
+                FOR par IN OUTBOUND CONCAT("User/", @user_key) has_participation
+                    LIMIT 2
                     RETURN 1
             )
-            
+            """,
+            bind_vars={"user_key": user_key}
+        )
+
+        if cursor.next() == 1:
+            self.increment(participated_user_count=1)
+
+    def count(self) -> dict:
+        """Recount every counter with full collection scans."""
+        cursor = self.db.aql.execute(
+            """
+            LET user_count = LENGTH(User)
+
             LET participated_user_count = COUNT(
                 FOR u in User
-                    LET par_count = COUNT(
+                    FILTER LENGTH(
                         FOR par IN OUTBOUND u has_participation
+                            LIMIT 1
                             RETURN 1
-                    )
-                    FILTER par_count > 0
+                    ) > 0
                     RETURN 1
             )
-            
-            LET cleanday_count = COUNT(
-                FOR cl_day in CleanDay
-                    RETURN 1
-            )
-            
-            LET past_cleanday_count = COUNT(
-                FOR cl_day in CleanDay
-                    FILTER cl_day.status == "Завершен"
-                    RETURN 1
-            )
-            
-            LET cleanday_metric = SUM(
+
+            LET cleanday_count = LENGTH(CleanDay)
+
+            LET past = (
                 FOR cl_day in CleanDay
                     FILTER cl_day.status == "Завершен"
-                    RETURN cl_day.area
+                    RETURN NOT_NULL(cl_day.area, 0)
             )
-            
+
             RETURN {
                 user_count: user_count,
                 participated_user_count: participated_user_count,
                 cleanday_count: cleanday_count,
-                past_cleanday_count: past_cleanday_count,
-                cleanday_metric: cleanday_metric
+                past_cleanday_count: LENGTH(past),
+                cleanday_metric: SUM(past)
             }
             """
         )
 
-        res_dict = cursor.next()
+        return cursor.next()
 
-        return RepoStats.model_validate(res_dict)
+    def reconcile(self) -> RepoStats:
+        """Replace the counters with a full recount.
+
+        Stats is locked exclusively, so writers that want to increment a counter wait
+        until the recount is committed and their changes are counted exactly once.
+        """
+        trans = self.db.begin_transaction(read=['User', 'CleanDay', 'has_participation'], exclusive=['Stats'])
+        try:
+            totals = StatRepo(trans).count()
+            date = datetime.now(UTC).isoformat()
+            trans.aql.execute(
+                """
+                FOR i IN 0..@last
+                    LET counters = i == 0 ? @totals : ZIP(@fields, @fields[* RETURN 0])
+                    UPSERT {_key: TO_STRING(i)}
+                    INSERT MERGE({_key: TO_STRING(i), updated_at: @date, reconciled_at: @date}, counters)
+                    UPDATE MERGE(counters, {updated_at: @date, reconciled_at: @date})
+                    IN Stats
+                """,
+                bind_vars={"last": STATS_SHARDS - 1, "totals": totals, "fields": counter_fields, "date": date}
+            )
+        except Exception as e:
+            trans.abort_transaction()
+            raise e
+        else:
+            trans.commit_transaction()
+
+        return self.get_stats()
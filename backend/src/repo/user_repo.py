@@ -1,3 +1,4 @@
+from datetime import datetime, UTC
 from typing import Optional, Tuple
 
 from arango.cursor import Cursor
@@ -6,11 +7,14 @@ from arango.database import StandardDatabase
 from auth.model import RegisterUser
 from data.entity import User, Image, Sex
 from data.query import GetUser, GetUsersParams, GetCleanday, PaginationParams, UserSortField, GetExtendedUser, \
-    GetCleandaysParams, UserHeatmapField, HeatmapEntry
+    GetCleandaysParams, UserHeatmapField, HeatmapEntry, UserHeatmapQuery
 from repo import util
+from repo.bucketing import bucket_expression, apply_quantiles
 from repo.city_repo import CityRepo
 from repo.client import database
-from repo.model import CreateUser, UpdateUser
+from repo.heatmap_repo import HeatmapCubeRepo, CubeKind, cube_filters
+from repo.model import CreateUser, UpdateUser, EntityVersion
+from storage.image import save_photo, load_metadata
 
 contains_filters = ['first_name', 'last_name', 'login', 'city']
 from_filters = ['level_from', 'cleanday_count_from', 'organized_count_from', 'stat_from']
@@ -27,6 +31,32 @@ filter_fields = {
     'stat_to': 'stat'
 }
 
+# Вычисляемые поля пользователя для тепловой карты
+heatmap_lets = {
+    'city': 'LET city = FIRST(FOR city IN OUTBOUND u lives_in LIMIT 1 RETURN city.name)',
+    'cleanday_count': 'LET cleanday_count = COUNT(FOR p IN OUTBOUND u has_participation '
+                      'FOR cl_day IN OUTBOUND p participation_in RETURN 1)',
+    'organized_count': 'LET organized_count = COUNT(FOR p IN OUTBOUND u has_participation '
+                       'FILTER p.type == "Организатор" FOR cl_day IN OUTBOUND p participation_in RETURN 1)',
+    'stat': 'LET stat = SUM(FOR p IN OUTBOUND u has_participation RETURN p.stat)',
+}
+
+
+def filtered_fields(params: GetUsersParams) -> set[str]:
+    params_dict = params.model_dump(exclude_none=True)
+    fields = {name for name in contains_filters + ['sex'] if name in params_dict}
+    fields.update(field for name, field in filter_fields.items() if name in params_dict)
+    if params_dict.get('search_query', "") != "":
+        fields.update(contains_filters)
+    return fields
+
+
+# Фильтры, которые тепловая карта может применить к ячейкам куба
+cube_in_filters = {'sex': 'sex'}
+cube_range_filters = {
+    name: (field, '>=' if name.endswith('_from') else '<=') for name, field in filter_fields.items()
+}
+
 
 def setup_get_users_params(params: GetUsersParams) -> (dict, list[str]):
     params_dict = params.model_dump(exclude_none=True)
@@ -116,30 +146,12 @@ class UserRepo:
                       RETURN p.stat
             )
             
-            LET created_at = FIRST(
-                FOR log IN INBOUND userId relates_to_user
-                    FILTER log.type == "CreateUser"
-                    LIMIT 1
-                    RETURN log.date
-            )
-            
-            LET updated_at = NOT_NULL(FIRST(
-                FOR log IN INBOUND userId relates_to_user
-                    FILTER log.type == "UpdateUser"
-                    SORT log.date DESC
-                    LIMIT 1
-                    RETURN log.date
-            ), created_at)
-            
-            
             RETURN MERGE(user, {
               "key": @id,
               "city": city.name,
               "cleanday_count": parCount,
               "organized_count": orgCount,
-              "stat": stat,
-              "created_at": created_at,
-              "updated_at": updated_at
+              "stat": stat
             })
             """, bind_vars={"id": user_key}
         )
@@ -257,6 +269,21 @@ class UserRepo:
 
         return User.model_validate(user_dict)
 
+    def get_version(self, user_key: str) -> Optional[EntityVersion]:
+        cursor = self.db.aql.execute(
+            """
+            LET user = DOCUMENT(CONCAT("User/", @user_key))
+            FILTER user != null
+            RETURN {tag: user._rev, modified_at: user.modified_at}
+            """,
+            bind_vars={"user_key": user_key}
+        )
+
+        if cursor.empty():
+            return None
+
+        return EntityVersion.model_validate(cursor.next())
+
     def get_raw_by_key(self, user_key: str) -> Optional[User]:
 
         cursor = self.db.aql.execute(
@@ -295,10 +322,12 @@ class UserRepo:
               sex: @sex,
               password: @password,
               about_me: @about_me,
-              score: @score
+              score: @score,
+              created_at: @created_at,
+              updated_at: @created_at
             } INTO User
             RETURN NEW
-            """, bind_vars=user.model_dump()
+            """, bind_vars={**user.model_dump(), "created_at": datetime.now(UTC).isoformat()}
         )
 
         return self._return_single(cursor)
@@ -312,7 +341,9 @@ class UserRepo:
             UPDATE @user_key WITH @changes IN User
             RETURN NEW
             """,
-            bind_vars={"user_key": user_key, "changes": user.model_dump(exclude_none=True)},
+            bind_vars={"user_key": user_key,
+                       "changes": {**user.model_dump(exclude_none=True),
+                                   "updated_at": datetime.now(UTC).isoformat()}},
         )
 
         return self._return_single(cursor)
@@ -380,11 +411,11 @@ class UserRepo:
             LET userId = CONCAT("User/", @user_id)
 
             FOR file IN 1..1 OUTBOUND userId user_avatar
-              UPDATE file WITH {
-                photo: @file
-              } IN Image
+              UPDATE file WITH MERGE(@metadata, {
+                photo: null
+              }) IN Image OPTIONS { keepNull: false }
               RETURN NEW
-            """, bind_vars={"user_id": user_key, "file": image_data}
+            """, bind_vars={"user_id": user_key, "metadata": save_photo(image_data)}
         )
         return True
 
@@ -396,10 +427,9 @@ class UserRepo:
         self.db.aql.execute(
             """
             LET img = FIRST(
-              INSERT {
-                description: "avatar",
-                photo: @file
-              } INTO Image
+              INSERT MERGE(@metadata, {
+                description: "avatar"
+              }) INTO Image
               RETURN NEW
             )
             
@@ -408,7 +438,7 @@ class UserRepo:
               _to: img._id
             } INTO user_avatar
             """,
-            bind_vars={"user_key": user_key, "file": image_data},
+            bind_vars={"user_key": user_key, "metadata": save_photo(image_data)},
         )
 
     def get_image(self, user_key: str) -> Optional[Image]:
@@ -422,7 +452,10 @@ class UserRepo:
             
             FOR file IN OUTBOUND userId user_avatar
               LIMIT 1
-              RETURN file
+              RETURN {
+                key: file._key, description: file.description, hash: file.hash,
+                size: file.size, width: file.width, height: file.height, content_type: file.content_type
+              }
             """,
             bind_vars={"user_key": user_key},
         )
@@ -431,61 +464,46 @@ class UserRepo:
             return None
 
         result_dict = cursor.next()
-        result_dict['key'] = result_dict['_key']
 
-        return Image.model_validate(result_dict)
+        return Image.model_validate(load_metadata(result_dict))
 
     def get_heatmap(self, x_axis: UserHeatmapField, y_axis: UserHeatmapField,
-                    params: GetUsersParams) -> list[HeatmapEntry]:
+                    params: UserHeatmapQuery) -> list[HeatmapEntry]:
+        cell_filters = cube_filters(CubeKind.USER, params,
+                                    [(x_axis, params.x_bucket), (y_axis, params.y_bucket)],
+                                    cube_in_filters, cube_range_filters)
+        if cell_filters is not None:
+            return apply_quantiles(
+                HeatmapCubeRepo(self.db).get_heatmap(CubeKind.USER, x_axis, y_axis, cell_filters,
+                                                     params.x_bucket, params.y_bucket),
+                params.x_bucket, params.y_bucket
+            )
+
         bind_vars, filters = setup_get_users_params(params)
         bind_vars.pop("offset")
         bind_vars.pop("limit")
 
+        # Пользователь сводится к используемым полям и сразу учитывается в ячейке,
+        # вычисляемые поля считаются только если они нужны
+        used_fields = sorted({x_axis, y_axis} | filtered_fields(params))
+        lets = [heatmap_lets[field] for field in used_fields if field in heatmap_lets]
+        projection = ", ".join(f'"{field}": {field if field in heatmap_lets else "u." + field}'
+                               for field in used_fields)
+
         query = f"""
-                LET page = (FOR u in User
-                    LET userId = CONCAT("User/", u._key)
-                    LET city = FIRST(
-                        FOR city IN OUTBOUND userId lives_in
-                            LIMIT 1
-                            RETURN city
-                    )
-                    LET parCount = COUNT(
-                        FOR p IN OUTBOUND userId has_participation
-                            FOR cl_day IN OUTBOUND p participation_in
-                                RETURN cl_day
-                    )
-                    LET orgCount = COUNT(
-                        FOR p IN OUTBOUND userId has_participation
-                            FILTER p.type == "Организатор"
-                            FOR cl_day IN OUTBOUND p participation_in
-                                RETURN cl_day
-                    )
-                    LET stat = SUM(
-                        FOR p IN OUTBOUND userId has_participation
-                            RETURN p.stat
-                    )
-                    LET usr = MERGE(u, {{
-                        key: u._key,
-                        city: city.name,
-                        cleanday_count: parCount,
-                        organized_count: orgCount,
-                        stat: stat
-                    }})
-                    
+                FOR u IN User
+                    {'\n'.join(lets)}
+                    LET usr = {{{projection}}}
                     {'\n'.join(filters)}
-                    
-                    RETURN usr
-                )
-
-                FOR u IN page
-                    COLLECT x = TO_STRING(u.{x_axis}), y = TO_STRING(u.{y_axis}) WITH COUNT INTO count
+                    COLLECT x = {bucket_expression(f"usr.{x_axis}", params.x_bucket)}, y = {bucket_expression(f"usr.{y_axis}", params.y_bucket)} WITH COUNT INTO count
+                    OPTIONS {{ method: "hash" }}
                     RETURN {{ x_label: x, y_label: y, count: count }}
             """
 
-        cursor = self.db.aql.execute(query, bind_vars=bind_vars)
+        cursor = self.db.aql.execute(query, bind_vars=bind_vars, stream=True)
         data = [HeatmapEntry.model_validate(doc) for doc in cursor]
 
-        return data
+        return apply_quantiles(data, params.x_bucket, params.y_bucket)
 
 
 if __name__ == "__main__":
@@ -1,12 +1,19 @@
+from typing import Optional
+
 from arango.database import StandardDatabase
 
-from data.query import GetCleandaysParams, GetCleanday, CleandayHeatmapField, HeatmapEntry
+from data.query import GetCleandaysParams, GetCleanday, CleandayHeatmapField, HeatmapEntry, CleandayHeatmapQuery, \
+    HeatmapAxes
+from repo.bucketing import bucket_expression
 import logging
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 contains_filters = ['name', 'organization', 'organizer', 'city']
+# Поля, которые хранятся в самом документе субботника
+document_fields = {'name', 'organization', 'status', 'tags', 'begin_date', 'end_date', 'area', 'recommended_count',
+                   'created_at', 'updated_at'}
 
 from_filters = ['begin_date_from', 'end_date_from', 'area_from', 'recommended_count_from', 'participant_count_from',
                 'created_at_from', 'updated_at_from']
@@ -15,9 +22,19 @@ to_filters = ['begin_date_to', 'end_date_to', 'area_to', 'recommended_count_to',
 
 time_fields = ['begin_date', 'end_date', 'created_at', 'updated_at']
 
+# Фильтры, которые тепловая карта может применить к ячейкам куба
+cube_in_filters = {'status': 'status'}
+cube_range_filters = {
+    **{from_filter: (from_filter[:-5], '>=') for from_filter in from_filters},
+    **{to_filter: (to_filter[:-3], '<=') for to_filter in to_filters}
+}
+
 
 def get_cleanday_page(db: StandardDatabase, header_query: str, params: GetCleandaysParams, **kwargs) -> (int, list[GetCleanday]):
     params_dict = params.model_dump(exclude_none=True)
+    # Фильтры по полям документа стоят до обогащения, чтобы работали индексы и лишние субботники
+    # не обходили граф; фильтры по вычисляемым полям - после
+    document_filters = []
     filters = []
     bind_vars = {
         "offset": params.offset,
@@ -25,27 +42,29 @@ def get_cleanday_page(db: StandardDatabase, header_query: str, params: GetCleand
     }
     bind_vars.update(kwargs)
 
+    def add_filter(field_name: str, condition: str):
+        if field_name in document_fields:
+            document_filters.append(f"    FILTER {condition.format(doc='cl_day')}")
+        else:
+            filters.append(f"    FILTER {condition.format(doc='cleanday')}")
+
     for contains_filter in contains_filters:
         if contains_filter in params_dict:
-            filters.append(
-                f"    FILTER CONTAINS(LOWER(cleanday.{contains_filter}), LOWER(@{contains_filter}))"
-            )
+            add_filter(contains_filter, f"CONTAINS(LOWER({{doc}}.{contains_filter}), LOWER(@{contains_filter}))")
             bind_vars[contains_filter] = params_dict[contains_filter]
 
     if "status" in params_dict:
-        filters.append("    FILTER cleanday.status IN @status")
+        add_filter("status", "{doc}.status IN @status")
         bind_vars["status"] = params_dict["status"]
 
     if "tags" in params_dict:
-        filters.append("    FILTER cleanday.tags ANY IN @tags")
+        add_filter("tags", "{doc}.tags ANY IN @tags")
         bind_vars["tags"] = params_dict["tags"]
 
     for from_filter in from_filters:
         if from_filter in params_dict:
             field_name = from_filter[:-5]
-            filters.append(
-                f"    FILTER cleanday.{field_name} >= @{from_filter}"
-            )
+            add_filter(field_name, f"{{doc}}.{field_name} >= @{from_filter}")
             bind_vars[from_filter] = params_dict[from_filter]
             if field_name in time_fields:
                 bind_vars[from_filter] = bind_vars[from_filter].isoformat()
@@ -53,9 +72,7 @@ def get_cleanday_page(db: StandardDatabase, header_query: str, params: GetCleand
     for to_filter in to_filters:
         if to_filter in params_dict:
             field_name = to_filter[:-3]
-            filters.append(
-                f"    FILTER cleanday.{field_name} <= @{to_filter}"
-            )
+            add_filter(field_name, f"{{doc}}.{field_name} <= @{to_filter}")
             bind_vars[to_filter] = params_dict[to_filter]
             if field_name in time_fields:
                 bind_vars[to_filter] = bind_vars[to_filter].isoformat()
@@ -78,6 +95,7 @@ def get_cleanday_page(db: StandardDatabase, header_query: str, params: GetCleand
     query = f"""
         LET count = COUNT(
             {header_query}
+            {'\n'.join(document_filters)}
                 LET cdId = cl_day._id     
                 LET loc = FIRST(
                     FOR loc IN OUTBOUND cdId in_location
@@ -105,21 +123,6 @@ def get_cleanday_page(db: StandardDatabase, header_query: str, params: GetCleand
 
                         RETURN MERGE(req, {{"users_amount": fulfills, "key": req._key}})    
                 )
-                LET created_at = FIRST(
-                    FOR log IN INBOUND cdId relates_to_cleanday
-                        FILTER log.type == "CreateCleanday"
-                        LIMIT 1
-                        RETURN log.date
-                )
-
-                LET updated_at = NOT_NULL(FIRST(
-                    FOR log IN INBOUND cdId relates_to_cleanday
-                        FILTER log.type == "UpdateCleanday"
-                        SORT log.date DESC
-                        LIMIT 1
-                        RETURN log.date
-                ), created_at)
-
                 LET organizer = FIRST(
                     FOR par IN INBOUND cdId participation_in
                         FILTER par.type == "Организатор"
@@ -143,8 +146,6 @@ def get_cleanday_page(db: StandardDatabase, header_query: str, params: GetCleand
                     "participant_count": participant_count,
                     "requirements": requirements,
                     "location": loc,
-                    "created_at": created_at,
-                    "updated_at": updated_at,
                     "organizer": organizer,
                     "organizer_key": organizer_key,
                 }})
@@ -156,6 +157,7 @@ def get_cleanday_page(db: StandardDatabase, header_query: str, params: GetCleand
 
         LET page = (
              {header_query}
+            {'\n'.join(document_filters)}
                 LET cdId = cl_day._id     
                 LET loc = FIRST(
                     FOR loc IN OUTBOUND cdId in_location
@@ -184,21 +186,6 @@ def get_cleanday_page(db: StandardDatabase, header_query: str, params: GetCleand
                         RETURN MERGE(req, {{"users_amount": fulfills, "key": req._key}})    
                 )
 
-                LET created_at = FIRST(
-                    FOR log IN INBOUND cdId relates_to_cleanday
-                        FILTER log.type == "CreateCleanday"
-                        LIMIT 1
-                        RETURN log.date
-                )
-
-                LET updated_at = NOT_NULL(FIRST(
-                    FOR log IN INBOUND cdId relates_to_cleanday
-                        FILTER log.type == "UpdateCleanday"
-                        SORT log.date DESC
-                        LIMIT 1
-                        RETURN log.date
-                ), created_at)
-
                 LET organizer = FIRST(
                     FOR par IN INBOUND cdId participation_in
                         FILTER par.type == "Организатор"
@@ -222,8 +209,6 @@ def get_cleanday_page(db: StandardDatabase, header_query: str, params: GetCleand
                     "participant_count": participant_count,
                     "requirements": requirements,
                     "location": loc,
-                    "created_at": created_at,
-                    "updated_at": updated_at,
                     "organizer": organizer,
                     "organizer_key": organizer_key
                 }})
@@ -252,33 +237,65 @@ def get_cleanday_page(db: StandardDatabase, header_query: str, params: GetCleand
     return result_dict["count"], cleanday_page
 
 
-def get_heatmap(db: StandardDatabase, x_field: CleandayHeatmapField, y_field: CleandayHeatmapField,
-                    params: GetCleandaysParams) -> list[HeatmapEntry]:
-    params_dict = params.model_dump(exclude_none=True)
+# Производные поля субботника: какие LET нужны для вычисления каждого из них
+# Поля-списки: субботник попадает в ячейку для каждого тега или требования
+heatmap_list_fields = {'tags', 'requirements'}
+
+derived_dependencies = {
+    'city': ['loc', 'city'],
+    'location': ['loc'],
+    'participant_count': ['participant_count'],
+    'requirements': ['requirements'],
+    'organizer': ['organizer'],
+    'organizer_key': ['organizer_key'],
+}
+
+derived_lets = {
+    'loc': 'LET loc = FIRST(FOR loc IN OUTBOUND cdId in_location LIMIT 1 RETURN loc)',
+    'city': 'LET city = FIRST(FOR city IN OUTBOUND loc in_city LIMIT 1 RETURN city)',
+    'participant_count': 'LET participant_count = COUNT(FOR par IN INBOUND cdId participation_in RETURN 1)',
+    'requirements': 'LET requirements = (FOR req IN OUTBOUND cdId has_requirement RETURN req.name)',
+    'organizer': 'LET organizer = FIRST(FOR par IN INBOUND cdId participation_in FILTER par.type == "Организатор" '
+                 'LIMIT 1 FOR user IN INBOUND par has_participation RETURN user.login)',
+    'organizer_key': 'LET organizer_key = FIRST(FOR par IN INBOUND cdId participation_in FILTER par.type == '
+                     '"Организатор" LIMIT 1 FOR user IN INBOUND par has_participation RETURN user._key)',
+}
+
+derived_values = {
+    'city': '"city": city.name',
+    'location': '"location": {address: loc.address}',
+    'participant_count': '"participant_count": participant_count',
+    'requirements': '"requirements": requirements',
+    'organizer': '"organizer": organizer',
+    'organizer_key': '"organizer_key": organizer_key',
+}
+
+
+def heatmap_filters(params_dict: dict) -> (list[tuple[set[str], str]], dict):
+    """Heatmap filters as (fields used, AQL template with {doc}) pairs and their bind variables."""
     filters = []
     bind_vars = dict()
 
     for contains_filter in contains_filters:
         if contains_filter in params_dict:
-            filters.append(
-                f"    FILTER CONTAINS(LOWER(cleanday.{contains_filter}), LOWER(@{contains_filter}))"
-            )
+            filters.append((
+                {contains_filter},
+                f"FILTER CONTAINS(LOWER({{doc}}.{contains_filter}), LOWER(@{contains_filter}))"
+            ))
             bind_vars[contains_filter] = params_dict[contains_filter]
 
     if "status" in params_dict:
-        filters.append("    FILTER cleanday.status IN @status")
+        filters.append(({'status'}, "FILTER {doc}.status IN @status"))
         bind_vars["status"] = params_dict["status"]
 
     if "tags" in params_dict:
-        filters.append("    FILTER cleanday.tags ANY IN @tags")
+        filters.append(({'tags'}, "FILTER {doc}.tags ANY IN @tags"))
         bind_vars["tags"] = params_dict["tags"]
 
     for from_filter in from_filters:
         if from_filter in params_dict:
             field_name = from_filter[:-5]
-            filters.append(
-                f"    FILTER cleanday.{field_name} >= @{from_filter}"
-            )
+            filters.append(({field_name}, f"FILTER {{doc}}.{field_name} >= @{from_filter}"))
             bind_vars[from_filter] = params_dict[from_filter]
             if field_name in time_fields:
                 bind_vars[from_filter] = bind_vars[from_filter].isoformat()
@@ -286,144 +303,97 @@ def get_heatmap(db: StandardDatabase, x_field: CleandayHeatmapField, y_field: Cl
     for to_filter in to_filters:
         if to_filter in params_dict:
             field_name = to_filter[:-3]
-            filters.append(
-                f"    FILTER cleanday.{field_name} <= @{to_filter}"
-            )
+            filters.append(({field_name}, f"FILTER {{doc}}.{field_name} <= @{to_filter}"))
             bind_vars[to_filter] = params_dict[to_filter]
             if field_name in time_fields:
                 bind_vars[to_filter] = bind_vars[to_filter].isoformat()
 
     if 'search_query' in params_dict and params_dict['search_query'] != "":
         all_contains = [
-            f'CONTAINS(LOWER(cleanday.{contains_filter}), LOWER(@search_query))' for contains_filter in contains_filters
+            f'CONTAINS(LOWER({{doc}}.{contains_filter}), LOWER(@search_query))' for contains_filter in contains_filters
         ]
-        filters.append(
-            f"    FILTER({' OR '.join(all_contains)})"
-        )
+        filters.append((set(contains_filters), f"FILTER({' OR '.join(all_contains)})"))
         bind_vars['search_query'] = params_dict['search_query']
 
     if 'address' in params_dict and params_dict['address'] != "":
-        filters.append(
-            f"    FILTER CONTAINS(LOWER(cleanday.location.address), LOWER(@address))"
-        )
+        filters.append(({'location'}, "FILTER CONTAINS(LOWER({doc}.location.address), LOWER(@address))"))
         bind_vars['address'] = params_dict['address']
 
-    def unwrap(field):
-        if field == "tags":
-            return "tag IN u.tags"
-        elif field == "requirements":
-            return "req IN u.requirements"
-        else:
-            return None
+    return filters, bind_vars
 
-    # AQL-safe field accessor
-    def get_field_accessor(field: str) -> str:
-        return f"u.{field}" if '.' not in field else '.'.join(["u"] + field.split("."))
 
-    x_accessor = get_field_accessor(x_field)
-    y_accessor = get_field_accessor(y_field)
+def axis_values(field: str, bucket: Optional[str]) -> str:
+    """AQL array of the labels of a heatmap axis; list fields give one label per tag or requirement."""
+    if field in heatmap_list_fields:
+        # Выражение над массивом, а не подзапрос: подзапросы выполнялись бы для каждой сетки
+        return f"NOT_NULL(cleanday.{field}, [])[* RETURN {bucket_expression('CURRENT', bucket)}]"
+    return f"[{bucket_expression('cleanday.' + field, bucket)}]"
 
-    list_case = any(f in ["tags", "requirements"] for f in [x_field, y_field])
 
-    if list_case:
-        if x_field == "requirements":
-            x_exp = "req.name"
-        elif x_field == "tags":
-            x_exp = "tag"
-        else:
-            x_exp = x_accessor
+def switch_expression(expressions: list[str]) -> str:
+    """AQL expression that evaluates only the expression of the current grid."""
+    result = expressions[-1]
+    for index in range(len(expressions) - 2, -1, -1):
+        result = f"(grid == {index} ? {expressions[index]} : {result})"
+    return result
 
-        if y_field == "requirements":
-            y_exp = "req.name"
-        elif y_field == "tags":
-            y_exp = "tag"
-        else:
-            y_exp = y_accessor
-
-        loop = ""
-        if x_field == "requirements":
-            loop += "FOR req IN u.requirements "
-        elif x_field == "tags":
-            loop += "FOR tag IN u.tags "
-
-        if y_field == "requirements":
-            loop += "FOR req IN u.requirements "
-        elif y_field == "tags":
-            loop += "FOR tag IN u.tags "
-
-        query = f"""
-                    LET page = (
-                        FOR cl_day IN CleanDay
-                            LET cdId = cl_day._id
-                            LET loc = FIRST(FOR loc IN OUTBOUND cdId in_location LIMIT 1 RETURN MERGE(loc, {{key: loc._key}}))
-                            LET city = FIRST(FOR city IN OUTBOUND loc in_city LIMIT 1 RETURN city)
-                            LET participant_count = COUNT(FOR par IN INBOUND cdId participation_in RETURN 1)
-                            LET requirements = (
-                                FOR req IN OUTBOUND cdId has_requirement 
-                                    LET fulfills = COUNT(FOR par IN INBOUND req fullfills RETURN 1)
-                                    RETURN MERGE(req, {{"users_amount": fulfills, "key": req._key}})    
-                            )
-                            LET created_at = FIRST(FOR log IN INBOUND cdId relates_to_cleanday FILTER log.type == "CreateCleanday" LIMIT 1 RETURN log.date)
-                            LET updated_at = NOT_NULL(FIRST(FOR log IN INBOUND cdId relates_to_cleanday FILTER log.type == "UpdateCleanday" SORT log.date DESC LIMIT 1 RETURN log.date), created_at)
-                            LET organizer = FIRST(FOR par IN INBOUND cdId participation_in FILTER par.type == "Организатор" LIMIT 1 FOR user IN INBOUND par has_participation RETURN user.login)
-                            LET organizer_key = FIRST(FOR par IN INBOUND cdId participation_in FILTER par.type == "Организатор" LIMIT 1 FOR user IN INBOUND par has_participation RETURN user._key)
-                            LET cleanday = MERGE(cl_day, {{
-                                "key": cl_day._key,
-                                "city": city.name,
-                                "participant_count": participant_count,
-                                "requirements": requirements,
-                                "location": loc,
-                                "created_at": created_at,
-                                "updated_at": updated_at,
-                                "organizer": organizer,
-                                "organizer_key": organizer_key
-                            }})
-                            {'\n'.join(filters)}
-                            RETURN cleanday
-                    )
-                    FOR u IN page
-                        {loop}
-                        COLLECT x = TO_STRING({x_exp}), y = TO_STRING({y_exp}) WITH COUNT INTO count
-                        RETURN {{ x_label: x, y_label: y, count: count }}
-                """
-    else:
-        query = f"""
-                    LET page = (
-                        FOR cl_day IN CleanDay
-                            LET cdId = cl_day._id
-                            LET loc = FIRST(FOR loc IN OUTBOUND cdId in_location LIMIT 1 RETURN MERGE(loc, {{key: loc._key}}))
-                            LET city = FIRST(FOR city IN OUTBOUND loc in_city LIMIT 1 RETURN city)
-                            LET participant_count = COUNT(FOR par IN INBOUND cdId participation_in RETURN 1)
-                            LET requirements = (
-                                FOR req IN OUTBOUND cdId has_requirement 
-                                    LET fulfills = COUNT(FOR par IN INBOUND req fullfills RETURN 1)
-                                    RETURN MERGE(req, {{"users_amount": fulfills, "key": req._key}})    
-                            )
-                            LET created_at = FIRST(FOR log IN INBOUND cdId relates_to_cleanday FILTER log.type == "CreateCleanday" LIMIT 1 RETURN log.date)
-                            LET updated_at = NOT_NULL(FIRST(FOR log IN INBOUND cdId relates_to_cleanday FILTER log.type == "UpdateCleanday" SORT log.date DESC LIMIT 1 RETURN log.date), created_at)
-                            LET organizer = FIRST(FOR par IN INBOUND cdId participation_in FILTER par.type == "Организатор" LIMIT 1 FOR user IN INBOUND par has_participation RETURN user.login)
-                            LET organizer_key = FIRST(FOR par IN INBOUND cdId participation_in FILTER par.type == "Организатор" LIMIT 1 FOR user IN INBOUND par has_participation RETURN user._key)
-                            LET cleanday = MERGE(cl_day, {{
-                                "key": cl_day._key,
-                                "city": city.name,
-                                "participant_count": participant_count,
-                                "requirements": requirements,
-                                "location": loc,
-                                "created_at": created_at,
-                                "updated_at": updated_at,
-                                "organizer": organizer,
-                                "organizer_key": organizer_key
-                            }})
-                            {'\n'.join(filters)}
-                            
-                            RETURN cleanday
-                    )
-                    FOR u IN page
-                        COLLECT x = TO_STRING({x_accessor}), y = TO_STRING({y_accessor}) WITH COUNT INTO count
-                        RETURN {{ x_label: x, y_label: y, count: count }}
-                """
+
+def get_heatmaps(db: StandardDatabase, grids: list[HeatmapAxes], params: GetCleandaysParams) \
+        -> list[list[HeatmapEntry]]:
+    """Count cleandays by pairs of fields in one streaming scan, computing only the fields that are used.
+
+    Filters on stored fields are applied to the collection scan itself, so the optimizer can use
+    indexes, and traversals run only for the cleandays that pass them. Each cleanday is reduced to
+    the used fields and counted right away, so query memory depends on the number of cells only.
+    """
+    filters, bind_vars = heatmap_filters(params.model_dump(exclude_none=True))
+
+    axis_fields = {field.split('.')[0] for axes in grids for field in (axes.x_field, axes.y_field)}
+    derived_filter_fields = set().union(*(fields for fields, _ in filters if fields & derived_dependencies.keys()))
+    used_fields = axis_fields | derived_filter_fields
+    derived = [field for field in derived_dependencies if field in used_fields]
+
+    lets = []
+    for field in derived:
+        for let in derived_dependencies[field]:
+            if derived_lets[let] not in lets:
+                lets.append(derived_lets[let])
+
+    raw_filters = [template.format(doc="cl_day") for fields, template in filters if not fields & set(derived)]
+    derived_filters = [template.format(doc="cleanday") for fields, template in filters if fields & set(derived)]
+
+    projection = ", ".join(derived_values[field] if field in derived_values else f'"{field}": cl_day.{field}'
+                           for field in sorted(used_fields))
+
+    xs = switch_expression([axis_values(axes.x_field, axes.x_bucket) for axes in grids])
+    ys = switch_expression([axis_values(axes.y_field, axes.y_bucket) for axes in grids])
+
+    # Хэш-группировка не сортирует входной поток, в памяти остаются только ячейки
+    query = f"""
+                FOR cl_day IN CleanDay
+                    {'\n'.join(raw_filters)}
+                    LET cdId = cl_day._id
+                    {'\n'.join(lets)}
+                    LET cleanday = {{{projection}}}
+                    {'\n'.join(derived_filters)}
+                    FOR grid IN 0..{len(grids) - 1}
+                        FOR x_value IN {xs}
+                            FOR y_value IN {ys}
+                                COLLECT grid_index = grid, x = x_value, y = y_value WITH COUNT INTO count
+                                OPTIONS {{ method: "hash" }}
+                                RETURN {{ grid: grid_index, x_label: x, y_label: y, count: count }}
+    """
 
     logger.info(query)
-    cursor = db.aql.execute(query, bind_vars=bind_vars)
-    return [HeatmapEntry.model_validate(doc) for doc in cursor]
+    cursor = db.aql.execute(query, bind_vars=bind_vars, stream=True)
+
+    results = [[] for _ in grids]
+    for doc in cursor:
+        results[doc["grid"]].append(HeatmapEntry.model_validate(doc))
+    return results
 
+
+def get_heatmap(db: StandardDatabase, x_field: CleandayHeatmapField, y_field: CleandayHeatmapField,
+                params: CleandayHeatmapQuery) -> list[HeatmapEntry]:
+    axes = HeatmapAxes(x_field=x_field, y_field=y_field, x_bucket=params.x_bucket, y_bucket=params.y_bucket)
+    return get_heatmaps(db, [axes], params)[0]
@@ -0,0 +1,60 @@
+import random
+from datetime import datetime, UTC
+
+from arango.database import StandardDatabase
+
+# Сущности, у которых есть счётчик версий для составных представлений (ETag)
+versioned_collections = {
+    'cleanday_key': 'CleanDay',
+    'user_key': 'User',
+    'location_key': 'Location'
+}
+
+# Общая версия данных для кэша результатов статистики и тепловых карт;
+# как и счётчики Stats, разложена по документам, чтобы не было конфликтов записи
+DATA_VERSION_SHARDS = 8
+
+
+class VersionRepo:
+
+    def __init__(self, database: StandardDatabase):
+        self.db = database
+
+    def bump(self, collection: str, keys: list[str]):
+        self.db.aql.execute(
+            f"""
+            FOR versioned IN {collection}
+                FILTER versioned._key IN @keys
+                UPDATE versioned WITH {{
+                    version: NOT_NULL(versioned.version, 0) + 1,
+                    modified_at: @date
+                }} IN {collection}
+            """,
+            bind_vars={"keys": keys, "date": datetime.now(UTC).isoformat()}
+        )
+
+    def bump_data(self):
+        """Increment the global data version; the caller's transaction must write DataVersion."""
+        self.db.aql.execute(
+            """
+            UPSERT {_key: @shard}
+            INSERT {_key: @shard, version: 1, modified_at: @date}
+            UPDATE {version: OLD.version + 1, modified_at: @date}
+            IN DataVersion
+            """,
+            bind_vars={"shard": str(random.randrange(DATA_VERSION_SHARDS)), "date": datetime.now(UTC).isoformat()}
+        )
+
+    def get_data_version(self) -> str:
+        """Token that changes on every bump.
+
+        The modification date is part of the token, so the version does not repeat an old one
+        when the collection is restored from a dump and bumped again.
+        """
+        cursor = self.db.aql.execute(
+            """
+            LET shards = (FOR v IN DataVersion RETURN v)
+            RETURN CONCAT(SUM(shards[*].version), "@", NOT_NULL(MAX(shards[*].modified_at), ""))
+            """
+        )
+        return cursor.next()
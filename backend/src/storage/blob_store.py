@@ -0,0 +1,143 @@
+import hashlib
+import os
+import re
+import tempfile
+from abc import ABC, abstractmethod
+from functools import cache
+from typing import Iterator, Optional
+
+from config.environment import BLOB_STORE, BLOB_STORE_PATH, S3_ENDPOINT_URL, S3_BUCKET, S3_ACCESS_KEY, \
+    S3_SECRET_KEY
+
+CHUNK_SIZE = 64 * 1024
+
+HASH_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+def blob_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def is_valid_hash(value: str) -> bool:
+    return HASH_PATTERN.match(value) is not None
+
+
+class BlobStore(ABC):
+    """Content-addressed storage: blobs are keyed by the SHA-256 of their bytes."""
+
+    @abstractmethod
+    def put(self, data: bytes) -> str:
+        ...
+
+    @abstractmethod
+    def size(self, key: str) -> Optional[int]:
+        ...
+
+    @abstractmethod
+    def read_range(self, key: str, start: int, end: int, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        """Yield bytes start..end (inclusive) of the blob."""
+
+    def read(self, key: str) -> bytes:
+        size = self.size(key)
+        if size is None:
+            raise KeyError(key)
+        if size == 0:
+            return b''
+        return b''.join(self.read_range(key, 0, size - 1))
+
+
+class LocalBlobStore(BlobStore):
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        if not is_valid_hash(key):
+            raise KeyError(key)
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def put(self, data: bytes) -> str:
+        key = blob_hash(data)
+        path = self._path(key)
+        if os.path.exists(path):
+            return key
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Пишем во временный файл рядом и атомарно переименовываем,
+        # чтобы читатели никогда не видели недописанный блоб
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise e
+
+        return key
+
+    def size(self, key: str) -> Optional[int]:
+        try:
+            return os.path.getsize(self._path(key))
+        except (KeyError, FileNotFoundError):
+            return None
+
+    def read_range(self, key: str, start: int, end: int, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        with open(self._path(key), 'rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+
+class S3BlobStore(BlobStore):
+    """Blob store backed by an S3-compatible service (e.g. a local MinIO)."""
+
+    def __init__(self, endpoint_url: Optional[str], bucket: str,
+                 access_key: Optional[str], secret_key: Optional[str]):
+        try:
+            import boto3
+            from botocore.exceptions import ClientError
+        except ImportError:
+            raise RuntimeError("BLOB_STORE=s3 requires the boto3 package")
+
+        self.client_error = ClientError
+        self.bucket = bucket
+        self.client = boto3.client('s3', endpoint_url=endpoint_url,
+                                   aws_access_key_id=access_key, aws_secret_access_key=secret_key)
+
+    def put(self, data: bytes) -> str:
+        key = blob_hash(data)
+        if self.size(key) is None:
+            self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+        return key
+
+    def size(self, key: str) -> Optional[int]:
+        if not is_valid_hash(key):
+            return None
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=key)['ContentLength']
+        except self.client_error:
+            return None
+
+    def read_range(self, key: str, start: int, end: int, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        response = self.client.get_object(Bucket=self.bucket, Key=key, Range=f'bytes={start}-{end}')
+        yield from response['Body'].iter_chunks(chunk_size)
+
+
+def create_blob_store() -> BlobStore:
+    if BLOB_STORE == 's3':
+        return S3BlobStore(S3_ENDPOINT_URL, S3_BUCKET, S3_ACCESS_KEY, S3_SECRET_KEY)
+    return LocalBlobStore(BLOB_STORE_PATH)
+
+
+@cache
+def get_blob_store() -> BlobStore:
+    """Store created on first use, so importing the module does not touch the disk or S3."""
+    return create_blob_store()
@@ -0,0 +1,94 @@
+import base64
+import binascii
+import io
+import re
+from typing import Optional, Tuple
+
+from PIL import Image as PILImage, UnidentifiedImageError
+
+from storage.blob_store import get_blob_store
+from storage.variants import blob_saved
+
+# Аватар, который выдаётся пользователю при регистрации; байтов у него нет
+DEFAULT_AVATAR = "default_image"
+
+DATA_URL_PATTERN = re.compile(r'^data:(?P<content_type>[\w.+-]+/[\w.+-]+)?(;[^,]*)?;base64,', re.ASCII)
+
+SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+]
+
+
+def guess_content_type(data: bytes) -> str:
+    for signature, content_type in SIGNATURES:
+        if data.startswith(signature):
+            return content_type
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'application/octet-stream'
+
+
+def decode_photo(photo: str) -> Tuple[bytes, str]:
+    """Decode a data URL or a bare base64 string into bytes and a content type.
+
+    Raises ValueError if the payload is not valid base64.
+    """
+    content_type = None
+    match = DATA_URL_PATTERN.match(photo)
+    if match:
+        content_type = match.group('content_type')
+        photo = photo[match.end():]
+
+    try:
+        data = base64.b64decode(photo, validate=True)
+    except binascii.Error:
+        raise ValueError("Invalid base64 image data")
+
+    return data, content_type or guess_content_type(data)
+
+
+def read_dimensions(data: bytes) -> Tuple[Optional[int], Optional[int]]:
+    """Read width and height from the image header without decoding the pixels."""
+    try:
+        with PILImage.open(io.BytesIO(data)) as img:
+            return img.width, img.height
+    except (UnidentifiedImageError, OSError):
+        return None, None
+
+
+def image_url(blob_hash: Optional[str]) -> Optional[str]:
+    if blob_hash is None:
+        return None
+    return f"/api/images/{blob_hash}"
+
+
+def save_photo(photo: str) -> dict:
+    """Put the photo bytes into the blob store and return the metadata kept in the Image document."""
+    if photo == DEFAULT_AVATAR:
+        return {"hash": None, "size": 0, "width": None, "height": None, "content_type": None}
+
+    data, content_type = decode_photo(photo)
+    width, height = read_dimensions(data)
+    blob_hash = get_blob_store().put(data)
+
+    # Уменьшенные копии строятся в пуле процессов после фиксации транзакции, запрос их не ждёт
+    blob_saved(blob_hash)
+
+    return {
+        "hash": blob_hash,
+        "size": len(data),
+        "width": width,
+        "height": height,
+        "content_type": content_type
+    }
+
+
+def load_metadata(image_dict: dict) -> dict:
+    """Prepare an Image document for listings: metadata and a URL instead of the bytes."""
+    image_dict['url'] = image_url(image_dict.get('hash'))
+    image_dict['size'] = image_dict.get('size') or 0
+
+    return image_dict
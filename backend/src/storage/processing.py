@@ -0,0 +1,39 @@
+import io
+
+from PIL import Image as PILImage, ImageOps
+
+VARIANT_FORMAT = 'WEBP'
+VARIANT_CONTENT_TYPE = 'image/webp'
+VARIANT_QUALITY = 80
+
+
+def make_variants(data: bytes, sizes: list[int]) -> list[dict]:
+    """Decode the image once and encode a WebP copy for every size smaller than the original.
+
+    Runs in a worker process, so it only depends on Pillow.
+    """
+    with PILImage.open(io.BytesIO(data)) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA' if 'A' in img.getbands() or 'transparency' in img.info else 'RGB')
+
+        variants = []
+        for size in sorted(set(sizes), reverse=True):
+            if max(img.width, img.height) <= size:
+                continue
+
+            # Каждая следующая копия уменьшается из предыдущей, а не из оригинала
+            img = img.copy()
+            img.thumbnail((size, size), PILImage.Resampling.LANCZOS)
+
+            buffer = io.BytesIO()
+            img.save(buffer, VARIANT_FORMAT, quality=VARIANT_QUALITY)
+            variants.append({
+                'size': size,
+                'data': buffer.getvalue(),
+                'width': img.width,
+                'height': img.height,
+                'content_type': VARIANT_CONTENT_TYPE
+            })
+
+    return variants
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional, Iterator
+
+from config.environment import IMAGE_VARIANT_SIZES, IMAGE_WORKERS
+from repo.client import database
+from repo.image_repo import ImageRepo
+from storage import processing
+from storage.blob_store import get_blob_store
+
+logger = logging.getLogger(__name__)
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+# Ссылки на запущенные задачи, чтобы их не собрал сборщик мусора
+_tasks: set[asyncio.Task] = set()
+
+# Ограничивает число изображений, одновременно находящихся в памяти
+_semaphore = asyncio.Semaphore(IMAGE_WORKERS * 2)
+
+# Блобы, сохранённые в транзакции текущего запроса: копии для них строятся только после её фиксации
+_collected: ContextVar[Optional[list[str]]] = ContextVar('collected_blobs', default=None)
+
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawn: рабочие процессы не наследуют соединения и потоки сервера
+        _pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def schedule_variants(*blob_hashes: str):
+    """Generate resized copies of the blobs in the background. Does nothing outside an event loop."""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+
+    for blob_hash in blob_hashes:
+        task = loop.create_task(generate_variants(blob_hash))
+        _tasks.add(task)
+        task.add_done_callback(_tasks.discard)
+
+
+@contextmanager
+def collect_blobs() -> Iterator[list[str]]:
+    """Collect the blobs saved inside the block instead of generating their variants at once.
+
+    The handler passes the list to schedule_variants after its transaction is committed,
+    so an aborted transaction leaves no variants behind. Blobs saved after the block get
+    their variants at once again.
+    """
+    blobs = []
+    token = _collected.set(blobs)
+    try:
+        yield blobs
+    finally:
+        _collected.reset(token)
+
+
+def blob_saved(blob_hash: str):
+    collected = _collected.get()
+    if collected is None:
+        schedule_variants(blob_hash)
+    else:
+        collected.append(blob_hash)
+
+
+async def generate_variants(blob_hash: str):
+    async with _semaphore:
+        await _generate_variants(blob_hash)
+
+
+async def _generate_variants(blob_hash: str):
+    image_repo = ImageRepo(database)
+    if image_repo.has_variants(blob_hash):
+        return
+
+    loop = asyncio.get_running_loop()
+    try:
+        data = await loop.run_in_executor(None, get_blob_store().read, blob_hash)
+        variants = await loop.run_in_executor(get_pool(), processing.make_variants, data, IMAGE_VARIANT_SIZES)
+    except Exception:
+        logger.exception(f'Failed to generate variants of {blob_hash}')
+        return
+
+    for variant in variants:
+        variant['hash'] = await loop.run_in_executor(None, get_blob_store().put, variant.pop('data'))
+
+    image_repo.create_variants(blob_hash, variants)
@@ -0,0 +1,10 @@
+import logging
+
+from analytics.engine import analytics_engine
+
+logger = logging.getLogger(__name__)
+
+
+def refresh_snapshot():
+    if analytics_engine.refresh():
+        logger.info('Analytics snapshot reloaded')
@@ -0,0 +1,52 @@
+import asyncio
+import logging
+import time
+
+from arango.exceptions import ArangoServerError
+
+from repo.client import database
+from repo.heatmap_repo import HeatmapCubeRepo, CubeKind
+from repo.version_repo import VersionRepo
+
+logger = logging.getLogger(__name__)
+
+# Код ошибки ArangoDB при конфликте параллельной записи одного документа
+ERROR_ARANGO_CONFLICT = 1200
+
+REFRESH_ATTEMPTS = 5
+
+# Ссылки на запущенные задачи, чтобы их не собрал сборщик мусора
+_tasks: set[asyncio.Task] = set()
+
+
+def schedule_refresh(kind: CubeKind, keys: list[str]):
+    """Update the heatmap cube for changed entities after the request's transaction is committed.
+
+    Does nothing outside an event loop; missed updates are repaired by the periodic rebuild.
+    """
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+
+    task = loop.create_task(asyncio.to_thread(refresh, kind, list(keys)))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+def refresh(kind: CubeKind, keys: list[str]):
+    for attempt in range(REFRESH_ATTEMPTS):
+        try:
+            HeatmapCubeRepo(database).refresh(kind, keys)
+            return
+        except ArangoServerError as e:
+            if e.error_code != ERROR_ARANGO_CONFLICT or attempt == REFRESH_ATTEMPTS - 1:
+                logger.exception(f'Failed to refresh {kind} heatmap cube for {keys}')
+                return
+            time.sleep(0.05 * (attempt + 1))
+
+
+def rebuild_cubes():
+    HeatmapCubeRepo(database).rebuild()
+    VersionRepo(database).bump_data()
+    logger.info('Heatmap cubes rebuilt')
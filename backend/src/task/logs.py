@@ -0,0 +1,15 @@
+import logging
+from datetime import datetime, UTC, timedelta
+
+from config.environment import LOG_RETENTION_DAYS
+from repo.client import database
+from repo.log_repo import LogRepo
+
+logger = logging.getLogger(__name__)
+
+
+def archive_logs():
+    """Move logs past the retention period to the archive collection."""
+    archived = LogRepo(database).archive(datetime.now(UTC) - timedelta(days=LOG_RETENTION_DAYS))
+    if archived:
+        logger.info(f'Archived {archived} logs older than {LOG_RETENTION_DAYS} days')
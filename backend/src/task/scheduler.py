@@ -0,0 +1,40 @@
+import asyncio
+import logging
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler:
+    """Runs blocking maintenance jobs periodically in a worker thread.
+
+    A failed run is logged and the job is retried at the next interval.
+    """
+
+    def __init__(self):
+        self.jobs: list[tuple[str, float, Callable[[], object]]] = []
+        self.tasks: list[asyncio.Task] = []
+
+    def every(self, name: str, interval: float, job: Callable[[], object]):
+        self.jobs.append((name, interval, job))
+
+    def start(self):
+        for name, interval, job in self.jobs:
+            self.tasks.append(asyncio.create_task(self._loop(name, interval, job)))
+
+    async def shutdown(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks.clear()
+
+    async def _loop(self, name: str, interval: float, job: Callable[[], object]):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(job)
+            except Exception:
+                logger.exception(f'Periodic job {name} failed')
+
+
+scheduler = Scheduler()
@@ -0,0 +1,14 @@
+import logging
+
+from repo.client import database
+from repo.stat_repo import StatRepo
+from repo.version_repo import VersionRepo
+
+logger = logging.getLogger(__name__)
+
+
+def reconcile_stats():
+    """Recount the stats counters to repair drift, e.g. after a database restore."""
+    stats = StatRepo(database).reconcile()
+    VersionRepo(database).bump_data()
+    logger.info(f'Stats reconciled: {stats.model_dump(exclude={"updated_at", "reconciled_at"})}')
@@ -0,0 +1,49 @@
+import asyncio
+import logging
+import time
+
+from arango.exceptions import ArangoServerError
+
+from repo.client import database
+from repo.version_repo import VersionRepo
+from task.heatmap import ERROR_ARANGO_CONFLICT
+
+logger = logging.getLogger(__name__)
+
+BUMP_ATTEMPTS = 5
+
+# Ссылки на запущенные задачи, чтобы их не собрал сборщик мусора
+_tasks: set[asyncio.Task] = set()
+
+
+def schedule_bump(versioned: dict[str, set[str]]):
+    """Increment the versions of changed entities after the request's transaction is committed.
+
+    Outside an event loop the versions are bumped at once.
+    """
+    versioned = {collection: list(keys) for collection, keys in versioned.items() if keys}
+    if not versioned:
+        return
+
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        bump(versioned)
+        return
+
+    task = loop.create_task(asyncio.to_thread(bump, versioned))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+def bump(versioned: dict[str, list[str]]):
+    for collection, keys in versioned.items():
+        for attempt in range(BUMP_ATTEMPTS):
+            try:
+                VersionRepo(database).bump(collection, keys)
+                break
+            except ArangoServerError as e:
+                if e.error_code != ERROR_ARANGO_CONFLICT or attempt == BUMP_ATTEMPTS - 1:
+                    logger.exception(f'Failed to bump versions of {collection} {keys}')
+                    break
+                time.sleep(0.05 * (attempt + 1))
@@ -0,0 +1,123 @@
+import os
+import stat
+import zipfile
+
+import pytest
+
+from backup import extract
+from backup.extract import extract_archive
+
+
+def make_zip(path, entries):
+    """Write a zip with (name, data) or ZipInfo entries."""
+    with zipfile.ZipFile(path, 'w') as zipf:
+        for name, data in entries:
+            zipf.writestr(name, data)
+    return path
+
+
+def symlink_info(name: str) -> zipfile.ZipInfo:
+    info = zipfile.ZipInfo(name)
+    info.external_attr = (stat.S_IFLNK | 0o777) << 16
+    return info
+
+
+@pytest.fixture
+def target(tmp_path):
+    directory = tmp_path / "extract"
+    directory.mkdir()
+    return directory
+
+
+def test_extracts_dump(tmp_path, target):
+    archive = make_zip(tmp_path / "dump.zip", [
+        ("dump.json", "{}"),
+        ("CleanDay.structure.json", "{}"),
+        ("CleanDay.data.json.gz", b"\x1f\x8b"),
+    ])
+
+    extract_archive(archive, target)
+
+    assert sorted(os.listdir(target)) == ["CleanDay.data.json.gz", "CleanDay.structure.json", "dump.json"]
+
+
+@pytest.mark.parametrize("name", [
+    "../evil.json",
+    "nested/../../evil.json",
+    "/etc/evil.json",
+    "..\\evil.json",
+    "C:/evil.json",
+])
+def test_rejects_path_traversal(tmp_path, target, name):
+    archive = make_zip(tmp_path / "dump.zip", [("dump.json", "{}"), (name, "x")])
+
+    with pytest.raises(ValueError, match="Unsafe path"):
+        extract_archive(archive, target)
+
+    assert not (tmp_path / "evil.json").exists()
+
+
+def test_rejects_symlink(tmp_path, target):
+    archive = make_zip(tmp_path / "dump.zip", [("dump.json", "{}"), (symlink_info("link"), "/etc/passwd")])
+
+    with pytest.raises(ValueError, match="Symbolic link"):
+        extract_archive(archive, target)
+
+    assert not (target / "link").exists()
+
+
+def test_rejects_too_many_entries(tmp_path, target, monkeypatch):
+    monkeypatch.setattr(extract, "IMPORT_MAX_ENTRIES", 2)
+    archive = make_zip(tmp_path / "dump.zip", [("dump.json", "{}")] + [(f"{i}.json", "{}") for i in range(2)])
+
+    with pytest.raises(ValueError, match="more than 2 entries"):
+        extract_archive(archive, target)
+
+
+def test_rejects_zip_bomb(tmp_path, target, monkeypatch):
+    monkeypatch.setattr(extract, "IMPORT_MAX_UNCOMPRESSED_SIZE", 1024)
+    archive = tmp_path / "dump.zip"
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        zipf.writestr("dump.json", "{}")
+        zipf.writestr("CleanDay.data.json", b"\0" * 1024 * 1024)
+
+    with pytest.raises(ValueError, match="too large"):
+        extract_archive(archive, target)
+
+
+def test_rejects_understated_sizes(tmp_path, target, monkeypatch):
+    monkeypatch.setattr(extract, "IMPORT_MAX_UNCOMPRESSED_SIZE", 1024)
+    archive = tmp_path / "dump.zip"
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        zipf.writestr("dump.json", "{}")
+        zipf.writestr("CleanDay.data.json", b"\0" * 1024 * 1024)
+
+    # Размеры в заголовках подделаны: распаковка не должна записать больше лимита
+    data = bytearray(archive.read_bytes())
+    with zipfile.ZipFile(archive) as zipf:
+        info = zipf.getinfo("CleanDay.data.json")
+    size_offset = data.rfind(b"PK\x01\x02") + 24
+    data[size_offset:size_offset + 4] = (10).to_bytes(4, 'little')
+    data[info.header_offset + 22:info.header_offset + 26] = (10).to_bytes(4, 'little')
+    archive.write_bytes(bytes(data))
+
+    with pytest.raises(ValueError):
+        extract_archive(archive, target)
+
+    extracted = target / "CleanDay.data.json"
+    assert not extracted.exists() or extracted.stat().st_size <= 1024
+
+
+def test_rejects_archive_without_dump(tmp_path, target):
+    archive = make_zip(tmp_path / "dump.zip", [("notes.txt", "hello")])
+
+    with pytest.raises(ValueError, match="does not contain an arangodump"):
+        extract_archive(archive, target)
+
+
+def test_rejects_non_zip(tmp_path, target):
+    archive = tmp_path / "dump.zip"
+    archive.write_bytes(b"not a zip")
+
+    with pytest.raises(ValueError, match="Invalid zip"):
+        extract_archive(archive, target)
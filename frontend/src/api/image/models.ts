@@ -2,7 +2,11 @@ import { BaseApiModel, BaseGetResponseModel } from "@api/BaseApiModel";
 
 export interface ImageApiModel extends BaseApiModel {
     description: string;
-    photo: string;
+    url: string | null;
+    size: number;
+    width: number | null;
+    height: number | null;
+    content_type: string | null;
 }
 
 export interface GetImagesResponse extends BaseGetResponseModel {
@@ -75,8 +75,8 @@ const ViewCleandayResultsDialog: React.FC<ViewCleandayResultsDialogProps> = ({
 
     // Helper function to properly format base64 image
     const getImageSrc = (photoData: string): string => {
-        // Check if the string already includes the data:image prefix
-        if (photoData.startsWith('data:image')) {
+        // Check if the string already is a data URL or a link to the image
+        if (photoData.startsWith('data:image') || photoData.startsWith('http')) {
             return photoData;
         }
         
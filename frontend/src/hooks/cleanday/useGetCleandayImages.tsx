@@ -2,29 +2,20 @@ import { useGetOneTemplate } from '@hooks/templates/get/useGetOneTemplate.tsx';
 import substituteIdToEndpoint from '@/utils/api/substituteIdToEndpoint.ts';
 import { GET_CLEANDAY_IMAGES } from '@api/cleanday/endpoints.ts';
 import { Image } from '@models/Image.ts';
-
-interface ImageListResponse {
-  contents: Array<{
-    key: string;
-    description: string;
-    photo: string;
-  }>;
-}
+import { GetImagesResponse } from '@api/image/models';
+import { resolveImageUrl } from '@utils/image/mapper';
 
 export function useGetCleandayImages(cleandayId: string) {
-  return useGetOneTemplate<ImageListResponse, { contents: Image[] }>(
+  return useGetOneTemplate<GetImagesResponse, { contents: Image[] }>(
     ['cleanday', cleandayId, 'images'],
     substituteIdToEndpoint(cleandayId, GET_CLEANDAY_IMAGES),
     undefined,
     { enabled: !!cleandayId },
     (response) => {
-      // Map the response to ensure image data is properly structured
+      // Listing contains only metadata, the photo itself is loaded by URL
       const processedContents = response.contents.map(img => ({
         ...img,
-        // Ensure we're not adding duplicate data:image prefixes
-        photo: img.photo.startsWith('data:image') 
-          ? img.photo 
-          : `data:image/jpeg;base64,${img.photo}`
+        photo: resolveImageUrl(img.url)
       }));
       
       return { contents: processedContents };
@@ -1,6 +1,11 @@
 import { useGetOneTemplate } from '@hooks/templates/get/useGetOneTemplate.tsx';
 import { GET_USER_AVATAR } from '@api/user/endpoints.ts';
 import substituteIdToEndpoint from '@/utils/api/substituteIdToEndpoint.ts';
+import { ImageApiModel } from '@api/image/models';
+import { resolveImageUrl } from '@utils/image/mapper';
+
+// Аватары показываются небольшими, полный размер не нужен
+const AVATAR_SIZE = 256;
 
 interface UserAvatarResponse {
   photo: string;
@@ -9,16 +14,17 @@ interface UserAvatarResponse {
 /**
  * Hook for fetching a user's avatar
  * @param userId - The ID of the user whose avatar to fetch
- * @returns The query result containing the user's avatar as a base64 string
+ * @returns The query result containing the user's avatar URL ("default_image" if none)
  */
 export function useGetUserAvatar(userId: string) {
-  return useGetOneTemplate<UserAvatarResponse, UserAvatarResponse>(
+  return useGetOneTemplate<ImageApiModel, UserAvatarResponse>(
     ['user', userId, 'avatar'],
     substituteIdToEndpoint(userId, GET_USER_AVATAR),
     undefined,
     {
       staleTime: 5 * 60 * 1000, // 5 minutes cache
       enabled: !!userId
-    }
+    },
+    (response) => ({ photo: resolveImageUrl(response.url, AVATAR_SIZE) })
   );
 }
@@ -1,5 +1,20 @@
 import { ImageApiModel } from "@api/image/models";
 import { Image } from "@models/Image";
+import axiosInstance from "@/axiosInstance.ts";
+
+/**
+ * Converts the image URL returned by the API into an <img> src.
+ * Images without bytes (the default avatar) map to "default_image".
+ * With `size` the server returns a downscaled copy at least `size` pixels on its longer side.
+ */
+export const resolveImageUrl = (url?: string | null, size?: number): string => {
+    if (!url) {
+        return "default_image";
+    }
+
+    const src = `${axiosInstance.defaults.baseURL}${url}`;
+    return size ? `${src}?size=${size}` : src;
+};
 
 export const imageMapper = (apiModel?: ImageApiModel): Image | undefined => {
     if (!apiModel) {
@@ -9,6 +24,6 @@ export const imageMapper = (apiModel?: ImageApiModel): Image | undefined => {
     return {
         id: apiModel.key,
         description: apiModel.description,
-        photo: apiModel.photo
+        photo: resolveImageUrl(apiModel.url)
     };
 };